@@ -3,6 +3,9 @@ ASGI config for anos project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Login and sign up are async views (``core.authentication.async_views``) hashing passwords in a bounded thread
+pool, under ASGI they don't hold up other requests while doing so.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -78,12 +78,57 @@ WSGI_APPLICATION = 'appity.wsgi.application'
 
 AUTH_USER_MODEL = 'core.AppUser'
 
+# Ids go from MIN to MAX, then from MAX + 1 to MAX * GROWTH_FACTOR and so on, in a random looking order. Each process
+# reserves BLOCK_SIZE ids at a time. GROW_AFTER_COLLISIONS is no longer used, ids don't collide.
 APPITY_RANDOM_ID = {
     'default': {'MIN': 1000,
                 'MAX': 999999,
                 'GROWTH_FACTOR': 10,
-                'GROW_AFTER_COLLISIONS': 5}
+                'GROW_AFTER_COLLISIONS': 5,
+                'BLOCK_SIZE': 100}
 }
+
+# Number of days, starting today, for which provider free time is kept materialized as bitmaps
+APPITY_AVAILABILITY_BITMAP_DAYS = 92
+# Appointments reserve provider time in units of this many minutes, appointments sharing a unit overlap
+APPITY_RESERVATION_UNIT_MINUTES = 5
+# Resolved Appity tokens are cached in process for LOCAL_TTL seconds and in the CACHE cache for SHARED_TTL seconds,
+# never beyond their expiration. Other workers keep accepting a deleted token until their local copy expires, at
+# most LOCAL_TTL seconds. Deletes only reach other workers through a CACHE they share (Redis, Memcached), with the
+# default per-process cache the token cache stays off unless ENABLED is True.
+APPITY_TOKEN_CACHE = {
+    'ENABLED': None,
+    'SIZE': 10000,
+    'LOCAL_TTL': 5,
+    'SHARED_TTL': 300,
+    'CACHE': 'default',
+}
+# Stateless signed access tokens, CURRENT_KEY signs new tokens and all KEYS verify them so keys can be rotated.
+# Revocations reach other workers within REVOCATION_REFRESH seconds.
+APPITY_SIGNED_TOKENS = {
+    'KEYS': {'1': SECRET_KEY},
+    'CURRENT_KEY': '1',
+    'LIFETIME': 3600,
+    'REVOCATION_REFRESH': 5,
+    'BLOOM_CAPACITY': 100000,
+    'BLOOM_ERROR_RATE': 0.01,
+}
+
+# Password hashes of login and sign up are computed by WORKERS threads, with up to QUEUE more waiting. Beyond that
+# requests get a 503 response telling clients to retry after RETRY_AFTER seconds.
+APPITY_PASSWORD_HASHING = {
+    'WORKERS': 4,
+    'QUEUE': 32,
+    'RETRY_AFTER': 1,
+}
+
+# Workers keep currency rates in memory and check the version of the rates in the CACHE cache every VERSION_CHECK
+# seconds, so other workers convert prices with the new rates within that delay.
+APPITY_CURRENCY_RATES = {
+    'VERSION_CHECK': 1,
+    'CACHE': 'default',
+}
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -108,8 +153,9 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle'
+        # sliding window counters, constant cache memory and traffic per request whatever the rates
+        'core.throttling.AnonRateThrottle',
+        'core.throttling.UserRateThrottle'
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '100/day',
@@ -176,6 +222,10 @@ APPEND_SLASH=False
 USER_SHORT_SESSION_SECONDS = 3600 * 24  # 24 hours
 # Number of seconds in which the end-user authentication session expires when "Remember me" is enabled
 USER_LONG_SESSION_SECONDS = 3600 * 24 * 60  # 60 days
+# Session engines of core.authentication.sessions write a session at most once per request and skip unchanged saves.
+# Use core.authentication.sessions.cached_db to serve session reads from SESSION_CACHE_ALIAS, which must then be a
+# cache shared by all workers (e.g. Redis or Memcached), not the per-process default.
+SESSION_ENGINE = 'core.authentication.sessions.db'
 
 
 AUTHENTICATION_BACKENDS = (
@@ -0,0 +1,230 @@
+"""
+Materialized availability bitmaps.
+
+Free time of every provider is stored as one ``AvailabilityBitmap`` row per day, one bit per minute, for the next
+``APPITY_AVAILABILITY_BITMAP_DAYS`` days. Reads scan the bits of a single table instead of combining availability
+and appointments, and the rows are refreshed from signals whenever the underlying data changes.
+"""
+import datetime
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from booking.models import Availability, AvailabilityBitmap
+from booking.slots import (
+    Interval, date_range_bounds, day_of_week, get_computed_free_intervals, load_weekly_windows, utc_days,
+)
+
+LOG = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+BITMAP_BYTES = MINUTES_PER_DAY // 8
+
+
+def materialized_days() -> int:
+    return getattr(settings, 'APPITY_AVAILABILITY_BITMAP_DAYS', 92)
+
+
+def materialized_range() -> Tuple[datetime.date, datetime.date]:
+    """Return the first and last (inclusive) dates kept materialized."""
+    today = timezone.localdate(timezone.now(), timezone=datetime.timezone.utc)
+    return today, today + datetime.timedelta(days=materialized_days() - 1)
+
+
+def day_start(day: datetime.date) -> datetime.datetime:
+    return datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+
+def rasterize(intervals: Iterable[Interval], start_date: datetime.date, end_date: datetime.date) -> Dict:
+    """
+    Turn sorted free intervals into one integer bitmap per day.
+    Partial minutes are not free: interval starts are rounded up and ends are rounded down to the minute.
+    """
+    bitmaps = {}
+    day = start_date
+    while day <= end_date:
+        bitmaps[day] = 0
+        day += datetime.timedelta(days=1)
+    origin = day_start(start_date)
+    for start, end in intervals:
+        first_minute = -(-(start - origin) // datetime.timedelta(minutes=1))
+        last_minute = (end - origin) // datetime.timedelta(minutes=1)
+        while first_minute < last_minute:
+            day_index, minute = divmod(first_minute, MINUTES_PER_DAY)
+            run = min(last_minute - first_minute, MINUTES_PER_DAY - minute)
+            day = start_date + datetime.timedelta(days=day_index)
+            if day in bitmaps:
+                bitmaps[day] |= ((1 << run) - 1) << minute
+            first_minute += run
+    return bitmaps
+
+
+def iter_bitmap_intervals(day: datetime.date, bits: int):
+    """Yield the free intervals of one day bitmap, one per run of set bits."""
+    origin = day_start(day)
+    while bits:
+        first = (bits & -bits).bit_length() - 1
+        shifted = bits >> first
+        run = ((shifted ^ (shifted + 1)) >> 1).bit_length()
+        yield origin + datetime.timedelta(minutes=first), origin + datetime.timedelta(minutes=first + run)
+        bits &= ~(((1 << run) - 1) << first)
+
+
+def weekday_days(weekdays: Set[int], timezone_name: str = '') -> Set[datetime.date]:
+    """
+    Return the materialized (UTC) days overlapping local days of some days of the week, those whose free time
+    depends on the availability windows of these days.
+    :param weekdays: ``Availability.DayOfWeek`` values
+    """
+    first_day, last_day = materialized_range()
+    one_day = datetime.timedelta(days=1)
+    days = set()
+    local_day = first_day - one_day
+    while local_day <= last_day + one_day:
+        if day_of_week(local_day) in weekdays:
+            day, last_utc_day = utc_days(*date_range_bounds(local_day, local_day, timezone_name))
+            while day <= last_utc_day:
+                if first_day <= day <= last_day:
+                    days.add(day)
+                day += one_day
+        local_day += one_day
+    return days
+
+
+def refresh_bitmaps(
+        provider_ids: List[int], start_date: datetime.date, end_date: datetime.date, using: Optional[str] = None,
+        days: Optional[Set[datetime.date]] = None,
+):
+    """
+    Recompute and store the bitmaps of the given providers for every day between two dates (inclusive).
+    :param days: only store these days of the range
+    """
+    first_day, last_day = materialized_range()
+    start_date, end_date = max(start_date, first_day), min(end_date, last_day)
+    if days is not None:
+        days = {day for day in days if start_date <= day <= end_date}
+        if not days:
+            return
+        start_date, end_date = min(days), max(days)
+    if not provider_ids or start_date > end_date:
+        return
+    weekly_windows = load_weekly_windows(provider_ids, using=using)
+    free = get_computed_free_intervals(
+        provider_ids, weekly_windows, day_start(start_date), day_start(end_date + datetime.timedelta(days=1)),
+        using=using,
+    )
+    rows = []
+    for provider_id in provider_ids:
+        for day, bits in rasterize(free.get(provider_id, []), start_date, end_date).items():
+            if days is not None and day not in days:
+                continue
+            rows.append(AvailabilityBitmap(
+                provider_id=provider_id, date=day, bits=bits.to_bytes(BITMAP_BYTES, 'little'),
+                updated_at=timezone.now(),
+            ))
+    AvailabilityBitmap.objects.using(using).bulk_create(
+        rows,
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=['provider', 'date'],
+        update_fields=['bits', 'updated_at'],
+    )
+
+
+def load_bitmap_intervals(
+        provider_ids: Iterable[int], start_date: datetime.date, end_date: datetime.date, using: Optional[str] = None,
+) -> Dict[int, List[Interval]]:
+    """
+    Read free intervals from stored bitmaps with one query, without touching availability or appointments.
+    :return: {provider_id: [(start, end), ...]} only for providers having a bitmap for every requested day
+    """
+    expected_days = (end_date - start_date).days + 1
+    rows = AvailabilityBitmap.objects.using(using).filter(
+        provider_id__in=provider_ids, date__gte=start_date, date__lte=end_date,
+    ).order_by('provider_id', 'date').values_list('provider_id', 'date', 'bits')
+    days = defaultdict(list)
+    for provider_id, day, bits in rows:
+        days[provider_id].append((day, bits))
+    intervals = {}
+    for provider_id, provider_days in days.items():
+        if len(provider_days) != expected_days:
+            continue
+        provider_intervals = []  # type: List[Interval]
+        for day, bits in provider_days:
+            for start, end in iter_bitmap_intervals(day, int.from_bytes(bits, 'little')):
+                if provider_intervals and provider_intervals[-1][1] == start:
+                    # join runs continuing over midnight
+                    provider_intervals[-1] = (provider_intervals[-1][0], end)
+                else:
+                    provider_intervals.append((start, end))
+        intervals[provider_id] = provider_intervals
+    return intervals
+
+
+def get_bitmap_free_intervals(
+        provider_id: int, start_date: datetime.date, end_date: datetime.date, using: Optional[str] = None,
+) -> Optional[List[Interval]]:
+    """Return free intervals of a provider from bitmaps, or None when the range is not fully materialized."""
+    first_day, last_day = materialized_range()
+    if start_date < first_day or end_date > last_day:
+        return None
+    return load_bitmap_intervals([provider_id], start_date, end_date, using=using).get(provider_id)
+
+
+def appointment_days(
+        start: datetime.datetime, end: Optional[datetime.datetime],
+) -> Tuple[datetime.date, datetime.date]:
+    """
+    Return the first and last (inclusive) days touched by an appointment.
+    :param end: None for recurring appointments repeating forever, which touch every materialized day
+    """
+    first_day = start.astimezone(datetime.timezone.utc).date()
+    if end is None:
+        return first_day, max(first_day, materialized_range()[1])
+    return first_day, max(end, start).astimezone(datetime.timezone.utc).date()
+
+
+def safe_refresh_bitmaps(
+        provider_ids: List[int], start_date: datetime.date, end_date: datetime.date, using: Optional[str] = None,
+        days: Optional[Set[datetime.date]] = None,
+):
+    """
+    Refresh bitmaps without ever failing the caller. Rows that could not be refreshed are deleted if possible so
+    reads fall back to availability and appointments instead of returning stale free time.
+    """
+    try:
+        refresh_bitmaps(provider_ids, start_date, end_date, using=using, days=days)
+    except DatabaseError:
+        LOG.exception('Could not refresh availability bitmaps of providers {}'.format(provider_ids))
+        try:
+            rows = AvailabilityBitmap.objects.using(using).filter(
+                provider_id__in=provider_ids, date__gte=start_date, date__lte=end_date,
+            )
+            if days is not None:
+                rows = rows.filter(date__in=days)
+            rows.delete()
+        except DatabaseError:
+            LOG.exception('Could not invalidate availability bitmaps of providers {}'.format(provider_ids))
+
+
+def rebuild(
+        provider_ids: Optional[List[int]] = None, batch_size: int = 100,
+        start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None,
+) -> int:
+    """
+    Recompute bitmaps of many providers in batches and drop rows of days already passed.
+    :return: number of providers processed
+    """
+    first_day, last_day = materialized_range()
+    start_date = max(start_date or first_day, first_day)
+    end_date = min(end_date or last_day, last_day)
+    AvailabilityBitmap.objects.filter(date__lt=first_day).delete()
+    if provider_ids is None:
+        provider_ids = list(Availability.objects.order_by('user_id').values_list('user_id', flat=True).distinct())
+    for index in range(0, len(provider_ids), batch_size):
+        refresh_bitmaps(provider_ids[index:index + batch_size], start_date, end_date)
+    return len(provider_ids)
@@ -0,0 +1,479 @@
+"""
+Bulk import and export of availability and appointments.
+
+Input is parsed incrementally, CSV with a header row or NDJSON, and handled in batches: references are checked with
+one query per batch and existing appointments with a query or two per ``PRELOAD_WINDOW`` of time the batch spans.
+Primary keys come from ``RandomId.bulk`` and rows are written with ``bulk_create``, so memory stays bounded by the
+batch size whatever the size of the input. Exports stream rows from a server side cursor.
+"""
+import codecs
+import csv
+import datetime
+import io
+import json
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from booking import bitmaps, feeds
+from booking.models import Appointment, Availability, AvailabilityBitmap, SlotReservation
+from booking.reservations import reservation_unit, reservation_units
+from booking.slots import MAX_APPOINTMENT_LENGTH, load_recurring_intervals
+from core.models.models import UserToClient
+from core.services.models import Service
+from core.utils import RandomId
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON)
+CONTENT_TYPES = {
+    FORMAT_CSV: 'text/csv; charset=utf-8',
+    FORMAT_NDJSON: 'application/x-ndjson',
+}
+KIND_AVAILABILITY = 'availability'
+KIND_APPOINTMENTS = 'appointments'
+KINDS = (KIND_AVAILABILITY, KIND_APPOINTMENTS)
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+MAX_BATCH_ATTEMPTS = 3
+# appointments of a batch are checked against existing ones this much time at a time
+PRELOAD_WINDOW = datetime.timedelta(days=7)
+
+AVAILABILITY_FIELDS = ['id', 'provider', 'day_of_week', 'start_time', 'end_time']
+APPOINTMENT_FIELDS = [
+    'id', 'provider', 'service', 'customer', 'start', 'end', 'status', 'notes', 'recurrence', 'recurrence_interval',
+    'recurrence_until',
+]
+DAY_NAMES = {label.lower(): value for value, label in Availability.DayOfWeek.choices}
+DAYS_OF_WEEK = set(DAY_NAMES.values())
+APPOINTMENT_STATUSES = {value for value, _ in Appointment.STATUS_CHOICES}
+
+# line number, parsed record or None, error message or None
+Record = Tuple[int, Optional[dict], Optional[str]]
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.error_count = 0
+        self.errors = []  # type: List[dict]
+        self.provider_ids = set()  # type: Set[int]
+
+    def add_error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def to_dict(self) -> dict:
+        return {'created': self.created, 'error_count': self.error_count, 'errors': self.errors}
+
+
+def iter_text_lines(stream, chunk_size: int = 64 * 1024) -> Iterator[str]:
+    """Decode a binary stream as UTF-8 and yield its lines with their line endings, reading one chunk at a time."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        yield from lines
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def iter_records(stream, file_format: str) -> Iterator[Record]:
+    """Parse CSV (with a header row) or NDJSON input into records, lazily."""
+    lines = iter_text_lines(stream)
+    if file_format == FORMAT_CSV:
+        reader = csv.DictReader(lines)
+        try:
+            for row in reader:
+                yield reader.line_num, {key: value for key, value in row.items() if key is not None}, None
+        except csv.Error as e:
+            yield reader.line_num, None, str(e)
+        return
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None, 'Invalid JSON'
+            continue
+        if not isinstance(record, dict):
+            yield line_number, None, 'Expected a JSON object'
+            continue
+        yield line_number, record, None
+
+
+def iter_batches(records: Iterable[Record], batch_size: int) -> Iterator[List[Record]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def blank(value) -> bool:
+    return value is None or value == ''
+
+
+def parse_int(record: dict, name: str, required: bool = True) -> Optional[int]:
+    value = record.get(name)
+    if blank(value):
+        if required:
+            raise ValueError('{} is required'.format(name))
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('{} must be an integer'.format(name))
+
+
+def parse_time(record: dict, name: str) -> datetime.time:
+    value = record.get(name)
+    try:
+        return datetime.time.fromisoformat(str(value))
+    except (TypeError, ValueError):
+        raise ValueError('{} must be a time (HH:MM[:SS])'.format(name))
+
+
+def parse_aware_datetime(record: dict, name: str, required: bool = True) -> Optional[datetime.datetime]:
+    value = record.get(name)
+    if blank(value):
+        if required:
+            raise ValueError('{} is required'.format(name))
+        return None
+    try:
+        parsed = parse_datetime(str(value))
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError('{} must be an ISO 8601 datetime'.format(name))
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def parse_availability(record: dict) -> dict:
+    day = record.get('day_of_week')
+    if isinstance(day, str) and day.strip().lower() in DAY_NAMES:
+        day_of_week = DAY_NAMES[day.strip().lower()]
+    else:
+        day_of_week = parse_int(record, 'day_of_week')
+    if day_of_week not in DAYS_OF_WEEK:
+        raise ValueError('day_of_week must be between 1 (Sunday) and 7 (Saturday)')
+    start_time, end_time = parse_time(record, 'start_time'), parse_time(record, 'end_time')
+    if end_time <= start_time:
+        raise ValueError('end_time must be after start_time')
+    return {
+        'provider': parse_int(record, 'provider'),
+        'day_of_week': day_of_week,
+        'start_time': start_time,
+        'end_time': end_time,
+    }
+
+
+def parse_appointment(record: dict) -> dict:
+    if not blank(record.get('recurrence')):
+        raise ValueError('recurring appointments cannot be imported, book them individually')
+    status = record.get('status') or 'pending'
+    if status not in APPOINTMENT_STATUSES:
+        raise ValueError('status must be one of {}'.format(', '.join(sorted(APPOINTMENT_STATUSES))))
+    start = parse_aware_datetime(record, 'start')
+    end = parse_aware_datetime(record, 'end', required=False)
+    if end is not None and end <= start:
+        raise ValueError('end must be after start')
+    if end is not None and end - start > MAX_APPOINTMENT_LENGTH:
+        raise ValueError('appointments cannot be longer than {}'.format(MAX_APPOINTMENT_LENGTH))
+    return {
+        'provider': parse_int(record, 'provider'),
+        'service': parse_int(record, 'service'),
+        'customer': parse_int(record, 'customer', required=False),
+        'start': start,
+        'end': end,
+        'status': status,
+        'notes': record.get('notes') or None,
+    }
+
+
+def parse_batch(batch: List[Record], parse: Callable, result: ImportResult) -> List[Tuple[int, dict]]:
+    rows = []
+    for line, record, error in batch:
+        if error is None:
+            try:
+                rows.append((line, parse(record)))
+                continue
+            except ValueError as e:
+                error = str(e)
+        result.add_error(line, error)
+    return rows
+
+
+def check_providers(
+        rows: List[Tuple[int, dict]], allowed_provider_ids: Optional[Set[int]], result: ImportResult,
+) -> List[Tuple[int, dict]]:
+    """Drop rows of unknown providers or of providers the importing user doesn't manage, with one query."""
+    provider_ids = {row['provider'] for _, row in rows}
+    existing = set(get_user_model().objects.filter(id__in=provider_ids).values_list('id', flat=True))
+    valid = []
+    for line, row in rows:
+        if row['provider'] not in existing:
+            result.add_error(line, 'Unknown provider {}'.format(row['provider']))
+        elif allowed_provider_ids is not None and row['provider'] not in allowed_provider_ids:
+            result.add_error(line, 'Not allowed to import for provider {}'.format(row['provider']))
+        else:
+            valid.append((line, row))
+    return valid
+
+
+def insert_availability(rows: List[Tuple[int, dict]], result: ImportResult, using: Optional[str] = None):
+    ids = RandomId('booking.Availability').bulk(len(rows))
+    Availability.objects.using(using).bulk_create([
+        Availability(
+            id=availability_id, user_id=row['provider'], day_of_week=row['day_of_week'],
+            start_time=row['start_time'], end_time=row['end_time'],
+        ) for availability_id, (_, row) in zip(ids, rows)
+    ])
+    result.created += len(rows)
+    result.provider_ids.update(row['provider'] for _, row in rows)
+
+
+def iter_preload_windows(rows: List[Tuple[int, dict]]) -> Iterator[List[Tuple[int, dict]]]:
+    """
+    Group rows sorted by start into runs whose appointments all lie within ``PRELOAD_WINDOW`` of the run's first
+    start, so the time read for a run is bounded whatever the dates of the batch.
+    """
+    group = []
+    for line, row in sorted(rows, key=lambda item: item[1]['start']):
+        if group and row['end'] - group[0][1]['start'] > PRELOAD_WINDOW:
+            yield group
+            group = []
+        group.append((line, row))
+    if group:
+        yield group
+
+
+def check_appointments(
+        rows: List[Tuple[int, dict]], result: ImportResult, using: Optional[str] = None,
+) -> List[Tuple[int, dict, List[datetime.datetime]]]:
+    """
+    Resolve services and customers and reject appointments overlapping existing appointments or each other. Existing
+    reservations and recurring occurrences are read with one query each per ``PRELOAD_WINDOW`` the batch spans,
+    for the providers of the rows within it.
+    :return: valid rows with the reservation units they need
+    """
+    services = {
+        service_id: (duration, client_id) for service_id, duration, client_id in Service.objects.using(using).filter(
+            id__in={row['service'] for _, row in rows},
+        ).values_list('id', 'duration', 'client_id')
+    }
+    # services can only be booked with providers of the client offering them
+    memberships = set(UserToClient.objects.using(using).filter(
+        user_id__in={row['provider'] for _, row in rows},
+        client_id__in={client_id for _, client_id in services.values()},
+        invitation=False,
+    ).values_list('user_id', 'client_id'))
+    customer_ids = {row['customer'] for _, row in rows if row['customer'] is not None}
+    customers = set(get_user_model().objects.using(using).filter(id__in=customer_ids).values_list('id', flat=True))
+    checked = []
+    for line, row in rows:
+        if row['service'] not in services:
+            result.add_error(line, 'Unknown service {}'.format(row['service']))
+            continue
+        duration, client_id = services[row['service']]
+        if (row['provider'], client_id) not in memberships:
+            result.add_error(line, 'Service {} is not offered by a client of provider {}'.format(
+                row['service'], row['provider'],
+            ))
+            continue
+        if row['customer'] is not None and row['customer'] not in customers:
+            result.add_error(line, 'Unknown customer {}'.format(row['customer']))
+            continue
+        if row['end'] is None:
+            if duration <= 0:
+                result.add_error(line, 'Service {} has no duration'.format(row['service']))
+                continue
+            if datetime.timedelta(minutes=duration) > MAX_APPOINTMENT_LENGTH:
+                result.add_error(line, 'Service {} is too long to be booked'.format(row['service']))
+                continue
+            row['end'] = row['start'] + datetime.timedelta(minutes=duration)
+        checked.append((line, row))
+    if not checked:
+        return []
+
+    taken = set()
+    overlapping = set()
+    for group in iter_preload_windows([(line, row) for line, row in checked if row['status'] != 'canceled']):
+        provider_ids = {row['provider'] for _, row in group}
+        range_start = group[0][1]['start']
+        range_end = max(row['end'] for _, row in group)
+        taken.update(SlotReservation.objects.using(using).filter(
+            provider_id__in=provider_ids,
+            slot_start__gte=range_start - reservation_unit(),
+            slot_start__lt=range_end,
+        ).values_list('provider_id', 'slot_start'))
+        occurrences = load_recurring_intervals(list(provider_ids), range_start, range_end, using=using)
+        for line, row in group:
+            if any(start < row['end'] and row['start'] < end for start, end in occurrences.get(row['provider'], [])):
+                overlapping.add(line)
+    valid = []
+    for line, row in checked:
+        units = []
+        if row['status'] != 'canceled':
+            units = reservation_units(row['start'], row['end'])
+            keys = [(row['provider'], unit) for unit in units]
+            if line in overlapping or any(key in taken for key in keys):
+                result.add_error(line, 'Overlaps another appointment of provider {}'.format(row['provider']))
+                continue
+            taken.update(keys)
+        valid.append((line, row, units))
+    return valid
+
+
+def insert_appointments(
+        rows: List[Tuple[int, dict, List[datetime.datetime]]], result: ImportResult, using: Optional[str] = None,
+):
+    ids = RandomId('booking.Appointment').bulk(len(rows))
+    appointments = []
+    reservations = []
+    for appointment_id, (_, row, units) in zip(ids, rows):
+        appointments.append(Appointment(
+            id=appointment_id, provider_id=row['provider'], service_id=row['service'], customer_id=row['customer'],
+            appointment_date=row['start'], end_date=row['end'], status=row['status'], notes=row['notes'],
+        ))
+        reservations.extend(
+            SlotReservation(provider_id=row['provider'], slot_start=unit, appointment_id=appointment_id)
+            for unit in units
+        )
+    Appointment.objects.using(using).bulk_create(appointments)
+    SlotReservation.objects.using(using).bulk_create(reservations, batch_size=DEFAULT_BATCH_SIZE)
+    result.created += len(rows)
+    result.provider_ids.update(row['provider'] for _, row, _ in rows)
+
+
+def import_batch(
+        kind: str, batch: List[Record], allowed_provider_ids: Optional[Set[int]], result: ImportResult,
+        using: Optional[str] = None,
+):
+    parse = parse_availability if kind == KIND_AVAILABILITY else parse_appointment
+    rows = check_providers(parse_batch(batch, parse, result), allowed_provider_ids, result)
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        # errors of a failed attempt are found again by the next one
+        attempt_result = ImportResult()
+        try:
+            with transaction.atomic(using=using):
+                if kind == KIND_AVAILABILITY:
+                    if rows:
+                        insert_availability(rows, attempt_result, using=using)
+                else:
+                    valid = check_appointments(rows, attempt_result, using=using)
+                    if valid:
+                        insert_appointments(valid, attempt_result, using=using)
+                # bulk inserts don't send signals, drop stale bitmaps with the rows so reads compute free time
+                AvailabilityBitmap.objects.using(using).filter(provider_id__in=attempt_result.provider_ids).delete()
+        except IntegrityError:
+            # a concurrent writer took an id or a reservation unit after the batch was checked
+            if attempt == MAX_BATCH_ATTEMPTS - 1:
+                raise
+            continue
+        result.created += attempt_result.created
+        result.provider_ids.update(attempt_result.provider_ids)
+        for error in attempt_result.errors:
+            result.add_error(error['line'], error['error'])
+        return
+
+
+def import_rows(
+        kind: str, stream, file_format: str, allowed_provider_ids: Optional[Set[int]] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE, rebuild_bitmaps: bool = True, using: Optional[str] = None,
+) -> ImportResult:
+    """
+    Import availability or appointments from a binary stream, feeds of imported appointments are bumped at the end.
+    :param allowed_provider_ids: providers rows may refer to, None for all
+    :param rebuild_bitmaps: rebuild bitmaps of the affected providers at the end, otherwise they stay missing until
+    the next ``rebuild_availability_bitmaps`` run
+    """
+    result = ImportResult()
+    for batch in iter_batches(iter_records(stream, file_format), batch_size):
+        import_batch(kind, batch, allowed_provider_ids, result, using=using)
+    result.errors.sort(key=lambda error: error['line'])
+    if result.provider_ids:
+        provider_ids = sorted(result.provider_ids)
+        if rebuild_bitmaps:
+            bitmaps.rebuild(provider_ids=provider_ids)
+        if kind == KIND_APPOINTMENTS:
+            client_ids = Service.objects.filter(
+                appointments__provider_id__in=provider_ids,
+            ).values_list('client_id', flat=True).distinct()
+            feeds.bump_feed_versions(
+                [feeds.provider_feed_key(provider_id) for provider_id in provider_ids] +
+                [feeds.client_feed_key(client_id) for client_id in client_ids],
+                using=using,
+            )
+    return result
+
+
+def export_queryset(kind: str, provider_ids: Optional[Iterable[int]] = None):
+    """Return the rows exported for a kind, as tuples ordered like the export fields."""
+    if kind == KIND_AVAILABILITY:
+        queryset = Availability.objects.order_by('user_id', 'day_of_week', 'start_time')
+        if provider_ids is not None:
+            queryset = queryset.filter(user_id__in=provider_ids)
+        return queryset.values_list('id', 'user_id', 'day_of_week', 'start_time', 'end_time')
+    queryset = Appointment.objects.order_by('provider_id', 'appointment_date', 'id')
+    if provider_ids is not None:
+        queryset = queryset.filter(provider_id__in=provider_ids)
+    return queryset.values_list(
+        'id', 'provider_id', 'service_id', 'customer_id', 'appointment_date', 'end_date', 'status', 'notes',
+        'recurrence', 'recurrence_interval', 'recurrence_until',
+    )
+
+
+def format_value(value):
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        return value.isoformat()
+    return value
+
+
+def iter_export(kind: str, file_format: str, rows: Iterable[Tuple], chunk_size: int = 1000) -> Iterator[str]:
+    """Yield exported rows as CSV or NDJSON text, ``chunk_size`` rows at a time."""
+    fields = AVAILABILITY_FIELDS if kind == KIND_AVAILABILITY else APPOINTMENT_FIELDS
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if file_format == FORMAT_CSV:
+        writer.writerow(fields)
+    count = 0
+    for row in rows:
+        values = [format_value(value) for value in row]
+        if file_format == FORMAT_CSV:
+            writer.writerow(['' if value is None else value for value in values])
+        else:
+            buffer.write(json.dumps(dict(zip(fields, values))))
+            buffer.write('\n')
+        count += 1
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_rows(
+        kind: str, file_format: str, provider_ids: Optional[Iterable[int]] = None, chunk_size: int = 1000,
+) -> Iterator[str]:
+    rows = export_queryset(kind, provider_ids).iterator(chunk_size=chunk_size)
+    return iter_export(kind, file_format, rows, chunk_size=chunk_size)
+
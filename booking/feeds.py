@@ -0,0 +1,306 @@
+"""
+iCalendar feeds of provider and client schedules.
+
+Calendar apps poll feeds often, so every feed has a ``FeedVersion`` change counter bumped after appointments shown
+in it change. The ETag and Last-Modified headers are derived from that single row and most polls are answered with
+304 without reading appointments. Full responses are streamed from a server side cursor, one event at a time.
+Feed URLs carry a signed token since calendar apps can't send authentication headers. Tokens include the
+``token_version`` of the feed, rotating it revokes leaked URLs.
+
+Recurring appointments repeat in the provider's timezone, with a ``VTIMEZONE`` component per zone describing its
+offsets from the first year of a series until ``FEED_TIMEZONE_YEARS`` years ahead.
+"""
+import datetime
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.core import signing
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from booking.models import Appointment, AppointmentException, FeedVersion
+from booking.timezones import default_timezone_name, get_zone, to_local, transition_table
+from core.services.models import Service
+
+FEED_SALT = 'booking.feeds'
+# appointments that ended more than this long ago are left out of feeds
+FEED_PAST_DAYS = 90
+ICS_DATETIME_FORMAT = '%Y%m%dT%H%M%S'
+# years after the current one covered by VTIMEZONE components
+FEED_TIMEZONE_YEARS = 5
+STATUS_MAP = {
+    'pending': 'TENTATIVE',
+    'confirmed': 'CONFIRMED',
+    'completed': 'CONFIRMED',
+}
+RECURRENCE_MAP = {
+    'daily': 'DAILY',
+    'weekly': 'WEEKLY',
+}
+
+
+def provider_feed_key(provider_id: int) -> str:
+    return 'provider:{}'.format(provider_id)
+
+
+def client_feed_key(client_id: int) -> str:
+    return 'client:{}'.format(client_id)
+
+
+def sign_feed_key(key: str, token_version: int = 0) -> str:
+    return signing.dumps([key, token_version], salt=FEED_SALT, compress=True)
+
+
+def is_valid_feed_token(token: Optional[str], key: str, token_version: int = 0) -> bool:
+    if not token:
+        return False
+    try:
+        value = signing.loads(token, salt=FEED_SALT)
+    except signing.BadSignature:
+        return False
+    if isinstance(value, str):
+        # tokens signed before feeds had token versions
+        value = [value, 0]
+    return value == [key, token_version]
+
+
+def get_token_versions(keys: Iterable[str]) -> Dict[str, int]:
+    """Return the token versions of feeds, feeds never rotated have version 0."""
+    keys = list(keys)
+    versions = dict.fromkeys(keys, 0)
+    versions.update(FeedVersion.objects.filter(key__in=keys).values_list('key', 'token_version'))
+    return versions
+
+
+def rotate_feed_tokens(keys: Iterable[str], using: Optional[str] = None):
+    """Revoke the URLs of feeds by incrementing their token versions, creating missing counters."""
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    FeedVersion.objects.using(using).bulk_create([FeedVersion(key=key) for key in keys], ignore_conflicts=True)
+    FeedVersion.objects.using(using).filter(key__in=keys).update(token_version=F('token_version') + 1)
+
+
+def appointment_feed_keys(appointment: Appointment) -> set:
+    """Return the keys of the feeds showing an appointment."""
+    keys = set()
+    if appointment.provider_id:
+        keys.add(provider_feed_key(appointment.provider_id))
+    if appointment.service_id:
+        keys.add(client_feed_key(appointment.service.client_id))
+    return keys
+
+
+def bump_feed_versions(keys: Iterable[str], using: Optional[str] = None):
+    """Increment the change counters of feeds, creating missing ones."""
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    FeedVersion.objects.using(using).bulk_create([FeedVersion(key=key) for key in keys], ignore_conflicts=True)
+    FeedVersion.objects.using(using).filter(key__in=keys).update(version=F('version') + 1, updated_at=timezone.now())
+
+
+def bump_feed_versions_on_commit(keys: Iterable[str], using: Optional[str] = None):
+    """
+    Bump feed counters once the current transaction commits. Bumping after the commit keeps the counter rows out
+    of booking transactions, so concurrent bookings of a provider don't wait on each other.
+    """
+    keys = set(keys)
+    if keys:
+        transaction.on_commit(lambda: bump_feed_versions(keys, using=using), using=using)
+
+
+def get_feed_version(key: str) -> Tuple[int, Optional[datetime.datetime], int]:
+    """
+    Return the version of a feed, when it last changed and its token version. Feeds without changes yet have
+    version 0.
+    """
+    row = FeedVersion.objects.filter(key=key).values_list('version', 'updated_at', 'token_version').first()
+    return row or (0, None, 0)
+
+
+def feed_etag(key: str, version: int, day: datetime.date) -> str:
+    # the feed window moves daily, so the day is part of the content version
+    return '"{}-{}-{}"'.format(key.replace(':', '-'), version, day.strftime('%Y%m%d'))
+
+
+def escape_text(value: str) -> str:
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold_line(line: str) -> str:
+    """Fold a content line to lines of at most 75 octets, as required by RFC 5545."""
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts = []
+    current = ''
+    limit = 75
+    for char in line:
+        if len((current + char).encode()) > limit:
+            parts.append(current)
+            current = ''
+            limit = 74  # continuation lines start with a space
+        current += char
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def format_utc(value: datetime.datetime) -> str:
+    return value.astimezone(datetime.timezone.utc).strftime(ICS_DATETIME_FORMAT) + 'Z'
+
+
+def format_local(value: datetime.datetime, timezone_name: str) -> str:
+    return to_local(value, timezone_name).strftime(ICS_DATETIME_FORMAT)
+
+
+def event_lines(
+        appointment_id: int, start: datetime.datetime, end: datetime.datetime, status: str, summary: str,
+        notes: Optional[str], stamp: datetime.datetime, extra: Iterable[str] = (),
+) -> List[str]:
+    lines = [
+        'BEGIN:VEVENT',
+        'UID:appointment-{}@appity'.format(appointment_id),
+        'DTSTAMP:{}'.format(format_utc(stamp)),
+    ]
+    lines.extend(extra)
+    if not any(line.startswith('DTSTART') for line in extra):
+        lines.append('DTSTART:{}'.format(format_utc(start)))
+        lines.append('DTEND:{}'.format(format_utc(end)))
+    lines.append('SUMMARY:{}'.format(escape_text(summary or '')))
+    if notes:
+        lines.append('DESCRIPTION:{}'.format(escape_text(notes)))
+    lines.append('STATUS:{}'.format(STATUS_MAP.get(status, 'CONFIRMED')))
+    lines.append('END:VEVENT')
+    return lines
+
+
+def format_offset(offset: datetime.timedelta) -> str:
+    seconds = int(offset.total_seconds())
+    sign = '-' if seconds < 0 else '+'
+    hours, rest = divmod(abs(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return '{}{:02d}{:02d}{}'.format(sign, hours, minutes, '{:02d}'.format(seconds) if seconds else '')
+
+
+def observance_lines(
+        zone: datetime.tzinfo, instant: datetime.datetime, offset_from: datetime.timedelta,
+        offset_to: datetime.timedelta,
+) -> List[str]:
+    """One observance of a VTIMEZONE, starting at a naive UTC instant and expressed in the offset before it."""
+    local = instant.replace(tzinfo=datetime.timezone.utc).astimezone(zone)
+    kind = 'DAYLIGHT' if local.dst() else 'STANDARD'
+    lines = [
+        'BEGIN:{}'.format(kind),
+        'DTSTART:{}'.format((instant + offset_from).strftime(ICS_DATETIME_FORMAT)),
+        'TZOFFSETFROM:{}'.format(format_offset(offset_from)),
+        'TZOFFSETTO:{}'.format(format_offset(offset_to)),
+    ]
+    if local.tzname():
+        lines.append('TZNAME:{}'.format(escape_text(local.tzname())))
+    lines.append('END:{}'.format(kind))
+    return lines
+
+
+def vtimezone_lines(timezone_name: str, first_year: int, last_year: int) -> List[str]:
+    """Describe the offsets of a zone between two years (inclusive), from its cached transition tables."""
+    zone = get_zone(timezone_name)
+    first_table = transition_table(timezone_name, first_year)
+    start = datetime.datetime(first_year, 1, 1)
+    lines = ['BEGIN:VTIMEZONE', 'TZID:{}'.format(timezone_name)]
+    lines.extend(observance_lines(zone, start, first_table.offsets[0], first_table.offsets[0]))
+    for year in range(first_year, last_year + 1):
+        table = transition_table(timezone_name, year)
+        for index, instant in enumerate(table.utc_transitions):
+            lines.extend(observance_lines(zone, instant, table.offsets[index], table.offsets[index + 1]))
+    lines.append('END:VTIMEZONE')
+    return lines
+
+
+def series_lines(row: Tuple, exceptions: List[Tuple], stamp: datetime.datetime) -> List[str]:
+    """Events of a recurring appointment: the rule, skipped dates and one overriding event per moved occurrence."""
+    appointment_id, start, end, status, summary, notes, rule, interval, until, timezone_name = row
+    timezone_name = timezone_name or default_timezone_name()
+    recurrence = 'RRULE:FREQ={};INTERVAL={}'.format(RECURRENCE_MAP.get(rule, 'WEEKLY'), interval or 1)
+    if until:
+        recurrence += ';UNTIL={}'.format(format_utc(until))
+    extra = [
+        'DTSTART;TZID={}:{}'.format(timezone_name, format_local(start, timezone_name)),
+        'DTEND;TZID={}:{}'.format(timezone_name, format_local(end, timezone_name)),
+        recurrence,
+    ]
+    # same value type as DTSTART
+    extra.extend(
+        'EXDATE;TZID={}:{}'.format(timezone_name, format_local(original_start, timezone_name))
+        for original_start, _, _ in exceptions
+    )
+    lines = event_lines(appointment_id, start, end, status, summary, notes, stamp, extra)
+    for original_start, new_start, new_end in exceptions:
+        if new_start and new_end:
+            lines.extend(event_lines(
+                appointment_id, new_start, new_end, status, summary, notes, stamp,
+                ['RECURRENCE-ID;TZID={}:{}'.format(timezone_name, format_local(original_start, timezone_name))],
+            ))
+    return lines
+
+
+def feed_appointments(key: str):
+    """Return the appointments shown in a feed."""
+    kind, object_id = key.split(':')
+    if kind == 'provider':
+        return Appointment.objects.filter(provider_id=int(object_id))
+    return Appointment.objects.filter(service_id__in=Service.objects.filter(client_id=int(object_id)).values('id'))
+
+
+def iter_feed(key: str, name: str, stamp: datetime.datetime, chunk_size: int = 500) -> Iterator[str]:
+    """
+    Yield an iCalendar document a few events at a time. Recurring appointments and their exceptions are few and
+    loaded first, for the timezones they use; single appointments are read through a server side cursor.
+    """
+    since = timezone.now() - datetime.timedelta(days=FEED_PAST_DAYS)
+    since = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    appointments = feed_appointments(key).exclude(status='canceled')
+    fields = ('id', 'appointment_date', 'end_date', 'status', 'service__name', 'notes')
+    series = list(appointments.exclude(recurrence='').filter(
+        Q(recurrence_until__isnull=True) | Q(recurrence_until__gte=since),
+    ).order_by('appointment_date', 'id').values_list(
+        *fields, 'recurrence', 'recurrence_interval', 'recurrence_until', 'provider__timezone',
+    ))
+    exceptions = defaultdict(list)
+    first_years = {}
+    if series:
+        rows = AppointmentException.objects.filter(
+            appointment_id__in=[row[0] for row in series],
+        ).order_by('original_start').values_list('appointment_id', 'original_start', 'new_start', 'new_end')
+        for appointment_id, original_start, new_start, new_end in rows:
+            exceptions[appointment_id].append((original_start, new_start, new_end))
+        for row in series:
+            timezone_name = row[-1] or default_timezone_name()
+            year = to_local(row[1], timezone_name).year
+            first_years[timezone_name] = min(year, first_years.get(timezone_name, year))
+    header = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Appity//Scheduling//EN',
+        'CALSCALE:GREGORIAN',
+        'X-WR-CALNAME:{}'.format(escape_text(name)),
+    ]
+    last_year = stamp.year + FEED_TIMEZONE_YEARS
+    for timezone_name, first_year in sorted(first_years.items()):
+        header.extend(vtimezone_lines(timezone_name, first_year, max(first_year, last_year)))
+    yield ''.join(fold_line(line) for line in header)
+    singles = appointments.filter(recurrence='', appointment_date__gte=since).order_by('appointment_date', 'id')
+    buffer = []
+    for appointment_id, start, end, status, summary, notes in singles.values_list(*fields).iterator(
+            chunk_size=chunk_size,
+    ):
+        buffer.extend(event_lines(appointment_id, start, end or start, status, summary, notes, stamp))
+        if len(buffer) >= chunk_size:
+            yield ''.join(fold_line(line) for line in buffer)
+            buffer = []
+    for row in series:
+        start, end = row[1], row[2] or row[1]
+        buffer.extend(series_lines((row[0], start, end) + row[3:], exceptions[row[0]], stamp))
+    buffer.append('END:VCALENDAR')
+    yield ''.join(fold_line(line) for line in buffer)
@@ -0,0 +1,134 @@
+import datetime
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from booking.models import Appointment, Availability
+from booking.reservations import SlotUnavailable, book_appointment, fits_free_time
+from core.benchmark import summarize_latencies
+from core.models.models import Client
+from core.services.models import Service
+
+
+class Command(BaseCommand):
+    help = (
+        'Book appointments against a single provider from many threads and report throughput, latency and '
+        'whether any overlapping appointments were created. Runs on every configured database unless '
+        '--database is given. Creates its own provider, client and service and removes them afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Number of concurrent booking threads')
+        parser.add_argument('--attempts', type=int, default=50, help='Booking attempts per thread')
+        parser.add_argument('--slots', type=int, default=64, help='Number of distinct slots competed for')
+        parser.add_argument('--duration', type=int, default=30, help='Service duration in minutes')
+        parser.add_argument('--database', action='append', dest='databases', help='Database alias to benchmark')
+        parser.add_argument('--keep', action='store_true', help='Keep the created objects')
+
+    def handle(self, *args, **options):
+        for alias in options['databases'] or list(settings.DATABASES):
+            self.stdout.write('Benchmarking booking on database "{}" ({})'.format(
+                alias, connections[alias].vendor,
+            ))
+            self.benchmark(alias=alias, **options)
+
+    def benchmark(self, alias, threads, attempts, slots, duration, keep, **options):
+        provider, client, service = self.setup_provider(alias=alias, duration=duration)
+        first_slot = datetime.datetime.combine(
+            timezone.localdate() + datetime.timedelta(days=1), datetime.time(0), tzinfo=datetime.timezone.utc,
+        )
+        candidates = [first_slot + datetime.timedelta(minutes=duration * index) for index in range(slots)]
+        outcomes = Counter()
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            local_outcomes = Counter()
+            local_latencies = []
+            try:
+                for _ in range(attempts):
+                    start = random.choice(candidates)  # nosec B311
+                    end = start + datetime.timedelta(minutes=duration)
+                    started_at = time.perf_counter()
+                    try:
+                        if not fits_free_time(provider, start, end, using=alias):
+                            raise SlotUnavailable()
+                        book_appointment(provider=provider, service=service, start=start, using=alias)
+                        local_outcomes['booked'] += 1
+                    except SlotUnavailable:
+                        local_outcomes['conflicts'] += 1
+                    except Exception as e:  # noqa
+                        local_outcomes['errors'] += 1
+                        local_outcomes['error: {}'.format(e)] += 1
+                    local_latencies.append(time.perf_counter() - started_at)
+            finally:
+                connections[alias].close()
+            with lock:
+                outcomes.update(local_outcomes)
+                latencies.extend(local_latencies)
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        started_at = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started_at
+
+        overlaps = self.count_overlaps(provider=provider, alias=alias)
+        summary = summarize_latencies(latencies)
+        self.stdout.write(
+            '  threads={} attempts={} booked={} conflicts={} errors={} overlaps={}'.format(
+                threads, threads * attempts, outcomes['booked'], outcomes['conflicts'], outcomes['errors'], overlaps,
+            )
+        )
+        self.stdout.write('  elapsed={:.3f}s attempts/s={:.1f} bookings/s={:.1f}'.format(
+            elapsed, threads * attempts / elapsed, outcomes['booked'] / elapsed,
+        ))
+        self.stdout.write('  latency mean={mean_ms}ms p50={p50_ms}ms p95={p95_ms}ms p99={p99_ms}ms max={max_ms}ms'.format(
+            **summary
+        ))
+        for outcome, count in sorted(outcomes.items()):
+            if outcome.startswith('error: '):
+                self.stdout.write('  {} x {}'.format(count, outcome))
+        if overlaps:
+            self.stderr.write(self.style.ERROR('  Overlapping appointments were created'))
+        if not keep:
+            provider.delete()
+            client.delete()
+
+    @staticmethod
+    def setup_provider(alias, duration):
+        provider = get_user_model().objects.db_manager(alias).create(
+            email='benchmark-{}@example.com'.format(uuid.uuid4().hex), is_active=False,
+        )
+        client = Client.objects.using(alias).create(
+            company='Booking benchmark', address1='-', city='-', country='US', zip_code='-', phone='-',
+        )
+        service = Service.objects.using(alias).create(name='Booking benchmark', duration=duration, client=client)
+        Availability.objects.using(alias).bulk_create([
+            Availability(user=provider, day_of_week=day, start_time=datetime.time(0), end_time=datetime.time(23, 59))
+            for day in Availability.DayOfWeek.values
+        ])
+        return provider, client, service
+
+    @staticmethod
+    def count_overlaps(provider, alias) -> int:
+        rows = Appointment.objects.using(alias).filter(provider=provider).exclude(status='canceled').order_by(
+            'appointment_date',
+        ).values_list('appointment_date', 'service__duration')
+        overlaps = 0
+        previous_end = None
+        for start, duration in rows:
+            if previous_end and start < previous_end:
+                overlaps += 1
+            previous_end = max(previous_end or start, start + datetime.timedelta(minutes=duration))
+        return overlaps
@@ -0,0 +1,25 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from booking import bulk
+
+
+class Command(BaseCommand):
+    help = 'Export availability or appointments as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=bulk.KINDS)
+        parser.add_argument('--format', choices=bulk.FORMATS, default=bulk.FORMAT_CSV)
+        parser.add_argument('--provider', type=int, action='append', dest='providers', help='Only this provider id')
+        parser.add_argument('-o', '--output', default='-', help='Output file, standard output by default')
+
+    def handle(self, *args, **options):
+        chunks = bulk.export_rows(options['kind'], options['format'], options['providers'])
+        if options['output'] == '-':
+            for chunk in chunks:
+                sys.stdout.write(chunk)
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            for chunk in chunks:
+                output.write(chunk)
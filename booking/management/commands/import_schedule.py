@@ -0,0 +1,38 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking import bulk
+
+
+class Command(BaseCommand):
+    help = 'Import availability or appointments from a CSV (with a header row) or NDJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=bulk.KINDS)
+        parser.add_argument('path', help='File to import, - for standard input')
+        parser.add_argument('--format', choices=bulk.FORMATS, default=None, help='Guessed from the file extension')
+        parser.add_argument('--batch-size', type=int, default=bulk.DEFAULT_BATCH_SIZE, help='Rows inserted per batch')
+        parser.add_argument(
+            '--skip-bitmaps', action='store_true', help='Leave bitmaps to the next rebuild_availability_bitmaps run',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or (bulk.FORMAT_NDJSON if path.endswith('.ndjson') else bulk.FORMAT_CSV)
+        import_options = {'batch_size': options['batch_size'], 'rebuild_bitmaps': not options['skip_bitmaps']}
+        started_at = time.monotonic()
+        if path == '-':
+            result = bulk.import_rows(options['kind'], sys.stdin.buffer, file_format, **import_options)
+        else:
+            with open(path, 'rb') as stream:
+                result = bulk.import_rows(options['kind'], stream, file_format, **import_options)
+        elapsed = time.monotonic() - started_at
+        for error in result.errors:
+            self.stderr.write('Line {}: {}'.format(error['line'], error['error']))
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {} row(s) with {} error(s) in {:.2f}s ({:.0f} rows/s)'.format(
+                result.created, result.error_count, elapsed, result.created / elapsed if elapsed else 0,
+            )
+        ))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking import bitmaps
+
+
+class Command(BaseCommand):
+    help = 'Recompute materialized availability bitmaps, used for backfills and to extend the materialized range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--provider', type=int, action='append', dest='providers', help='Only this provider id')
+        parser.add_argument('--batch-size', type=int, default=100, help='Providers recomputed per batch')
+
+    def handle(self, *args, **options):
+        started_at = time.monotonic()
+        count = bitmaps.rebuild(provider_ids=options['providers'], batch_size=options['batch_size'])
+        first_day, last_day = bitmaps.materialized_range()
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt availability bitmaps of {} provider(s) from {} to {} in {:.2f}s'.format(
+                count, first_day, last_day, time.monotonic() - started_at,
+            )
+        ))
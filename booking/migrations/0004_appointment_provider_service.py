@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_remove_service_appointment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('booking', '0003_alter_availability_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='provider',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='appointments', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='service',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='appointments', to='core.service'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:04
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def reserve_existing_appointments(apps, schema_editor):
+    appointment_model = apps.get_model('booking', 'Appointment')
+    reservation_model = apps.get_model('booking', 'SlotReservation')
+    unit = datetime.timedelta(minutes=getattr(settings, 'APPITY_RESERVATION_UNIT_MINUTES', 5))
+    epoch = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    appointments = appointment_model.objects.filter(
+        provider__isnull=False, service__isnull=False,
+    ).exclude(status='canceled').values_list('id', 'provider_id', 'appointment_date', 'service__duration')
+    reservations = []
+    for appointment_id, provider_id, start, duration in appointments.iterator():
+        slot_start = epoch + (start - epoch) // unit * unit
+        end = start + datetime.timedelta(minutes=duration)
+        while slot_start < end:
+            reservations.append(reservation_model(
+                provider_id=provider_id, slot_start=slot_start, appointment_id=appointment_id,
+            ))
+            slot_start += unit
+    # existing overlapping appointments keep their first reservation only
+    reservation_model.objects.bulk_create(reservations, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('booking', '0005_availabilitybitmap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='customer',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='booked_appointments', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='SlotReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot_start', models.DateTimeField()),
+                ('appointment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='booking.appointment')),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slot_reservations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('provider', 'slot_start')},
+            },
+        ),
+        migrations.RunPython(reserve_existing_appointments, migrations.RunPython.noop),
+    ]
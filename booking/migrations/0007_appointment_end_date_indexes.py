@@ -0,0 +1,41 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:08
+
+import datetime
+
+from django.db import migrations, models
+
+
+def fill_end_dates(apps, schema_editor):
+    appointment_model = apps.get_model('booking', 'Appointment')
+    appointments = appointment_model.objects.filter(
+        end_date__isnull=True, service__isnull=False,
+    ).values_list('id', 'appointment_date', 'service__duration')
+    updated = [
+        appointment_model(id=appointment_id, end_date=start + datetime.timedelta(minutes=duration or 0))
+        for appointment_id, start, duration in appointments.iterator()
+    ]
+    appointment_model.objects.bulk_update(updated, ['end_date'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0006_slotreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='end_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_end_dates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['provider', 'appointment_date', 'id'], name='booking_appt_provider_start'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['service', 'appointment_date', 'id'], name='booking_appt_service_start'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0007_appointment_end_date_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_start', models.DateTimeField()),
+                ('new_start', models.DateTimeField(blank=True, null=True)),
+                ('new_end', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='recurrence',
+            field=models.CharField(blank=True, choices=[('', 'None'), ('daily', 'Daily'), ('weekly', 'Weekly')], default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='recurrence_interval',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='recurrence_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(condition=models.Q(('recurrence', ''), _negated=True), fields=['provider', 'appointment_date'], name='booking_appt_recurring'),
+        ),
+        migrations.AddField(
+            model_name='appointmentexception',
+            name='appointment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='booking.appointment'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='appointmentexception',
+            unique_together={('appointment', 'original_start')},
+        ),
+    ]
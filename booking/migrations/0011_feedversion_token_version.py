@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0010_feedversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feedversion',
+            name='token_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,31 +1,162 @@
+import datetime
+from typing import Optional
+
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
-from core.utils import RandomId
+from core.utils import LoadedValues, RandomId
+
 
-class Appointment(models.Model):
+class Appointment(LoadedValues, models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
         ('confirmed', 'Confirmed'),
         ('completed', 'Completed'),
         ('canceled', 'Canceled'),
     )
+    RECURRENCE_CHOICES = (
+        ('', 'None'),
+        ('daily', 'Daily'),
+        ('weekly', 'Weekly'),
+    )
     id = models.BigIntegerField(unique=True, default=RandomId('booking.Appointment'), primary_key=True)
+    # appointment_date is the start of the appointment, end_date is exclusive
     appointment_date = models.DateTimeField()
+    end_date = models.DateTimeField(null=True, blank=True)
+    provider = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='appointments', on_delete=models.CASCADE, null=True, blank=True,
+    )
+    service = models.ForeignKey(
+        'core.Service', related_name='appointments', on_delete=models.CASCADE, null=True, blank=True,
+    )
+    customer = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='booked_appointments', on_delete=models.SET_NULL, null=True, blank=True,
+    )
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     notes = models.TextField(blank=True, null=True)
+    # a recurring appointment is stored once, occurrences are expanded by booking.recurrence
+    recurrence = models.CharField(max_length=10, choices=RECURRENCE_CHOICES, blank=True, default='')
+    recurrence_interval = models.PositiveSmallIntegerField(default=1)
+    recurrence_until = models.DateTimeField(null=True, blank=True)
 
+    loaded_fields = (
+        'provider_id', 'service_id', 'appointment_date', 'end_date', 'status', 'recurrence', 'recurrence_until',
+    )
 
     class Meta:
         app_label = 'booking'
         verbose_name = 'appointment'
         verbose_name_plural = 'appointments'
+        indexes = [
+            models.Index(fields=['provider', 'appointment_date', 'id'], name='booking_appt_provider_start'),
+            models.Index(fields=['service', 'appointment_date', 'id'], name='booking_appt_service_start'),
+            models.Index(
+                fields=['provider', 'appointment_date'], condition=~Q(recurrence=''), name='booking_appt_recurring',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.service.name} - {self.appointment_date}"
 
+    def save(self, *args, **kwargs):
+        if self.end_date is None and self.service_id and self.appointment_date:
+            self.end_date = self.appointment_date + datetime.timedelta(minutes=self.service.duration)
+        return super().save(*args, **kwargs)
+
+    @property
+    def is_recurring(self) -> bool:
+        return bool(self.recurrence)
+
+
+class AppointmentException(models.Model):
+    """A skipped (no new start) or moved occurrence of a recurring appointment."""
+    appointment = models.ForeignKey(Appointment, related_name='exceptions', on_delete=models.CASCADE)
+    original_start = models.DateTimeField()
+    new_start = models.DateTimeField(null=True, blank=True)
+    new_end = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = 'booking'
+        unique_together = ('appointment', 'original_start')
+
+    def __str__(self):
+        return f"{self.appointment_id}: {self.original_start}"
+
+
+class WaitlistEntry(models.Model):
+    """
+    Interest of a customer in a service of a provider within a time window.
+    Time freed by canceled appointments is offered to waiting entries by ``booking.waitlist``, higher priority first
+    and then in the order the entries were created.
+    """
+    STATUS_CHOICES = (
+        ('waiting', 'Waiting'),
+        ('offered', 'Offered'),
+        ('canceled', 'Canceled'),
+    )
+    id = models.BigIntegerField(unique=True, default=RandomId('booking.WaitlistEntry'), primary_key=True)
+    customer = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='waitlist_entries', on_delete=models.CASCADE)
+    provider = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='provider_waitlist_entries', on_delete=models.CASCADE,
+    )
+    service = models.ForeignKey('core.Service', related_name='waitlist_entries', on_delete=models.CASCADE)
+    window_start = models.DateTimeField()
+    window_end = models.DateTimeField()
+    priority = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='waiting')
+    # appointment booked when time was offered to the entry
+    appointment = models.ForeignKey(
+        Appointment, related_name='waitlist_entries', on_delete=models.SET_NULL, null=True, blank=True,
+    )
+
+    class Meta:
+        app_label = 'booking'
+        verbose_name_plural = 'waitlist entries'
+        indexes = [
+            models.Index(fields=['provider', 'status', 'window_start'], name='booking_waitlist_provider'),
+        ]
+
+    def __str__(self):
+        return f"{self.customer_id}: {self.window_start} - {self.window_end}"
+
+
+class FeedVersion(models.Model):
+    """
+    Change counter of a calendar feed (``provider:<id>`` or ``client:<id>``), bumped whenever appointments shown
+    in the feed change. Feed ETags and Last-Modified headers come from this row only. Feed URL tokens are signed
+    with ``token_version``, incrementing it revokes every URL handed out before.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    token_version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        app_label = 'booking'
 
+    def __str__(self):
+        return f"{self.key}: {self.version}"
+
+
+class SlotReservation(models.Model):
+    """
+    Claims one reservation unit (``APPITY_RESERVATION_UNIT_MINUTES`` long) of a provider's time for an appointment.
+    The unique constraint guarantees that two appointments of a provider never share a unit.
+    """
+    provider = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='slot_reservations', on_delete=models.CASCADE)
+    slot_start = models.DateTimeField()
+    appointment = models.ForeignKey(Appointment, related_name='reservations', on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'booking'
+        unique_together = ('provider', 'slot_start')
 
-class Availability(models.Model):
+    def __str__(self):
+        return f"{self.provider_id}: {self.slot_start}"
+
+
+class Availability(LoadedValues, models.Model):
     class DayOfWeek(models.IntegerChoices):
         SUNDAY = 1
         MONDAY = 2
@@ -41,9 +172,31 @@ class Availability(models.Model):
     end_time = models.TimeField()
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='availability', on_delete=models.CASCADE)
 
+    loaded_fields = ('user_id', 'day_of_week')
+
     class Meta:
         app_label = 'booking'
         verbose_name_plural = 'availabilities'
 
     def __str__(self):
         return f"{self.day_of_week}: {self.start_time} - {self.end_time}"
+
+
+class AvailabilityBitmap(models.Model):
+    """
+    Materialized free time of a provider for one day, derived from ``Availability`` and ``Appointment`` rows.
+    Bit ``n`` of ``bits`` (little endian) is set when minute ``n`` after midnight (UTC) is free.
+    """
+    provider = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='availability_bitmaps', on_delete=models.CASCADE,
+    )
+    date = models.DateField()
+    bits = models.BinaryField(max_length=180)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'booking'
+        unique_together = ('provider', 'date')
+
+    def __str__(self):
+        return f"{self.provider_id}: {self.date}"
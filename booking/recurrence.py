@@ -0,0 +1,84 @@
+"""
+Recurring appointments.
+
+A recurring appointment is stored once, as its first occurrence plus a rule (``daily`` or ``weekly``, every
+``recurrence_interval`` days or weeks, optionally until ``recurrence_until``). Occurrences are generated lazily and
+only for the window being looked at. Occurrences that were skipped or moved are stored sparsely as
+``AppointmentException`` rows keyed by the start they originally had.
+"""
+import datetime
+from heapq import merge
+from typing import Dict, Iterator, Optional, Tuple
+
+from booking.timezones import LocalClock, to_local
+
+RECURRENCE_DAILY = 'daily'
+RECURRENCE_WEEKLY = 'weekly'
+
+Occurrence = Tuple[datetime.datetime, datetime.datetime]
+# original occurrence start (UTC) => moved occurrence or None when skipped
+Exceptions = Dict[datetime.datetime, Optional[Occurrence]]
+
+
+def recurrence_step(rule: str, interval: int) -> datetime.timedelta:
+    """Return the time between two occurrences of a rule, in local (wall clock) time."""
+    days = 7 if rule == RECURRENCE_WEEKLY else 1
+    return datetime.timedelta(days=days * max(interval or 1, 1))
+
+
+def series_end(
+        start: datetime.datetime, end: datetime.datetime, until: Optional[datetime.datetime],
+) -> Optional[datetime.datetime]:
+    """Return a bound for the end of the last occurrence of a series, None when it repeats forever."""
+    if until is None:
+        return None
+    return max(until, start) + (end - start)
+
+
+def iter_occurrences(
+        start: datetime.datetime, end: datetime.datetime, rule: str, interval: int,
+        until: Optional[datetime.datetime], window_start: datetime.datetime, window_end: datetime.datetime,
+        exceptions: Optional[Exceptions] = None, timezone_name: str = '',
+) -> Iterator[Occurrence]:
+    """
+    Yield occurrences of a series overlapping the ``[window_start, window_end)`` range, sorted by start.
+    Occurrences keep their local time of day across DST changes.
+    :param start: start of the first occurrence
+    :param end: end of the first occurrence
+    :param until: occurrences starting after this are not generated
+    :param exceptions: skipped and moved occurrences of the series
+    :param timezone_name: timezone of the provider, the default timezone when empty
+    """
+    exceptions = exceptions or {}
+    moved = sorted(
+        occurrence for occurrence in exceptions.values()
+        if occurrence is not None and occurrence[0] < window_end and occurrence[1] > window_start
+    )
+    return merge(
+        iter_regular_occurrences(
+            start, end, rule, interval, until, window_start, window_end, exceptions, timezone_name,
+        ),
+        moved,
+    )
+
+
+def iter_regular_occurrences(
+        start: datetime.datetime, end: datetime.datetime, rule: str, interval: int,
+        until: Optional[datetime.datetime], window_start: datetime.datetime, window_end: datetime.datetime,
+        exceptions: Exceptions, timezone_name: str,
+) -> Iterator[Occurrence]:
+    clock = LocalClock(timezone_name)
+    step = recurrence_step(rule, interval)
+    duration = end - start
+    local_start = to_local(start, timezone_name)
+    # jump close to the window, one step earlier to absorb UTC offset changes
+    index = max(0, (window_start - end) // step - 1)
+    while True:
+        occurrence_start = clock.to_utc(local_start + index * step)
+        index += 1
+        if occurrence_start >= window_end or (until is not None and occurrence_start > until):
+            return
+        occurrence_end = occurrence_start + duration
+        if occurrence_end <= window_start or occurrence_start in exceptions:
+            continue
+        yield occurrence_start, occurrence_end
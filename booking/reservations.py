@@ -0,0 +1,226 @@
+"""
+Overlap free appointment booking.
+
+Every appointment claims the reservation units covering its time range as ``SlotReservation`` rows. The unique
+``(provider, slot_start)`` constraint makes the database reject a booking overlapping another appointment of the
+same provider, so concurrent bookings only contend on the rows of the units they want instead of on a table or
+provider wide lock. A rejected booking is retried only when the units were held by canceled appointments.
+Appointments start on the unit grid, otherwise a unit partly used by the end of one appointment and partly by the
+start of the next one would make back to back bookings collide.
+"""
+import datetime
+import random
+import time
+from typing import Iterable, List, Optional
+
+from django.db import IntegrityError, OperationalError, transaction
+
+from booking.models import Appointment, AppointmentException, SlotReservation
+from booking.recurrence import iter_occurrences, series_end
+from booking.slots import (
+    MAX_APPOINTMENT_LENGTH, RESERVATION_EPOCH, get_computed_free_intervals, get_free_intervals_between,
+    iter_availability_between, load_busy_intervals, load_recurring_intervals, load_weekly_windows, reservation_unit,
+)
+
+MAX_BOOKING_ATTEMPTS = 5
+# occurrences of a new recurring appointment are checked against other appointments this far ahead
+RECURRENCE_CONFLICT_CHECK = datetime.timedelta(days=366)
+
+
+class SlotUnavailable(Exception):
+    """Raised when the requested time overlaps another appointment of the provider."""
+
+
+def reservation_units(start: datetime.datetime, end: datetime.datetime) -> List[datetime.datetime]:
+    """Return the starts of all reservation units overlapping the ``[start, end)`` range."""
+    unit = reservation_unit()
+    slot_start = RESERVATION_EPOCH + (start - RESERVATION_EPOCH) // unit * unit
+    units = []
+    while slot_start < end:
+        units.append(slot_start)
+        slot_start += unit
+    return units
+
+
+def fits_free_time(provider, start: datetime.datetime, end: datetime.datetime, using: Optional[str] = None) -> bool:
+    """Check that a time range lies within the provider's availability and doesn't overlap known appointments."""
+    free = get_free_intervals_between(provider.id, start, end, using=using)
+    return any(free_start <= start and end <= free_end for free_start, free_end in free)
+
+
+def release_reservations(appointment_id: int, using: Optional[str] = None):
+    """Free the time held by an appointment, used when it gets canceled."""
+    SlotReservation.objects.using(using).filter(appointment_id=appointment_id).delete()
+
+
+def release_stale_reservations(provider_id: int, units: List[datetime.datetime], using: Optional[str] = None) -> bool:
+    """
+    Delete reservations of the given units that belong to canceled appointments.
+    :return: True when none of the units is held by an active appointment anymore
+    """
+    reservations = SlotReservation.objects.using(using).filter(provider_id=provider_id, slot_start__in=units)
+    reservations.filter(appointment__status='canceled').delete()
+    return not reservations.exists()
+
+
+def overlaps_busy_time(occurrences: Iterable, busy: List) -> bool:
+    """Check sorted occurrences against sorted, merged busy intervals in one linear pass."""
+    busy_index = 0
+    for start, end in occurrences:
+        while busy_index < len(busy) and busy[busy_index][1] <= start:
+            busy_index += 1
+        if busy_index < len(busy) and busy[busy_index][0] < end:
+            return True
+    return False
+
+
+def fits_intervals(occurrences: Iterable, intervals: List) -> bool:
+    """Check that every sorted occurrence lies within one of sorted, merged intervals, in one linear pass."""
+    index = 0
+    for start, end in occurrences:
+        while index < len(intervals) and intervals[index][1] <= start:
+            index += 1
+        if index == len(intervals) or not (intervals[index][0] <= start and end <= intervals[index][1]):
+            return False
+    return True
+
+
+def recurrence_conflicts(
+        provider_id: int, start: datetime.datetime, end: datetime.datetime, recurrence: str, interval: int,
+        until: Optional[datetime.datetime], timezone_name: str = '', exclude_id: Optional[int] = None,
+        using: Optional[str] = None,
+) -> bool:
+    """
+    Check whether occurrences of a new recurring appointment within a year overlap time already taken or fall
+    outside the provider's weekly availability.
+    :param exclude_id: the new appointment, when it is already stored
+    """
+    check_end = start + RECURRENCE_CONFLICT_CHECK
+    last_end = series_end(start, end, until)
+    if last_end is not None:
+        check_end = min(check_end, last_end)
+    occurrences = list(iter_occurrences(
+        start, end, recurrence, interval, until, start, check_end, timezone_name=timezone_name,
+    ))
+    if not occurrences:
+        return False
+    # the last occurrence may end after the checked range
+    busy_end = occurrences[-1][1]
+    busy = load_busy_intervals([provider_id], start, busy_end, using=using, exclude_id=exclude_id).get(provider_id, [])
+    if overlaps_busy_time(occurrences, busy):
+        return True
+    weekly_windows = load_weekly_windows([provider_id], using=using).get(provider_id)
+    available = list(iter_availability_between(weekly_windows, start, busy_end)) if weekly_windows else []
+    return not fits_intervals(occurrences, available)
+
+
+def book_appointment(
+        provider, service, start: datetime.datetime, customer=None, notes: Optional[str] = None,
+        status: str = 'pending', recurrence: str = '', recurrence_interval: int = 1,
+        recurrence_until: Optional[datetime.datetime] = None, using: Optional[str] = None,
+) -> Appointment:
+    """
+    Create an appointment unless it overlaps another appointment of the provider.
+    Only the first occurrence of a recurring appointment holds reservation units. Later occurrences within
+    ``RECURRENCE_CONFLICT_CHECK`` are checked against other appointments and the provider's availability, and
+    single appointments against occurrences of recurring ones, after the insert and in the same transaction. With
+    SQLite, which serializes writers, a concurrent booking then either committed before the check and is seen by it,
+    or waits for the write lock and sees the new appointment in its own check; databases with concurrent writers
+    need serializable transactions for the same guarantee on occurrences.
+    :raises SlotUnavailable: when the time is already taken
+    :raises ValueError: when the service is longer than ``MAX_APPOINTMENT_LENGTH``
+    """
+    end = start + datetime.timedelta(minutes=service.duration)
+    if end - start > MAX_APPOINTMENT_LENGTH:
+        # busy time lookups would not see it
+        raise ValueError('appointments cannot be longer than {}'.format(MAX_APPOINTMENT_LENGTH))
+    units = reservation_units(start, end)
+    for attempt in range(MAX_BOOKING_ATTEMPTS):
+        # built outside of the transaction: the primary key default queries the table, and on SQLite a read
+        # before the first write of a transaction makes it fail instead of waiting when another writer is active
+        appointment = Appointment(
+            provider=provider,
+            service=service,
+            customer=customer,
+            appointment_date=start,
+            end_date=end,
+            status=status,
+            notes=notes,
+            recurrence=recurrence,
+            recurrence_interval=recurrence_interval,
+            recurrence_until=recurrence_until if recurrence else None,
+        )
+        try:
+            with transaction.atomic(using=using):
+                appointment.save(force_insert=True, using=using)
+                SlotReservation.objects.using(using).bulk_create([
+                    SlotReservation(provider=provider, slot_start=slot_start, appointment=appointment)
+                    for slot_start in units
+                ])
+                # occurrences of recurring appointments hold no reservation units
+                if recurrence:
+                    if recurrence_conflicts(
+                            provider.id, start, end, recurrence, recurrence_interval, recurrence_until,
+                            timezone_name=provider.timezone, exclude_id=appointment.pk, using=using,
+                    ):
+                        raise SlotUnavailable()
+                elif load_recurring_intervals([provider.id], start, end, using=using).get(provider.id):
+                    raise SlotUnavailable()
+            return appointment
+        except IntegrityError:
+            # either another appointment holds some of the units, or they are held by canceled appointments
+            # whose reservations were not released (e.g. canceled through a queryset update)
+            if not release_stale_reservations(provider.id, units, using=using):
+                raise SlotUnavailable()
+        except OperationalError:
+            # SQLite raises "database is locked" when another writer holds the lock longer than its timeout
+            if attempt == MAX_BOOKING_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0, 0.005 * 2 ** attempt))  # nosec B311
+    raise SlotUnavailable()
+
+
+def is_occurrence(appointment: Appointment, original_start: datetime.datetime) -> bool:
+    """Check that a recurring appointment has a regular occurrence starting at the given time."""
+    occurrences = iter_occurrences(
+        appointment.appointment_date, appointment.end_date, appointment.recurrence, appointment.recurrence_interval,
+        appointment.recurrence_until, original_start, original_start + datetime.timedelta(microseconds=1),
+        timezone_name=appointment.provider.timezone if appointment.provider_id else '',
+    )
+    return any(occurrence_start == original_start for occurrence_start, _ in occurrences)
+
+
+def skip_occurrence(
+        appointment: Appointment, original_start: datetime.datetime, using: Optional[str] = None,
+) -> AppointmentException:
+    """Skip one occurrence of a recurring appointment."""
+    exception, _ = AppointmentException.objects.using(using).update_or_create(
+        appointment=appointment, original_start=original_start, defaults={'new_start': None, 'new_end': None},
+    )
+    return exception
+
+
+def move_occurrence(
+        appointment: Appointment, original_start: datetime.datetime, new_start: datetime.datetime,
+        using: Optional[str] = None,
+) -> AppointmentException:
+    """
+    Move one occurrence of a recurring appointment to another time.
+    :raises SlotUnavailable: when the new time is not free
+    """
+    new_end = new_start + (appointment.end_date - appointment.appointment_date)
+    provider_id = appointment.provider_id
+    with transaction.atomic(using=using):
+        exception, _ = AppointmentException.objects.using(using).update_or_create(
+            appointment=appointment, original_start=original_start, defaults={'new_start': None, 'new_end': None},
+        )
+        # the occurrence is skipped at this point so it doesn't conflict with itself; free time is computed
+        # instead of read from bitmaps, which only reflect the skip after commit
+        free = get_computed_free_intervals(
+            [provider_id], load_weekly_windows([provider_id], using=using), new_start, new_end, using=using,
+        ).get(provider_id, [])
+        if not any(free_start <= new_start and new_end <= free_end for free_start, free_end in free):
+            raise SlotUnavailable()
+        exception.new_start, exception.new_end = new_start, new_end
+        exception.save(update_fields=['new_start', 'new_end'])
+    return exception
@@ -0,0 +1,65 @@
+"""
+Appointment range queries.
+
+Appointments of a provider or a service are listed by start time through the ``(provider, appointment_date, id)``
+and ``(service, appointment_date, id)`` indexes. Pages continue after the ``(appointment_date, id)`` of the last row
+returned instead of using an offset, so every page is a bounded range scan of the index whatever its position.
+"""
+import base64
+import binascii
+import datetime
+from typing import List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+
+from booking.models import Appointment
+
+DEFAULT_APPOINTMENTS_PAGE = 100
+MAX_APPOINTMENTS_PAGE = 500
+
+
+def encode_cursor(start: datetime.datetime, appointment_id: int) -> str:
+    """Return an opaque cursor pointing after the given appointment."""
+    raw = '{},{}'.format(start.astimezone(datetime.timezone.utc).isoformat(), appointment_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """
+    Parse a cursor created by ``encode_cursor``.
+    :raises ValueError: when the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        start, appointment_id = raw.split(',')
+        start = datetime.datetime.fromisoformat(start)
+        appointment_id = int(appointment_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if start.tzinfo is None:
+        raise ValueError('Invalid cursor')
+    return start, appointment_id
+
+
+def get_appointments_page(
+        queryset: QuerySet, start: datetime.datetime, end: datetime.datetime,
+        cursor: Optional[Tuple[datetime.datetime, int]] = None, limit: int = DEFAULT_APPOINTMENTS_PAGE,
+) -> Tuple[List[Appointment], Optional[str]]:
+    """
+    Return appointments starting within ``[start, end)`` ordered by start time, one page at a time.
+    :param queryset: appointments already filtered by provider or service
+    :param cursor: decoded cursor of the previous page
+    :return: the page and the cursor of the next page, None on the last page
+    """
+    queryset = queryset.filter(appointment_date__gte=start, appointment_date__lt=end)
+    if cursor:
+        cursor_start, cursor_id = cursor
+        # the lower bound keeps the scan starting at the cursor, the condition skips rows of the same start
+        queryset = queryset.filter(appointment_date__gte=cursor_start).filter(
+            Q(appointment_date__gt=cursor_start) | Q(id__gt=cursor_id),
+        )
+    page = list(queryset.order_by('appointment_date', 'id')[:limit + 1])
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    return page, encode_cursor(page[-1].appointment_date, page[-1].id)
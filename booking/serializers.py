@@ -1,8 +1,221 @@
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
 from rest_framework import fields, serializers
 
-from booking.models import Appointment
+from booking.models import Appointment, WaitlistEntry
+from booking.schedule import DEFAULT_APPOINTMENTS_PAGE, MAX_APPOINTMENTS_PAGE, decode_cursor
+from booking.slots import MAX_APPOINTMENT_LENGTH, is_unit_aligned, reservation_unit
+from core.models.models import Client, UserToClient
+from core.services.models import Service
+
+MAX_SLOT_SEARCH_DAYS = 92
+MAX_EARLIEST_SLOTS = 100
+MAX_SEARCH_SLOTS = 1000
+
+
+def validate_unit_aligned(field: str, value: datetime.datetime):
+    """Reject a start that isn't on the reservation unit grid."""
+    if not is_unit_aligned(value):
+        raise serializers.ValidationError({field: _('Appointments start at a multiple of %(minutes)d minutes.') % {
+            'minutes': reservation_unit() // datetime.timedelta(minutes=1),
+        }})
+
+
+def validate_slot_step(value):
+    """Slots start on the reservation unit grid, a shorter step would only repeat the search."""
+    unit_minutes = reservation_unit() // datetime.timedelta(minutes=1)
+    if value is not None and value < unit_minutes:
+        raise serializers.ValidationError(_('Step cannot be shorter than {} minutes.').format(unit_minutes))
+    return value
+
+
+def validate_provider_offers(attrs):
+    """Reject a provider who doesn't belong to the client offering the service."""
+    if not UserToClient.objects.filter(
+            user=attrs['provider'], client_id=attrs['service'].client_id, invitation=False,
+    ).exists():
+        raise serializers.ValidationError({'provider': _('Provider does not offer this service.')})
+
 
 class AppointmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Appointment
-        fields = ['day_of_week','start_time','end_time']
+        fields = [
+            'id', 'provider', 'service', 'customer', 'appointment_date', 'end_date', 'status', 'notes', 'recurrence',
+            'recurrence_interval', 'recurrence_until',
+        ]
+        read_only_fields = fields
+
+
+class BookAppointmentSerializer(serializers.Serializer):
+    provider = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all())
+    service = serializers.PrimaryKeyRelatedField(queryset=Service.objects.all())
+    start = serializers.DateTimeField()
+    notes = serializers.CharField(required=False, allow_blank=True, allow_null=True, default=None)
+    recurrence = serializers.ChoiceField(choices=Appointment.RECURRENCE_CHOICES, required=False, default='')
+    recurrence_interval = serializers.IntegerField(min_value=1, max_value=52, required=False, default=1)
+    recurrence_until = serializers.DateTimeField(required=False, allow_null=True, default=None)
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['service'].duration <= 0:
+            raise serializers.ValidationError({'service': _('Service has no duration.')})
+        if datetime.timedelta(minutes=attrs['service'].duration) > MAX_APPOINTMENT_LENGTH:
+            raise serializers.ValidationError({'service': _('Service is too long to be booked.')})
+        if attrs['start'] <= timezone.now():
+            raise serializers.ValidationError({'start': _('Cannot book an appointment in the past.')})
+        validate_unit_aligned('start', attrs['start'])
+        if attrs['recurrence_until'] and attrs['recurrence_until'] < attrs['start']:
+            raise serializers.ValidationError({'recurrence_until': _('Recurrence cannot end before it starts.')})
+        validate_provider_offers(attrs)
+        return attrs
+
+
+class OccurrenceExceptionSerializer(serializers.Serializer):
+    original_start = serializers.DateTimeField()
+    new_start = serializers.DateTimeField(required=False, allow_null=True, default=None)
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['new_start'] and attrs['new_start'] <= timezone.now():
+            raise serializers.ValidationError({'new_start': _('Cannot move an occurrence in the past.')})
+        if attrs['new_start']:
+            validate_unit_aligned('new_start', attrs['new_start'])
+        return attrs
+
+
+class AppointmentRangeSerializer(serializers.Serializer):
+    provider = serializers.PrimaryKeyRelatedField(
+        queryset=get_user_model().objects.all(), required=False, default=None,
+    )
+    service = serializers.PrimaryKeyRelatedField(queryset=Service.objects.all(), required=False, default=None)
+    cursor = serializers.CharField(required=False, default=None)
+    limit = serializers.IntegerField(
+        min_value=1, max_value=MAX_APPOINTMENTS_PAGE, required=False, default=DEFAULT_APPOINTMENTS_PAGE,
+    )
+
+    def get_fields(self):
+        # from is a reserved word, so the range fields cannot be declared as class attributes
+        fields = super().get_fields()
+        fields['from'] = serializers.DateTimeField()
+        fields['to'] = serializers.DateTimeField()
+        return fields
+
+    def validate_cursor(self, value):
+        if value is None:
+            return None
+        try:
+            return decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError(_('Invalid cursor.'))
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['provider'] is None and attrs['service'] is None:
+            raise serializers.ValidationError({'provider': _('A provider or a service is required.')})
+        if attrs['to'] <= attrs['from']:
+            raise serializers.ValidationError({'to': _('End of the range must be after its start.')})
+        return attrs
+
+
+class WaitlistEntrySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WaitlistEntry
+        fields = [
+            'id', 'provider', 'service', 'window_start', 'window_end', 'priority', 'created_at', 'status',
+            'appointment',
+        ]
+        read_only_fields = fields
+
+
+class JoinWaitlistSerializer(serializers.Serializer):
+    provider = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all())
+    service = serializers.PrimaryKeyRelatedField(queryset=Service.objects.all())
+    window_start = serializers.DateTimeField()
+    window_end = serializers.DateTimeField()
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['window_end'] <= max(attrs['window_start'], timezone.now()):
+            raise serializers.ValidationError({'window_end': _('Window must end in the future, after its start.')})
+        if attrs['service'].duration <= 0:
+            raise serializers.ValidationError({'service': _('Service has no duration.')})
+        if datetime.timedelta(minutes=attrs['service'].duration) > MAX_APPOINTMENT_LENGTH:
+            raise serializers.ValidationError({'service': _('Service is too long to be booked.')})
+        if attrs['window_end'] - attrs['window_start'] < datetime.timedelta(minutes=attrs['service'].duration):
+            raise serializers.ValidationError({'window_end': _('Window is shorter than the service.')})
+        validate_provider_offers(attrs)
+        return attrs
+
+
+class CancelScheduleSerializer(serializers.Serializer):
+    provider = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all())
+    start = serializers.DateTimeField()
+    end = serializers.DateTimeField()
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['end'] <= attrs['start']:
+            raise serializers.ValidationError({'end': _('End of the range must be after its start.')})
+        return attrs
+
+
+class ScheduleImportSerializer(serializers.Serializer):
+    batch_size = serializers.IntegerField(min_value=1, max_value=10000, required=False, default=1000)
+
+
+class ScheduleExportSerializer(serializers.Serializer):
+    client = serializers.PrimaryKeyRelatedField(queryset=Client.objects.all(), required=False, default=None)
+
+
+class RotateFeedSerializer(serializers.Serializer):
+    client = serializers.PrimaryKeyRelatedField(queryset=Client.objects.all(), required=False, default=None)
+
+
+class SlotSearchSerializer(serializers.Serializer):
+    provider = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all())
+    service = serializers.PrimaryKeyRelatedField(queryset=Service.objects.all())
+    start_date = serializers.DateField()
+    end_date = serializers.DateField()
+    step = serializers.IntegerField(min_value=1, required=False, default=None)
+
+    def validate_step(self, value):
+        return validate_slot_step(value)
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['end_date'] < attrs['start_date']:
+            raise serializers.ValidationError({'end_date': _('End date cannot be before start date.')})
+        if attrs['end_date'] - attrs['start_date'] >= datetime.timedelta(days=MAX_SLOT_SEARCH_DAYS):
+            raise serializers.ValidationError(
+                {'end_date': _('Cannot search more than {} days at once.').format(MAX_SLOT_SEARCH_DAYS)}
+            )
+        if attrs['service'].duration <= 0:
+            raise serializers.ValidationError({'service': _('Service has no duration.')})
+        validate_provider_offers(attrs)
+        return attrs
+
+
+class EarliestSlotSearchSerializer(serializers.Serializer):
+    service = serializers.PrimaryKeyRelatedField(queryset=Service.objects.all())
+    client = serializers.PrimaryKeyRelatedField(queryset=Client.objects.all(), required=False, default=None)
+    start_date = serializers.DateField(required=False, default=None)
+    days = serializers.IntegerField(min_value=1, max_value=MAX_SLOT_SEARCH_DAYS, required=False, default=14)
+    limit = serializers.IntegerField(min_value=1, max_value=MAX_EARLIEST_SLOTS, required=False, default=10)
+    per_provider_limit = serializers.IntegerField(min_value=1, required=False, default=None)
+    step = serializers.IntegerField(min_value=1, required=False, default=None)
+
+    def validate_step(self, value):
+        return validate_slot_step(value)
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['service'].duration <= 0:
+            raise serializers.ValidationError({'service': _('Service has no duration.')})
+        if attrs['client'] is None:
+            # providers default to the users of the client offering the service
+            attrs['client'] = attrs['service'].client
+        return attrs
@@ -0,0 +1,206 @@
+
+from collections import defaultdict
+from typing import Optional
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from booking import bitmaps, feeds, waitlist
+from booking.models import Appointment, AppointmentException, Availability
+from booking.recurrence import series_end
+from booking.reservations import release_reservations
+from core.services.models import Service
+
+
+def get_appointment_schedule(appointment: Appointment):
+    """
+    Return the provider and the time range taken by an appointment.
+    The range of a recurring appointment covers all its occurrences, its end is None when it repeats forever.
+    """
+    start = appointment.appointment_date
+    end = appointment.end_date or start
+    if start and appointment.is_recurring:
+        end = series_end(start, end, appointment.recurrence_until)
+    return appointment.provider_id, start, end
+
+
+def frees_time(appointment: Appointment, deleted: bool) -> bool:
+    """Whether an appointment just gave its time back, by being canceled or deleted while active."""
+    if appointment.is_recurring or not appointment.provider_id or not appointment.end_date:
+        return False
+    if deleted:
+        return appointment.status != 'canceled'
+    return appointment.status == 'canceled' and getattr(appointment, '_previous_status', None) not in (
+        None, 'canceled',
+    )
+
+
+def deleted_with_provider(provider_id, origin) -> bool:
+    """Whether a delete cascades from the provider itself, whose bitmaps are then deleted too."""
+    return isinstance(origin, get_user_model()) and origin.pk == provider_id
+
+
+@receiver(pre_save, sender=Availability)
+def remember_previous_availability_day(sender, instance: Availability, raw=False, using=None, **kwargs):
+    instance._previous_day = None
+    if raw or instance._state.adding:
+        return
+    if instance.loaded_values is not None:
+        instance._previous_day = (instance.loaded_values['user_id'], instance.loaded_values['day_of_week'])
+    else:
+        instance._previous_day = Availability.objects.using(using).filter(pk=instance.pk).values_list(
+            'user_id', 'day_of_week',
+        ).first()
+
+
+@receiver(post_save, sender=Availability)
+@receiver(post_delete, sender=Availability)
+def refresh_availability_bitmaps(sender, instance: Availability, raw=False, using=None, **kwargs):
+    if raw or deleted_with_provider(instance.user_id, kwargs.get('origin')):
+        return
+    # a weekly window only affects the days of its day of week, in the provider's timezone
+    weekdays = defaultdict(set)
+    changed_days = {(instance.user_id, instance.day_of_week), getattr(instance, '_previous_day', None)} - {None}
+    for provider_id, weekday in changed_days:
+        weekdays[provider_id].add(weekday)
+
+    def refresh():
+        timezones = dict(get_user_model().objects.using(using).filter(pk__in=list(weekdays)).values_list(
+            'pk', 'timezone',
+        ))
+        first_day, last_day = bitmaps.materialized_range()
+        for provider_id, timezone_name in timezones.items():
+            days = bitmaps.weekday_days(weekdays[provider_id], timezone_name)
+            bitmaps.safe_refresh_bitmaps([provider_id], first_day, last_day, using=using, days=days)
+
+    # refresh after commit so concurrent writers don't wait on bitmap rows while holding their transaction
+    transaction.on_commit(refresh, using=using)
+
+
+def get_previous_value(sender, instance, name: str, using=None):
+    """Return a field as stored before a save, from the value it was loaded with when possible."""
+    if instance.loaded_values is not None:
+        return instance.loaded_values[name]
+    return sender.objects.using(using).filter(pk=instance.pk).values_list(name, flat=True).first()
+
+
+@receiver(pre_save, sender=get_user_model())
+def remember_previous_timezone(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+    instance._previous_timezone = None
+    if raw or instance._state.adding or (update_fields is not None and 'timezone' not in update_fields):
+        return
+    instance._previous_timezone = get_previous_value(sender, instance, 'timezone', using=using)
+
+
+@receiver(post_save, sender=get_user_model())
+def refresh_timezone_bitmaps(sender, instance, raw=False, using=None, **kwargs):
+    previous_timezone = getattr(instance, '_previous_timezone', None)
+    if raw or previous_timezone is None or previous_timezone == instance.timezone:
+        return
+
+    def refresh():
+        # local availability windows moved in UTC
+        if Availability.objects.using(using).filter(user_id=instance.pk).exists():
+            bitmaps.safe_refresh_bitmaps([instance.pk], *bitmaps.materialized_range(), using=using)
+
+    transaction.on_commit(refresh, using=using)
+
+
+def get_previous_appointment(instance: Appointment, using=None) -> Optional[Appointment]:
+    """Return the appointment as stored before a save, from the values it was loaded with when possible."""
+    if instance.loaded_values is None:
+        return Appointment.objects.using(using).select_related('service').filter(pk=instance.pk).first()
+    previous = Appointment(id=instance.pk, **instance.loaded_values)
+    if previous.service_id == instance.service_id and instance.service_id:
+        # the service gives the client whose feed showed the appointment, the saved instance shares it
+        previous.service = instance.service
+    return previous
+
+
+@receiver(pre_save, sender=Appointment)
+def remember_previous_appointment_schedule(sender, instance: Appointment, raw=False, using=None, **kwargs):
+    instance._previous_schedule = None
+    instance._previous_status = None
+    instance._previous_feed_keys = set()
+    if not raw and not instance._state.adding:
+        previous = get_previous_appointment(instance, using=using)
+        if previous:
+            instance._previous_schedule = get_appointment_schedule(previous)
+            instance._previous_status = previous.status
+            instance._previous_feed_keys = feeds.appointment_feed_keys(previous)
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def refresh_appointment_bitmaps(sender, instance: Appointment, raw=False, using=None, **kwargs):
+    if raw or deleted_with_provider(instance.provider_id, kwargs.get('origin')):
+        return
+    if kwargs.get('signal') is post_save and instance.status == 'canceled':
+        release_reservations(instance.id, using=using)
+    schedule = get_appointment_schedule(instance)
+    previous_schedule = getattr(instance, '_previous_schedule', None)
+
+    def refresh():
+        for provider_id, start, end in {schedule, previous_schedule} - {None}:
+            if provider_id and start:
+                days = bitmaps.appointment_days(start, end)
+                bitmaps.safe_refresh_bitmaps([provider_id], *days, using=using)
+
+    transaction.on_commit(refresh, using=using)
+    feeds.bump_feed_versions_on_commit(
+        feeds.appointment_feed_keys(instance) | getattr(instance, '_previous_feed_keys', set()), using=using,
+    )
+    if frees_time(instance, kwargs.get('signal') is post_delete):
+        freed = [(instance.provider_id, instance.appointment_date, instance.end_date)]
+        # registered after the bitmap refresh, so offers see up to date free time
+        transaction.on_commit(lambda: waitlist.safe_match_freed_slots(freed, using=using), using=using)
+
+
+@receiver(post_save, sender=AppointmentException)
+@receiver(post_delete, sender=AppointmentException)
+def refresh_exception_bitmaps(sender, instance: AppointmentException, raw=False, using=None, **kwargs):
+    if raw or isinstance(kwargs.get('origin'), (Appointment, get_user_model())):
+        # deleted along with its appointment, which refreshes the bitmaps itself
+        return
+    series = Appointment.objects.using(using).filter(pk=instance.appointment_id).values_list(
+        'provider_id', 'appointment_date', 'end_date', 'service__client_id',
+    ).first()
+    if not series or not series[0]:
+        return
+    provider_id, start, end, client_id = series
+    feeds.bump_feed_versions_on_commit(
+        {feeds.provider_feed_key(provider_id)} | ({feeds.client_feed_key(client_id)} if client_id else set()),
+        using=using,
+    )
+    ranges = [(instance.original_start, instance.original_start + ((end or start) - start))]
+    if instance.new_start and instance.new_end:
+        ranges.append((instance.new_start, instance.new_end))
+
+    def refresh():
+        for start, end in ranges:
+            bitmaps.safe_refresh_bitmaps([provider_id], *bitmaps.appointment_days(start, end), using=using)
+
+    transaction.on_commit(refresh, using=using)
+
+
+@receiver(pre_save, sender=Service)
+def remember_previous_service_name(sender, instance: Service, raw=False, using=None, update_fields=None, **kwargs):
+    instance._previous_name = None
+    if raw or instance._state.adding or (update_fields is not None and 'name' not in update_fields):
+        return
+    instance._previous_name = get_previous_value(sender, instance, 'name', using=using)
+
+
+@receiver(post_save, sender=Service)
+def bump_service_feeds(sender, instance: Service, raw=False, using=None, **kwargs):
+    previous_name = getattr(instance, '_previous_name', None)
+    if raw or previous_name is None or previous_name == instance.name:
+        return
+    # the service name is the summary of its appointments in feeds
+    provider_ids = Appointment.objects.using(using).filter(
+        service_id=instance.pk, provider_id__isnull=False,
+    ).values_list('provider_id', flat=True).distinct()
+    keys = {feeds.client_feed_key(instance.client_id)} | {feeds.provider_feed_key(pk) for pk in provider_ids}
+    feeds.bump_feed_versions_on_commit(keys, using=using)
@@ -0,0 +1,468 @@
+"""
+Bookable slot computation.
+
+Weekly ``Availability`` windows and ``Appointment`` rows are both turned into sorted lists of ``(start, end)``
+intervals and combined with a single linear sweep, so the cost of a lookup depends on the number of intervals
+involved and not on the number of candidate slots. Slots start on the reservation unit grid, so back to back
+slots never claim the same reservation unit.
+"""
+import datetime
+import heapq
+from collections import defaultdict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+
+from booking.models import Appointment, AppointmentException, Availability
+from booking.recurrence import iter_occurrences
+from booking.timezones import LocalClock, to_local, to_utc
+
+Interval = Tuple[datetime.datetime, datetime.datetime]
+ProviderSlot = Tuple[datetime.datetime, datetime.datetime, int]
+
+# longest appointment looked up before the searched range, keeps busy lookups a range scan of the start index;
+# longer appointments are rejected when booking or importing
+MAX_APPOINTMENT_LENGTH = datetime.timedelta(days=1)
+# reservation units are counted from this moment
+RESERVATION_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+# earliest slot searches look this many days ahead first and double the window until enough slots are found
+EARLIEST_SEARCH_INITIAL_DAYS = 7
+
+
+class WeeklyWindows(dict):
+    """Availability windows of a provider by day of week, as local times of the provider's timezone."""
+
+    def __init__(self, timezone_name: str = ''):
+        super().__init__()
+        self.timezone_name = timezone_name
+
+
+def reservation_unit() -> datetime.timedelta:
+    return datetime.timedelta(minutes=getattr(settings, 'APPITY_RESERVATION_UNIT_MINUTES', 5))
+
+
+def is_unit_aligned(moment: datetime.datetime) -> bool:
+    """Check that a moment is the start of a reservation unit."""
+    return (moment - RESERVATION_EPOCH) % reservation_unit() == datetime.timedelta(0)
+
+
+def align_to_unit(moment: datetime.datetime) -> datetime.datetime:
+    """Round a moment up to the start of a reservation unit."""
+    return moment + -(moment - RESERVATION_EPOCH) % reservation_unit()
+
+
+def day_of_week(day: datetime.date) -> int:
+    """Map a date to ``Availability.DayOfWeek`` (Sunday is 1, Saturday is 7)."""
+    return day.isoweekday() % 7 + 1
+
+
+def merge_intervals(intervals: Iterable[Interval]) -> List[Interval]:
+    """Merge overlapping or touching intervals. Input must be sorted by start."""
+    merged = []  # type: List[Interval]
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def iter_subtract_intervals(free: Iterable[Interval], busy: List[Interval]) -> Iterator[Interval]:
+    """
+    Remove busy intervals from free intervals, lazily.
+    :param free: sorted, non overlapping intervals, may be a generator
+    :param busy: sorted, non overlapping intervals
+    :return: sorted parts of free intervals not covered by any busy interval
+    """
+    busy_index = 0
+    busy_count = len(busy)
+    for start, end in free:
+        # busy intervals ending before this free interval can't affect it or any following one
+        while busy_index < busy_count and busy[busy_index][1] <= start:
+            busy_index += 1
+        cursor = start
+        index = busy_index
+        while index < busy_count and busy[index][0] < end:
+            busy_start, busy_end = busy[index]
+            if busy_start > cursor:
+                yield cursor, busy_start
+            if busy_end > cursor:
+                cursor = busy_end
+            if cursor >= end:
+                break
+            index += 1
+        if cursor < end:
+            yield cursor, end
+
+
+def subtract_intervals(free: List[Interval], busy: List[Interval]) -> List[Interval]:
+    """Remove busy intervals from free intervals. Both lists must be sorted and non overlapping."""
+    return list(iter_subtract_intervals(free, busy))
+
+
+def iter_clip_intervals(
+        intervals: Iterable[Interval], start: datetime.datetime, end: datetime.datetime,
+) -> Iterator[Interval]:
+    """Restrict sorted intervals to the ``[start, end)`` range, lazily."""
+    for interval_start, interval_end in intervals:
+        if interval_start >= end:
+            return
+        if interval_end > start:
+            yield max(interval_start, start), min(interval_end, end)
+
+
+def clip_intervals(intervals: List[Interval], start: datetime.datetime, end: datetime.datetime) -> List[Interval]:
+    """Restrict sorted intervals to the ``[start, end)`` range."""
+    return list(iter_clip_intervals(intervals, start, end))
+
+
+def split_into_slots(
+        free: Iterable[Interval], duration: datetime.timedelta, step: Optional[datetime.timedelta] = None,
+) -> Iterator[Interval]:
+    """
+    Yield ``duration`` long slots that fit in the free intervals, starting every ``step``. Starts are rounded up to
+    the reservation unit grid.
+    """
+    step = step or duration
+    for start, end in free:
+        slot_start = align_to_unit(start)
+        while slot_start + duration <= end:
+            yield slot_start, slot_start + duration
+            slot_start = align_to_unit(slot_start + step)
+
+
+def load_weekly_windows(provider_ids: Iterable[int], using: Optional[str] = None) -> Dict[int, WeeklyWindows]:
+    """
+    Load availability windows and timezones of the given providers with one query.
+    :param provider_ids: provider ids, a values queryset is used as a subquery
+    :return: {provider_id: {day_of_week: [(start_time, end_time), ...]}} with windows sorted by start time
+    """
+    windows = {}
+    rows = Availability.objects.using(using).filter(user_id__in=provider_ids).order_by('start_time').values_list(
+        'user_id', 'user__timezone', 'day_of_week', 'start_time', 'end_time',
+    )
+    for provider_id, timezone_name, weekday, start_time, end_time in rows:
+        if end_time > start_time:
+            provider_windows = windows.setdefault(provider_id, WeeklyWindows(timezone_name))
+            provider_windows.setdefault(weekday, []).append((start_time, end_time))
+    return windows
+
+
+def load_busy_intervals(
+        provider_ids: Iterable[int], start: datetime.datetime, end: datetime.datetime, using: Optional[str] = None,
+        exclude_id: Optional[int] = None,
+) -> Dict[int, List[Interval]]:
+    """
+    Load intervals taken by appointments of the given providers, including occurrences of recurring appointments.
+    :param exclude_id: appointment left out, e.g. the one being checked
+    :return: {provider_id: [(start, end), ...]} with merged intervals sorted by start
+    """
+    provider_ids = list(provider_ids)
+    busy = defaultdict(list)
+    appointments = Appointment.objects.using(using).filter(
+        provider_id__in=provider_ids,
+        appointment_date__gte=start - MAX_APPOINTMENT_LENGTH,
+        appointment_date__lt=end,
+        end_date__gt=start,
+        recurrence='',
+    ).exclude(
+        status='canceled',
+    )
+    if exclude_id is not None:
+        appointments = appointments.exclude(pk=exclude_id)
+    rows = appointments.order_by('appointment_date').values_list('provider_id', 'appointment_date', 'end_date')
+    for provider_id, appointment_start, appointment_end in rows:
+        if appointment_end > appointment_start:
+            busy[provider_id].append((appointment_start, appointment_end))
+    recurring = load_recurring_intervals(provider_ids, start, end, using=using, exclude_id=exclude_id)
+    for provider_id, occurrences in recurring.items():
+        busy[provider_id] = list(heapq.merge(busy[provider_id], occurrences))
+    return {provider_id: merge_intervals(intervals) for provider_id, intervals in busy.items()}
+
+
+def load_recurring_intervals(
+        provider_ids: List[int], start: datetime.datetime, end: datetime.datetime, using: Optional[str] = None,
+        exclude_id: Optional[int] = None,
+) -> Dict[int, List[Interval]]:
+    """
+    Expand occurrences of recurring appointments within ``[start, end)``, without storing them.
+    Exceptions are only loaded when some series reach the range, so this is one query in the common case.
+    :param exclude_id: series left out, e.g. the one being checked
+    :return: {provider_id: [(start, end), ...]} with occurrences sorted by start, possibly overlapping
+    """
+    appointments = Appointment.objects.using(using).filter(
+        provider_id__in=provider_ids,
+        appointment_date__lt=end,
+        end_date__isnull=False,
+    ).exclude(
+        recurrence='',
+    ).exclude(
+        status='canceled',
+    ).filter(
+        Q(recurrence_until__isnull=True) | Q(recurrence_until__gte=start - MAX_APPOINTMENT_LENGTH),
+    )
+    if exclude_id is not None:
+        appointments = appointments.exclude(pk=exclude_id)
+    series = list(appointments.values_list(
+        'id', 'provider_id', 'provider__timezone', 'appointment_date', 'end_date', 'recurrence', 'recurrence_interval',
+        'recurrence_until',
+    ))
+    if not series:
+        return {}
+    exceptions = defaultdict(dict)
+    exception_rows = AppointmentException.objects.using(using).filter(
+        appointment_id__in=[row[0] for row in series],
+    ).filter(
+        Q(original_start__gte=start - MAX_APPOINTMENT_LENGTH, original_start__lt=end) |
+        Q(new_start__lt=end, new_end__gt=start),
+    ).values_list('appointment_id', 'original_start', 'new_start', 'new_end')
+    for appointment_id, original_start, new_start, new_end in exception_rows:
+        moved = (new_start, new_end) if new_start and new_end and new_end > new_start else None
+        exceptions[appointment_id][original_start] = moved
+    occurrences = defaultdict(list)
+    for appointment_id, provider_id, timezone_name, first_start, first_end, rule, interval, until in series:
+        occurrences[provider_id].append(iter_occurrences(
+            first_start, first_end, rule, interval, until, start, end, exceptions.get(appointment_id),
+            timezone_name=timezone_name,
+        ))
+    return {provider_id: list(heapq.merge(*iterators)) for provider_id, iterators in occurrences.items()}
+
+
+def time_offset(value: datetime.time) -> datetime.timedelta:
+    return datetime.timedelta(hours=value.hour, minutes=value.minute, seconds=value.second)
+
+
+def iter_availability_intervals(
+        weekly_windows: WeeklyWindows, start_date: datetime.date, end_date: datetime.date,
+) -> Iterator[Interval]:
+    """
+    Expand weekly windows day by day into sorted, merged UTC intervals between two local dates (inclusive).
+    Each day is converted to UTC once, windows are only converted one by one on days with a DST transition.
+    """
+    clock = LocalClock(getattr(weekly_windows, 'timezone_name', ''))
+    day_windows = {
+        weekday: [(time_offset(start_time), time_offset(end_time)) for start_time, end_time in windows]
+        for weekday, windows in weekly_windows.items()
+    }
+    day = start_date
+    one_day = datetime.timedelta(days=1)
+    while day <= end_date:
+        windows = day_windows.get(day_of_week(day))
+        if windows:
+            midnight = datetime.datetime.combine(day, datetime.time.min)
+            origin = clock.utc_origin(midnight, midnight + one_day)
+            if origin is not None:
+                yield from merge_intervals((origin + start, origin + end) for start, end in windows)
+            else:
+                # times skipped by a DST gap convert out of order, windows may then shrink or swap
+                intervals = [
+                    (clock.to_utc(midnight + start), clock.to_utc(midnight + end)) for start, end in windows
+                ]
+                yield from merge_intervals(sorted(interval for interval in intervals if interval[1] > interval[0]))
+        day += one_day
+
+
+def iter_availability_between(
+        weekly_windows: WeeklyWindows, range_start: datetime.datetime, range_end: datetime.datetime,
+) -> Iterator[Interval]:
+    """Expand weekly windows into sorted, merged intervals within the ``[start, end)`` range, lazily."""
+    timezone_name = getattr(weekly_windows, 'timezone_name', '')
+    start_date = to_local(range_start, timezone_name).date()
+    end_date = to_local(range_end - datetime.timedelta(microseconds=1), timezone_name).date()
+    return iter_clip_intervals(
+        iter_availability_intervals(weekly_windows, start_date, end_date), range_start, range_end,
+    )
+
+
+def date_range_bounds(start_date: datetime.date, end_date: datetime.date, timezone_name: str = '') -> Interval:
+    """Return the datetime range covering both local dates entirely, the default timezone is used when empty."""
+    return (
+        to_utc(datetime.datetime.combine(start_date, datetime.time.min), timezone_name),
+        to_utc(datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time.min), timezone_name),
+    )
+
+
+def utc_days(range_start: datetime.datetime, range_end: datetime.datetime) -> Tuple[datetime.date, datetime.date]:
+    """Return the first and last (inclusive) UTC days touched by a datetime range."""
+    return (
+        range_start.astimezone(datetime.timezone.utc).date(),
+        (range_end - datetime.timedelta(microseconds=1)).astimezone(datetime.timezone.utc).date(),
+    )
+
+
+def get_computed_free_intervals(
+        provider_ids: List[int], weekly_windows: Dict[int, WeeklyWindows],
+        range_start: datetime.datetime, range_end: datetime.datetime, using: Optional[str] = None,
+) -> Dict[int, List[Interval]]:
+    """
+    Compute free intervals within a datetime range from availability windows and appointments, loading appointments
+    in bulk.
+    :return: {provider_id: [(start, end), ...]} for providers having availability windows
+    """
+    provider_ids = [provider_id for provider_id in provider_ids if weekly_windows.get(provider_id)]
+    if not provider_ids:
+        return {}
+    busy = load_busy_intervals(provider_ids, range_start, range_end, using=using)
+    return {
+        provider_id: subtract_intervals(
+            list(iter_availability_between(weekly_windows[provider_id], range_start, range_end)),
+            busy.get(provider_id, []),
+        ) for provider_id in provider_ids
+    }
+
+
+def get_free_intervals_between(
+        provider_id: int, range_start: datetime.datetime, range_end: datetime.datetime,
+        using: Optional[str] = None,
+) -> List[Interval]:
+    """
+    Return the sorted free intervals of a provider within the ``[start, end)`` range.
+    Materialized bitmaps are used when they cover the range, availability and appointments otherwise.
+    """
+    from booking.bitmaps import get_bitmap_free_intervals
+
+    if range_start >= range_end:
+        return []
+    free = get_bitmap_free_intervals(provider_id, *utc_days(range_start, range_end), using=using)
+    if free is None:
+        weekly_windows = load_weekly_windows([provider_id], using=using)
+        free = get_computed_free_intervals(
+            [provider_id], weekly_windows, range_start, range_end, using=using,
+        ).get(provider_id, [])
+    return clip_intervals(free, range_start, range_end)
+
+
+def get_free_intervals(
+        provider, start_date: datetime.date, end_date: datetime.date,
+        not_before: Optional[datetime.datetime] = None, using: Optional[str] = None,
+) -> List[Interval]:
+    """Return the sorted free intervals of a provider between two dates (inclusive) of the provider's timezone."""
+    range_start, range_end = date_range_bounds(start_date, end_date, provider.timezone)
+    if not_before and not_before > range_start:
+        range_start = not_before
+    return get_free_intervals_between(provider.id, range_start, range_end, using=using)
+
+
+def get_free_slots(
+        provider, service, start_date: datetime.date, end_date: datetime.date,
+        step: Optional[datetime.timedelta] = None, not_before: Optional[datetime.datetime] = None,
+        limit: Optional[int] = None,
+) -> List[Interval]:
+    """
+    Compute bookable slots for a provider and a service between two dates (inclusive).
+    :param provider: user whose availability is used
+    :param service: service whose ``duration`` (in minutes) gives the slot length
+    :param step: distance between two consecutive slot starts, defaults to the service duration
+    :param not_before: slots starting before this moment are not returned
+    :param limit: maximum number of slots returned, the earliest ones
+    """
+    duration = datetime.timedelta(minutes=service.duration)
+    free = get_free_intervals(provider, start_date, end_date, not_before=not_before)
+    return list(islice(split_into_slots(free, duration, step), limit))
+
+
+def iter_provider_slots(
+        provider_id: int, free: Iterable[Interval], duration: datetime.timedelta,
+        step: Optional[datetime.timedelta], not_before: datetime.datetime, range_end: datetime.datetime,
+        resume: Optional[Dict[int, datetime.datetime]] = None,
+) -> Iterator[ProviderSlot]:
+    """
+    Lazily yield ``(start, end, provider_id)`` slots of one provider starting before ``range_end``, in chronological
+    order. Free intervals must reach ``range_end + duration`` so that slots starting just before the end are found.
+    :param resume: receives, by provider, the next slot start of a free interval crossing ``range_end``, so the
+    search of the following range continues the same ``step`` grid
+    """
+    step = step or duration
+    for start, end in iter_clip_intervals(free, not_before, range_end + duration):
+        slot_start = align_to_unit(start)
+        while slot_start < range_end and slot_start + duration <= end:
+            yield slot_start, slot_start + duration, provider_id
+            slot_start = align_to_unit(slot_start + step)
+        if slot_start >= range_end:
+            if resume is not None and start < range_end:
+                resume[provider_id] = slot_start
+            return
+
+
+def find_earliest_slots(
+        provider_ids: Iterable[int], service, start_date: datetime.date, limit: int,
+        max_days: int, per_provider_limit: Optional[int] = None,
+        step: Optional[datetime.timedelta] = None, not_before: Optional[datetime.datetime] = None,
+) -> List[ProviderSlot]:
+    """
+    Find the earliest free slots across many providers.
+
+    Availability of all providers is loaded with one query. Free time is then read for all providers at once in
+    windows that start at ``EARLIEST_SEARCH_INITIAL_DAYS`` days and double in size, from materialized bitmaps when
+    available and from appointments otherwise, and the per provider slot streams of each window are combined with
+    a k-way heap merge that stops as soon as ``limit`` slots are found.
+    :param provider_ids: provider ids, a values queryset is used as a subquery
+    :param service: service whose ``duration`` (in minutes) gives the slot length
+    :param limit: maximum number of slots returned
+    :param max_days: number of days after ``start_date`` (inclusive) to look into
+    :param per_provider_limit: maximum number of slots returned for a single provider
+    :return: list of ``(start, end, provider_id)`` sorted by start
+    """
+    from booking.bitmaps import materialized_range, load_bitmap_intervals
+
+    duration = datetime.timedelta(minutes=service.duration)
+    all_windows = load_weekly_windows(provider_ids)
+    if not all_windows:
+        return []
+    first_materialized, last_materialized = materialized_range()
+    slots = []  # type: List[ProviderSlot]
+    provider_slot_counts = defaultdict(int)
+    # next slot start of each provider whose free time crosses the end of the previous window
+    resume = {}  # type: Dict[int, datetime.datetime]
+    last_date = start_date + datetime.timedelta(days=max_days - 1)
+    window_start = start_date
+    window_days = EARLIEST_SEARCH_INITIAL_DAYS
+    while window_start <= last_date and len(slots) < limit:
+        window_end = min(window_start + datetime.timedelta(days=window_days - 1), last_date)
+        range_start, range_end = date_range_bounds(window_start, window_end)
+        if not_before and not_before > range_start:
+            range_start = not_before
+        if range_start >= range_end:
+            window_start = window_end + datetime.timedelta(days=1)
+            window_days *= 2
+            continue
+        candidates = [
+            provider_id for provider_id in all_windows
+            if per_provider_limit is None or provider_slot_counts[provider_id] < per_provider_limit
+        ]
+        if not candidates:
+            break
+        # slots start within the window but may end after it
+        read_end = range_end + duration
+        free = {}
+        first_day, last_day = utc_days(range_start, read_end)
+        if first_materialized <= first_day and last_day <= last_materialized:
+            free = load_bitmap_intervals(candidates, first_day, last_day)
+        busy = load_busy_intervals(
+            [provider_id for provider_id in candidates if provider_id not in free], range_start, read_end,
+        ) if len(free) < len(candidates) else {}
+        streams = []
+        for provider_id in candidates:
+            if provider_id in free:
+                provider_free = free[provider_id]
+            else:
+                provider_free = iter_subtract_intervals(
+                    iter_availability_between(all_windows[provider_id], range_start, read_end),
+                    busy.get(provider_id, []),
+                )
+            provider_start = max(range_start, resume.get(provider_id, range_start))
+            stream = iter_provider_slots(
+                provider_id, provider_free, duration, step, provider_start, range_end, resume=resume,
+            )
+            if per_provider_limit is not None:
+                stream = islice(stream, per_provider_limit - provider_slot_counts[provider_id])
+            streams.append(stream)
+        for slot in islice(heapq.merge(*streams), limit - len(slots)):
+            provider_slot_counts[slot[2]] += 1
+            slots.append(slot)
+        window_start = window_end + datetime.timedelta(days=1)
+        window_days *= 2
+    return slots
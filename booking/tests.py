@@ -1,3 +1,809 @@
-from django.test import TestCase
+import datetime
+import json
+import random
+import zoneinfo
+from unittest import mock
 
-# Create your tests here.
+from django.core import signing
+from django.db import OperationalError, connection
+from django.db.models.query import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from booking import bitmaps, bulk, feeds
+from booking.models import (
+    Appointment, AppointmentException, Availability, AvailabilityBitmap, SlotReservation, WaitlistEntry,
+)
+from booking.reservations import (
+    MAX_BOOKING_ATTEMPTS, SlotUnavailable, book_appointment, move_occurrence, reservation_units, skip_occurrence,
+)
+from booking.slots import (
+    find_earliest_slots, get_computed_free_intervals, get_free_intervals_between, load_weekly_windows, merge_intervals,
+    split_into_slots, subtract_intervals,
+)
+from booking.timezones import LocalClock, to_local, to_utc
+from booking.waitlist import cancel_appointments
+from core.models import AppUser
+from core.models.models import Client, UserToClient
+from core.services.models import Service
+
+UTC = datetime.timezone.utc
+
+
+def utc(*args) -> datetime.datetime:
+    return datetime.datetime(*args, tzinfo=UTC)
+
+
+class BookingTestMixin:
+    @staticmethod
+    def create_client(company):
+        return Client.objects.create(
+            company=company, address1='Street 1', city='City', country='RO', zip_code='1000', phone='0000',
+        )
+
+    @staticmethod
+    def create_provider(email, client=None, timezone_name='', windows=()):
+        """Create a provider available every day of the week in the given (local start, local end) windows."""
+        provider = AppUser.objects.create_user(email=email, password='secret-password')
+        if timezone_name:
+            provider.timezone = timezone_name
+            provider.save(update_fields=['timezone'])
+        if client is not None:
+            UserToClient.objects.create(user=provider, client=client)
+        Availability.objects.bulk_create([
+            Availability(user=provider, day_of_week=weekday, start_time=start_time, end_time=end_time)
+            for weekday in Availability.DayOfWeek.values for start_time, end_time in windows
+        ])
+        return provider
+
+    @staticmethod
+    def create_service(client, duration=60, name='service'):
+        return Service.objects.create(name=name, duration=duration, client=client)
+
+
+class IntervalTest(SimpleTestCase):
+    def test_merge(self):
+        intervals = [
+            (utc(2030, 1, 1, 9), utc(2030, 1, 1, 10)),
+            (utc(2030, 1, 1, 10), utc(2030, 1, 1, 11)),
+            (utc(2030, 1, 1, 10, 30), utc(2030, 1, 1, 10, 45)),
+            (utc(2030, 1, 1, 12), utc(2030, 1, 1, 13)),
+        ]
+        self.assertEqual(merge_intervals(intervals), [
+            (utc(2030, 1, 1, 9), utc(2030, 1, 1, 11)),
+            (utc(2030, 1, 1, 12), utc(2030, 1, 1, 13)),
+        ])
+
+    def test_subtract(self):
+        free = [(utc(2030, 1, 1, 9), utc(2030, 1, 1, 17)), (utc(2030, 1, 2, 9), utc(2030, 1, 2, 17))]
+        busy = [
+            (utc(2030, 1, 1, 8), utc(2030, 1, 1, 10)),
+            (utc(2030, 1, 1, 12), utc(2030, 1, 1, 13)),
+            (utc(2030, 1, 1, 16), utc(2030, 1, 2, 10)),
+        ]
+        self.assertEqual(subtract_intervals(free, busy), [
+            (utc(2030, 1, 1, 10), utc(2030, 1, 1, 12)),
+            (utc(2030, 1, 1, 13), utc(2030, 1, 1, 16)),
+            (utc(2030, 1, 2, 10), utc(2030, 1, 2, 17)),
+        ])
+
+    def test_split_into_slots(self):
+        free = [(utc(2030, 1, 1, 9), utc(2030, 1, 1, 11)), (utc(2030, 1, 1, 12), utc(2030, 1, 1, 12, 30))]
+        slots = list(split_into_slots(free, datetime.timedelta(hours=1), datetime.timedelta(minutes=30)))
+        self.assertEqual(slots, [
+            (utc(2030, 1, 1, 9), utc(2030, 1, 1, 10)),
+            (utc(2030, 1, 1, 9, 30), utc(2030, 1, 1, 10, 30)),
+            (utc(2030, 1, 1, 10), utc(2030, 1, 1, 11)),
+        ])
+        # starts are rounded up to the 5 minute reservation units
+        free = [(utc(2030, 1, 1, 9, 2), utc(2030, 1, 1, 9, 30))]
+        slots = list(split_into_slots(free, datetime.timedelta(minutes=7)))
+        self.assertEqual([start for start, end in slots], [utc(2030, 1, 1, 9, 5), utc(2030, 1, 1, 9, 15)])
+
+
+class TimezonesTest(SimpleTestCase):
+    # DST in both hemispheres, a 30 minute DST, negative DST, abolished DST and a skipped day (Apia, 2011)
+    ZONES = [
+        'Europe/Berlin', 'America/New_York', 'Australia/Sydney', 'Australia/Lord_Howe', 'Europe/Dublin',
+        'America/Sao_Paulo', 'Asia/Kolkata', 'Pacific/Apia',
+    ]
+
+    def test_matches_zoneinfo(self):
+        samples = random.Random(7)
+        start = datetime.datetime(2005, 1, 1)
+        span = int((datetime.datetime(2035, 1, 1) - start).total_seconds())
+        for name in self.ZONES:
+            zone = zoneinfo.ZoneInfo(name)
+            clock = LocalClock(name)
+            instants = sorted(start + datetime.timedelta(seconds=samples.randrange(span)) for _ in range(5000))
+            for instant in instants:
+                local = instant.replace(tzinfo=UTC).astimezone(zone).replace(tzinfo=None)
+                self.assertEqual(to_local(instant.replace(tzinfo=UTC), name), local, (name, instant))
+                # naive times, including ones skipped or repeated by a transition, convert like fold=0
+                expected = instant.replace(tzinfo=zone).astimezone(UTC)
+                self.assertEqual(to_utc(instant, name), expected, (name, instant))
+                self.assertEqual(clock.to_utc(instant), expected, (name, instant))
+
+    def test_transitions(self):
+        # Berlin skips 02:00 to 03:00 on 2030-03-31 and repeats 02:00 to 03:00 on 2030-10-27
+        self.assertEqual(to_utc(datetime.datetime(2030, 3, 31, 2, 30), 'Europe/Berlin'), utc(2030, 3, 31, 1, 30))
+        self.assertEqual(to_utc(datetime.datetime(2030, 3, 31, 3), 'Europe/Berlin'), utc(2030, 3, 31, 1))
+        self.assertEqual(to_utc(datetime.datetime(2030, 10, 27, 2, 30), 'Europe/Berlin'), utc(2030, 10, 27, 0, 30))
+        self.assertEqual(to_local(utc(2030, 10, 27, 1, 30), 'Europe/Berlin'), datetime.datetime(2030, 10, 27, 2, 30))
+        # unknown zones fall back to the default timezone
+        self.assertEqual(to_utc(datetime.datetime(2030, 3, 31, 2, 30), 'Nowhere/Unknown'), utc(2030, 3, 31, 2, 30))
+
+
+class EarliestSlotsTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        self.company = self.create_client('company')
+        self.service = self.create_service(self.company)
+        # 23:30 to 04:30 UTC in winter, free time crosses every UTC midnight and so every search window boundary
+        self.night = self.create_provider(
+            'night@example.com', self.company, 'America/New_York', [(datetime.time(18, 30), datetime.time(23, 30))],
+        )
+        self.day = self.create_provider(
+            'day@example.com', self.company, windows=[(datetime.time(9), datetime.time(12))],
+        )
+
+    def test_merged_across_providers(self):
+        slots = find_earliest_slots([self.night.id, self.day.id], self.service, datetime.date(2030, 1, 7), 5, 14)
+        self.assertEqual(slots, [
+            (utc(2030, 1, 7, 0), utc(2030, 1, 7, 1), self.night.id),
+            (utc(2030, 1, 7, 1), utc(2030, 1, 7, 2), self.night.id),
+            (utc(2030, 1, 7, 2), utc(2030, 1, 7, 3), self.night.id),
+            (utc(2030, 1, 7, 3), utc(2030, 1, 7, 4), self.night.id),
+            (utc(2030, 1, 7, 9), utc(2030, 1, 7, 10), self.day.id),
+        ])
+
+    def test_window_boundary(self):
+        # the first search window ends on a UTC midnight in the middle of the provider's free time
+        slots = find_earliest_slots([self.night.id], self.service, datetime.date(2030, 1, 7), 100, 14)
+        free = get_free_intervals_between(self.night.id, utc(2030, 1, 7), utc(2030, 1, 22))
+        expected = [
+            (start, end, self.night.id) for start, end in split_into_slots(free, datetime.timedelta(hours=1))
+            if start < utc(2030, 1, 21)
+        ]
+        self.assertEqual(len(expected), 70)
+        self.assertEqual(slots, expected)
+        self.assertIn((utc(2030, 1, 13, 23, 30), utc(2030, 1, 14, 0, 30), self.night.id), slots)
+        self.assertIn((utc(2030, 1, 14, 0, 30), utc(2030, 1, 14, 1, 30), self.night.id), slots)
+
+    def test_busy_time_and_limits(self):
+        Appointment.objects.create(
+            provider=self.day, service=self.service, appointment_date=utc(2030, 1, 7, 9, 30),
+            end_date=utc(2030, 1, 7, 11),
+        )
+        slots = find_earliest_slots(
+            [self.night.id, self.day.id], self.service, datetime.date(2030, 1, 7), 3, 14, per_provider_limit=2,
+            step=datetime.timedelta(minutes=30), not_before=utc(2030, 1, 7, 1),
+        )
+        self.assertEqual(slots, [
+            (utc(2030, 1, 7, 1), utc(2030, 1, 7, 2), self.night.id),
+            (utc(2030, 1, 7, 1, 30), utc(2030, 1, 7, 2, 30), self.night.id),
+            (utc(2030, 1, 7, 11), utc(2030, 1, 7, 12), self.day.id),
+        ])
+
+    def test_view_permission(self):
+        user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+        api = APIClient()
+        api.force_authenticate(user)
+        other = self.create_client('other')
+        params = {'service': self.service.id, 'start_date': '2030-01-07', 'limit': 1}
+        response = api.get('/booking/slots/earliest', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['slots'][0]['provider'], self.night.id)
+        response = api.get('/booking/slots/earliest', dict(params, client=other.id))
+        self.assertEqual(response.status_code, 403)
+        UserToClient.objects.create(user=user, client=other)
+        response = api.get('/booking/slots/earliest', dict(params, client=other.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['slots'], [])
+
+
+class EarliestSlotsManyProvidersTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company, duration=30)
+        self.providers = [
+            self.create_provider(
+                'provider{}@example.com'.format(index), company,
+                windows=[(datetime.time(8 + index % 8), datetime.time(10 + index % 8))],
+            ) for index in range(20)
+        ]
+        self.provider_ids = [provider.id for provider in self.providers]
+        self.start_date = timezone.now().astimezone(UTC).date() + datetime.timedelta(days=1)
+        start = datetime.datetime.combine(self.start_date, datetime.time(8), tzinfo=UTC)
+        Appointment.objects.create(
+            provider=self.providers[0], service=self.service, appointment_date=start,
+            end_date=start + datetime.timedelta(minutes=90),
+        )
+
+    def search(self):
+        return find_earliest_slots(
+            self.provider_ids, self.service, self.start_date, limit=30, max_days=14, per_provider_limit=2,
+        )
+
+    def test_bitmaps_match_computed_free_time(self):
+        computed = self.search()
+        bitmaps.rebuild(self.provider_ids)
+        self.assertEqual(AvailabilityBitmap.objects.count(), 20 * bitmaps.materialized_days())
+        # availability of all providers, then their bitmaps for the first window
+        with self.assertNumQueries(2):
+            from_bitmaps = self.search()
+        self.assertEqual(from_bitmaps, computed)
+        self.assertEqual(len(computed), 30)
+        self.assertEqual(computed[0], (
+            datetime.datetime.combine(self.start_date, datetime.time(8), tzinfo=UTC),
+            datetime.datetime.combine(self.start_date, datetime.time(8, 30), tzinfo=UTC),
+            # ties are ordered by provider id
+            min(self.providers[8].id, self.providers[16].id),
+        ))
+        # the booked provider's first slot comes after its appointment
+        self.assertIn((
+            datetime.datetime.combine(self.start_date, datetime.time(9, 30), tzinfo=UTC),
+            datetime.datetime.combine(self.start_date, datetime.time(10), tzinfo=UTC),
+            self.providers[0].id,
+        ), computed)
+
+
+# Europe/Berlin moves to summer time on Sunday 2030-03-31
+@mock.patch('booking.bitmaps.materialized_range', return_value=(datetime.date(2030, 3, 25), datetime.date(2030, 4, 7)))
+class BitmapRefreshTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company)
+        self.provider = self.create_provider(
+            'provider@example.com', company, 'Europe/Berlin',
+            [(datetime.time(9), datetime.time(12)), (datetime.time(13), datetime.time(17))],
+        )
+
+    def assertBitmapsMatch(self):
+        first_day, last_day = bitmaps.materialized_range()
+        computed = get_computed_free_intervals(
+            [self.provider.id], load_weekly_windows([self.provider.id]),
+            bitmaps.day_start(first_day), bitmaps.day_start(last_day + datetime.timedelta(days=1)),
+        ).get(self.provider.id, [])
+        stored = bitmaps.load_bitmap_intervals([self.provider.id], first_day, last_day).get(self.provider.id)
+        self.assertEqual(stored, computed)
+
+    def refreshed_days(self, since):
+        return set(AvailabilityBitmap.objects.filter(updated_at__gte=since).values_list('date', flat=True))
+
+    def test_availability_changes(self, materialized_range):
+        bitmaps.rebuild([self.provider.id])
+        self.assertBitmapsMatch()
+        sunday = Availability.objects.get(
+            user=self.provider, day_of_week=Availability.DayOfWeek.SUNDAY, start_time=datetime.time(13),
+        )
+        since = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            sunday.end_time = datetime.time(19)
+            sunday.save()
+        self.assertBitmapsMatch()
+        # local Sundays start on Saturdays in UTC
+        self.assertEqual(self.refreshed_days(since), {
+            datetime.date(2030, 3, 30), datetime.date(2030, 3, 31),
+            datetime.date(2030, 4, 6), datetime.date(2030, 4, 7),
+        })
+        since = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            sunday.day_of_week = Availability.DayOfWeek.MONDAY
+            sunday.save()
+        self.assertBitmapsMatch()
+        self.assertIn(datetime.date(2030, 3, 31), self.refreshed_days(since))
+        self.assertIn(datetime.date(2030, 4, 1), self.refreshed_days(since))
+        with self.captureOnCommitCallbacks(execute=True):
+            Availability.objects.filter(day_of_week=Availability.DayOfWeek.TUESDAY).first().delete()
+        self.assertBitmapsMatch()
+
+    def test_appointment_changes(self, materialized_range):
+        bitmaps.rebuild([self.provider.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            # 10:00 local time on the DST day
+            appointment = book_appointment(self.provider, self.service, utc(2030, 3, 31, 8))
+        self.assertBitmapsMatch()
+        free = bitmaps.load_bitmap_intervals([self.provider.id], datetime.date(2030, 3, 31), datetime.date(2030, 3, 31))
+        self.assertEqual(free[self.provider.id], [
+            (utc(2030, 3, 31, 7), utc(2030, 3, 31, 8)), (utc(2030, 3, 31, 9), utc(2030, 3, 31, 10)),
+            (utc(2030, 3, 31, 11), utc(2030, 3, 31, 15)),
+        ])
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.status = 'canceled'
+            appointment.save()
+        self.assertBitmapsMatch()
+        with self.captureOnCommitCallbacks(execute=True):
+            book_appointment(
+                self.provider, self.service, utc(2030, 3, 26, 14), recurrence='weekly',
+                recurrence_until=utc(2030, 4, 30),
+            )
+        self.assertBitmapsMatch()
+
+    def test_appointment_save_reads_no_previous_row(self, materialized_range):
+        appointment = book_appointment(self.provider, self.service, utc(2030, 3, 26, 8))
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.status = 'confirmed'
+        with CaptureQueriesContext(connection) as queries:
+            appointment.save()
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        self.assertFalse([sql for sql in selects if 'FROM "booking_appointment"' in sql], selects)
+
+    def test_user_and_service_saves_read_no_previous_row(self, materialized_range):
+        provider = AppUser.objects.get(pk=self.provider.pk)
+        service = Service.objects.get(pk=self.service.pk)
+        provider.timezone = 'Europe/London'
+        service.name = 'renamed'
+        with CaptureQueriesContext(connection) as queries:
+            provider.save()
+            service.save()
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        for model in (AppUser, Service):
+            self.assertFalse([sql for sql in selects if 'FROM "{}"'.format(model._meta.db_table) in sql], selects)
+        self.assertEqual(provider._previous_timezone, 'Europe/Berlin')
+        self.assertEqual(service._previous_name, 'service')
+
+
+class BookAppointmentTest(BookingTestMixin, TransactionTestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company)
+        self.provider = self.create_provider('provider@example.com', company)
+
+    def test_overlap_rejected(self):
+        first = book_appointment(self.provider, self.service, utc(2030, 1, 7, 9))
+        self.assertEqual(
+            list(SlotReservation.objects.filter(appointment=first).order_by('slot_start').values_list(
+                'slot_start', flat=True,
+            )),
+            reservation_units(utc(2030, 1, 7, 9), utc(2030, 1, 7, 10)),
+        )
+        with self.assertRaises(SlotUnavailable):
+            book_appointment(self.provider, self.service, utc(2030, 1, 7, 9, 30))
+        self.assertEqual(Appointment.objects.count(), 1)
+        # touching appointments share no unit
+        book_appointment(self.provider, self.service, utc(2030, 1, 7, 10))
+
+    def test_units_of_canceled_appointments_reused(self):
+        first = book_appointment(self.provider, self.service, utc(2030, 1, 7, 9))
+        # a queryset update sends no signal and keeps the reservations
+        Appointment.objects.filter(pk=first.pk).update(status='canceled')
+        self.assertTrue(SlotReservation.objects.filter(appointment=first).exists())
+        second = book_appointment(self.provider, self.service, utc(2030, 1, 7, 9, 30))
+        # only the units the new appointment needs are released
+        self.assertEqual(SlotReservation.objects.filter(appointment=first).count(), 6)
+        self.assertEqual(SlotReservation.objects.filter(appointment=second).count(), 12)
+
+    def test_locked_database_retried(self):
+        bulk_create = QuerySet.bulk_create
+        calls = []
+
+        def locked_once(queryset, *args, **kwargs):
+            calls.append(queryset.model)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return bulk_create(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'bulk_create', autospec=True, side_effect=locked_once), \
+                mock.patch('booking.reservations.time.sleep') as sleep:
+            appointment = book_appointment(self.provider, self.service, utc(2030, 1, 7, 9))
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(list(Appointment.objects.values_list('pk', flat=True)), [appointment.pk])
+        self.assertEqual(SlotReservation.objects.filter(appointment=appointment).count(), 12)
+
+    def test_locked_database_gives_up(self):
+        with mock.patch.object(QuerySet, 'bulk_create', side_effect=OperationalError('database is locked')), \
+                mock.patch('booking.reservations.time.sleep') as sleep:
+            with self.assertRaises(OperationalError):
+                book_appointment(self.provider, self.service, utc(2030, 1, 7, 9))
+        self.assertEqual(sleep.call_count, MAX_BOOKING_ATTEMPTS - 1)
+        self.assertFalse(Appointment.objects.exists())
+
+
+class RecurringBookingTest(BookingTestMixin, TransactionTestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company)
+        self.provider = self.create_provider('provider@example.com', company, windows=[
+            (datetime.time(9), datetime.time(17)),
+        ])
+
+    def book_series(self, start, **kwargs):
+        return book_appointment(self.provider, self.service, start, recurrence='weekly', **kwargs)
+
+    def test_single_on_later_occurrence(self):
+        series = self.book_series(utc(2030, 1, 7, 9))
+        # the third occurrence holds no reservation units
+        with self.assertRaises(SlotUnavailable):
+            book_appointment(self.provider, self.service, utc(2030, 1, 21, 9, 30))
+        skip_occurrence(series, utc(2030, 1, 21, 9))
+        book_appointment(self.provider, self.service, utc(2030, 1, 21, 9, 30))
+        with self.assertRaises(SlotUnavailable):
+            move_occurrence(series, utc(2030, 1, 28, 9), utc(2030, 1, 21, 10))
+
+    def test_series_over_single(self):
+        single = book_appointment(self.provider, self.service, utc(2030, 2, 4, 9, 30))
+        with self.assertRaises(SlotUnavailable):
+            self.book_series(utc(2030, 1, 7, 9))
+        self.assertEqual(list(Appointment.objects.values_list('pk', flat=True)), [single.pk])
+        # ends before the single appointment
+        self.book_series(utc(2030, 1, 7, 9), recurrence_until=utc(2030, 1, 28, 9))
+
+    def test_series_over_series(self):
+        self.book_series(utc(2030, 1, 7, 9), recurrence_until=utc(2030, 6, 1))
+        with self.assertRaises(SlotUnavailable):
+            book_appointment(self.provider, self.service, utc(2030, 1, 1, 9, 30), recurrence='daily')
+        self.book_series(utc(2030, 1, 8, 9))
+
+    def test_occurrences_outside_availability(self):
+        Availability.objects.filter(user=self.provider, day_of_week=Availability.DayOfWeek.SATURDAY).delete()
+        with self.assertRaises(SlotUnavailable):
+            book_appointment(self.provider, self.service, utc(2030, 1, 7, 9), recurrence='daily')
+        self.book_series(utc(2030, 1, 7, 9))
+        api = APIClient()
+        api.force_authenticate(AppUser.objects.create_user(email='customer@example.com', password='secret-password'))
+        response = api.post('/booking/appointments', {
+            'provider': self.provider.id, 'service': self.service.id, 'start': '2030-01-08T15:00:00Z',
+            'recurrence': 'daily',
+        }, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+class WaitlistTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company)
+        self.provider = self.create_provider('provider@example.com', company, windows=[
+            (datetime.time(0), datetime.time(23, 59)),
+        ])
+        self.customers = [
+            AppUser.objects.create_user(email='customer{}@example.com'.format(index), password='secret-password')
+            for index in range(4)
+        ]
+        self.day = datetime.datetime.combine(
+            timezone.now().astimezone(UTC).date() + datetime.timedelta(days=2), datetime.time.min, tzinfo=UTC,
+        )
+
+    def at(self, hour: int) -> datetime.datetime:
+        return self.day + datetime.timedelta(hours=hour)
+
+    def join(self, customer, start_hour, end_hour, priority=0):
+        return WaitlistEntry.objects.create(
+            customer=customer, provider=self.provider, service=self.service, window_start=self.at(start_hour),
+            window_end=self.at(end_hour), priority=priority,
+        )
+
+    def test_freed_time_offered_by_priority(self):
+        booked = [book_appointment(self.provider, self.service, self.at(hour)) for hour in (9, 10)]
+        oldest = self.join(self.customers[0], 8, 12)
+        urgent = self.join(self.customers[1], 9, 11, priority=5)
+        too_late = self.join(self.customers[2], 11, 13)
+        newest = self.join(self.customers[3], 8, 12)
+        canceled, offered = cancel_appointments(Appointment.objects.filter(pk__in=[booked[0].pk, booked[1].pk]))
+        self.assertEqual(canceled, 2)
+        # both canceled hours form one freed range: the urgent entry gets its first hour, the oldest the next one
+        self.assertEqual(
+            sorted((appointment.customer_id, appointment.appointment_date) for appointment in offered),
+            sorted([(self.customers[1].id, self.at(9)), (self.customers[0].id, self.at(10))]),
+        )
+        statuses = dict(WaitlistEntry.objects.values_list('id', 'status'))
+        self.assertEqual(statuses, {
+            oldest.id: 'offered', urgent.id: 'offered', too_late.id: 'waiting', newest.id: 'waiting',
+        })
+        self.assertFalse(SlotReservation.objects.filter(appointment__in=booked).exists())
+
+    def test_only_upcoming_appointments_canceled(self):
+        upcoming = book_appointment(self.provider, self.service, self.at(9))
+        completed = book_appointment(self.provider, self.service, self.at(10))
+        Appointment.objects.filter(pk=completed.pk).update(status='completed')
+        past = Appointment.objects.create(
+            provider=self.provider, service=self.service, appointment_date=self.at(-72),
+            end_date=self.at(-71), status='completed',
+        )
+        self.join(self.customers[0], -72, 12)
+        canceled, offered = cancel_appointments(Appointment.objects.filter(provider=self.provider))
+        self.assertEqual(canceled, 1)
+        self.assertEqual([appointment.appointment_date for appointment in offered], [self.at(9)])
+        self.assertEqual(dict(Appointment.objects.filter(pk__in=[upcoming.pk, completed.pk, past.pk]).values_list(
+            'id', 'status',
+        )), {upcoming.pk: 'canceled', completed.pk: 'completed', past.pk: 'completed'})
+
+    def test_canceled_appointment_offered_on_commit(self):
+        appointment = book_appointment(self.provider, self.service, self.at(9))
+        entry = self.join(self.customers[0], 9, 10)
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.status = 'canceled'
+            appointment.save()
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, 'offered')
+        self.assertEqual(entry.appointment.appointment_date, self.at(9))
+        self.assertEqual(entry.appointment.customer, self.customers[0])
+
+
+class FeedTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company, name='Haircut')
+        self.provider = self.create_provider('provider@example.com', company, 'Europe/Berlin')
+        self.api = APIClient()
+        self.api.force_authenticate(self.provider)
+        start = timezone.now().replace(microsecond=0) + datetime.timedelta(days=1)
+        Appointment.objects.create(provider=self.provider, service=self.service, appointment_date=start)
+        self.series = Appointment.objects.create(
+            provider=self.provider, service=self.service, appointment_date=utc(2030, 1, 7, 8), recurrence='weekly',
+        )
+        AppointmentException.objects.create(appointment=self.series, original_start=utc(2030, 1, 14, 8))
+
+    def get_feed(self, url=None, **headers):
+        url = url or self.api.get('/booking/feeds').json()['provider']
+        response = self.api.get(url, **headers)
+        if response.status_code == 200:
+            response.text = b''.join(response.streaming_content).decode()
+        return response
+
+    def test_timezones(self):
+        text = self.get_feed().text
+        self.assertEqual(text.count('BEGIN:VTIMEZONE'), 1)
+        self.assertIn('TZID:Europe/Berlin\r\n', text)
+        # the 2030 change to summer time happens at 01:00 UTC, 02:00 of winter time
+        self.assertIn(
+            'BEGIN:DAYLIGHT\r\nDTSTART:20300331T020000\r\nTZOFFSETFROM:+0100\r\nTZOFFSETTO:+0200\r\n'
+            'TZNAME:CEST\r\nEND:DAYLIGHT\r\n', text,
+        )
+        self.assertIn('DTSTART;TZID=Europe/Berlin:20300107T090000\r\n', text)
+        self.assertIn('EXDATE;TZID=Europe/Berlin:20300114T090000\r\n', text)
+        # components of the calendar come before the events using them
+        self.assertLess(text.index('END:VTIMEZONE'), text.index('BEGIN:VEVENT'))
+        self.assertEqual(text.count('BEGIN:VEVENT'), 2)
+
+    def test_conditional_get(self):
+        response = self.get_feed()
+        self.assertEqual(response.status_code, 200)
+        url = self.api.get('/booking/feeds').json()['provider']
+        self.assertEqual(self.get_feed(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        feeds.bump_feed_versions([feeds.provider_feed_key(self.provider.id)])
+        self.assertEqual(self.get_feed(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_token_rotation(self):
+        url = self.api.get('/booking/feeds').json()['provider']
+        path = url.split('?')[0]
+        legacy_token = signing.dumps(feeds.provider_feed_key(self.provider.id), salt=feeds.FEED_SALT, compress=True)
+        self.assertEqual(self.get_feed(url).status_code, 200)
+        self.assertEqual(self.get_feed('{}?token={}'.format(path, legacy_token)).status_code, 200)
+        self.assertEqual(self.get_feed(path).status_code, 403)
+        response = self.api.post('/booking/feeds')
+        self.assertEqual(response.status_code, 200)
+        new_url = response.json()['provider']
+        self.assertNotEqual(new_url, url)
+        self.assertEqual(self.get_feed(url).status_code, 403)
+        self.assertEqual(self.get_feed('{}?token={}'.format(path, legacy_token)).status_code, 403)
+        self.assertEqual(self.get_feed(new_url).status_code, 200)
+        other = self.create_client('other')
+        self.assertEqual(self.api.post('/booking/feeds', {'client': other.id}).status_code, 403)
+
+
+class ImportExportTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company)
+        self.other_service = self.create_service(self.create_client('other'))
+        self.provider = self.create_provider('provider@example.com', company)
+        self.stranger = AppUser.objects.create_user(email='stranger@example.com', password='secret-password')
+        self.manager = AppUser.objects.create_user(email='manager@example.com', password='secret-password')
+        UserToClient.objects.create(user=self.manager, client=company)
+        self.api = APIClient()
+        self.api.force_authenticate(self.manager)
+
+    def import_rows(self, kind, content_type, body):
+        response = self.api.post('/booking/import/{}'.format(kind), body.encode(), content_type=content_type)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def export_rows(self, kind, file_format):
+        response = self.api.get('/booking/export/{}.{}'.format(kind, file_format))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_availability(self):
+        rows = [
+            {'provider': self.provider.id, 'day_of_week': 'monday', 'start_time': '09:00', 'end_time': '17:00'},
+            {'provider': self.provider.id, 'day_of_week': 3, 'start_time': '09:00', 'end_time': '12:00'},
+            {'provider': self.provider.id, 'day_of_week': 9, 'start_time': '09:00', 'end_time': '12:00'},
+            {'provider': self.stranger.id, 'day_of_week': 2, 'start_time': '09:00', 'end_time': '12:00'},
+        ]
+        result = self.import_rows(
+            'availability', 'application/x-ndjson', ''.join(json.dumps(row) + '\n' for row in rows),
+        )
+        self.assertEqual(result['created'], 2)
+        self.assertEqual([error['line'] for error in result['errors']], [3, 4])
+        exported = [json.loads(line) for line in self.export_rows('availability', 'ndjson').splitlines()]
+        self.assertEqual(
+            sorted((row['day_of_week'], row['start_time'], row['end_time']) for row in exported),
+            [(2, '09:00:00', '17:00:00'), (3, '09:00:00', '12:00:00')],
+        )
+
+    def test_appointments(self):
+        body = '\n'.join([
+            'provider,service,start,end,status',
+            '{p},{s},2030-01-07T09:00:00Z,,pending',
+            '{p},{s},2030-01-07T09:30:00Z,,pending',
+            '{p},{s},2030-01-07T09:30:00Z,,canceled',
+            '{p},{o},2030-01-08T09:00:00Z,,pending',
+            '{p},{s},2030-01-09T09:00:00Z,2030-01-10T10:00:00Z,pending',
+            '{p},{s},2020-01-07T09:00:00Z,,completed',
+        ]).format(p=self.provider.id, s=self.service.id, o=self.other_service.id)
+        result = self.import_rows('appointments', 'text/csv', body)
+        self.assertEqual(result['created'], 3)
+        self.assertEqual(
+            [(error['line'], error['error']) for error in result['errors']],
+            [
+                (3, 'Overlaps another appointment of provider {}'.format(self.provider.id)),
+                (5, 'Service {} is not offered by a client of provider {}'.format(
+                    self.other_service.id, self.provider.id,
+                )),
+                (6, 'appointments cannot be longer than 1 day, 0:00:00'),
+            ],
+        )
+        self.assertEqual(SlotReservation.objects.count(), 24)
+        # time held by imported appointments can't be booked or imported again
+        with self.assertRaises(SlotUnavailable):
+            book_appointment(self.provider, self.service, utc(2030, 1, 7, 9, 30))
+        result = self.import_rows('appointments', 'text/csv', body)
+        self.assertEqual(result['created'], 1)
+        lines = self.export_rows('appointments', 'csv').splitlines()
+        self.assertEqual(lines[0], ','.join(bulk.APPOINTMENT_FIELDS))
+        self.assertEqual(len(lines), 5)
+
+    def test_preload_bounded(self):
+        body = '\n'.join(['provider,service,start'] + [
+            '{},{},{}-01-07T09:00:00Z'.format(self.provider.id, self.service.id, year) for year in (2020, 2030)
+        ])
+        with mock.patch('booking.bulk.load_recurring_intervals', return_value={}) as load:
+            result = self.import_rows('appointments', 'text/csv', body)
+        self.assertEqual(result['created'], 2)
+        # one range per distant row instead of the decade between them
+        self.assertEqual([call.args[1:3] for call in load.call_args_list], [
+            (utc(2020, 1, 7, 9), utc(2020, 1, 7, 10)), (utc(2030, 1, 7, 9), utc(2030, 1, 7, 10)),
+        ])
+
+
+class AppointmentRangeTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        company = self.create_client('company')
+        self.service = self.create_service(company)
+        self.provider = self.create_provider('provider@example.com', company)
+        starts = [utc(2030, 1, 7, hour) for hour in (9, 9, 9, 10, 11, 12)] + [utc(2030, 1, 6, 9), utc(2030, 1, 8, 9)]
+        Appointment.objects.bulk_create([
+            Appointment(
+                id=index + 1, provider=self.provider, service=self.service, appointment_date=start,
+                end_date=start + datetime.timedelta(hours=1),
+            ) for index, start in enumerate(starts)
+        ])
+        self.api = APIClient()
+        self.api.force_authenticate(self.provider)
+
+    def get(self, **params):
+        return self.api.get('/booking/appointments', dict(
+            {'provider': self.provider.id, 'from': '2030-01-07T00:00:00Z', 'to': '2030-01-08T00:00:00Z'}, **params
+        ))
+
+    def get_page(self, **params):
+        response = self.get(**params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_pages(self):
+        ids, cursor = [], None
+        for _ in range(3):
+            page = self.get_page(limit=2, **({'cursor': cursor} if cursor else {}))
+            ids.extend(appointment['id'] for appointment in page['appointments'])
+            cursor = page['next']
+        # appointments starting at the same time are ordered by id and never repeated across pages
+        self.assertEqual(ids, [1, 2, 3, 4, 5, 6])
+        self.assertIsNone(cursor)
+
+    def test_permissions_and_cursor(self):
+        self.assertEqual(self.get(cursor='invalid').status_code, 400)
+        other = AppUser.objects.create_user(email='other@example.com', password='secret-password')
+        self.api.force_authenticate(other)
+        self.assertEqual(self.get().status_code, 403)
+
+
+class BookingLimitsTest(BookingTestMixin, TestCase):
+    def test_longer_than_a_day(self):
+        company = self.create_client('company')
+        provider = self.create_provider('provider@example.com', company)
+        customer = AppUser.objects.create_user(email='customer@example.com', password='secret-password')
+        api = APIClient()
+        api.force_authenticate(customer)
+        service = self.create_service(company, duration=24 * 60 + 5)
+        response = api.post('/booking/appointments', {
+            'provider': provider.id, 'service': service.id, 'start': '2030-01-07T09:00:00Z',
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('service', response.json())
+
+    def test_unaligned_start(self):
+        company = self.create_client('company')
+        provider = self.create_provider('provider@example.com', company, windows=[
+            (datetime.time(0), datetime.time(23, 59)),
+        ])
+        customer = AppUser.objects.create_user(email='customer@example.com', password='secret-password')
+        api = APIClient()
+        api.force_authenticate(customer)
+        service = self.create_service(company, duration=7)
+        day = timezone.now().astimezone(UTC).date() + datetime.timedelta(days=2)
+
+        def book(hour, minute):
+            return api.post('/booking/appointments', {
+                'provider': provider.id, 'service': service.id,
+                'start': datetime.datetime.combine(day, datetime.time(hour, minute), tzinfo=UTC).isoformat(),
+            }, format='json')
+
+        response = book(10, 7)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('start', response.json())
+        # the first appointment ends within the 10:05 unit, the next one starts in the following unit
+        self.assertEqual(book(10, 0).status_code, 201)
+        self.assertEqual(book(10, 10).status_code, 201)
+        self.assertEqual(book(10, 5).status_code, 409)
+
+
+class BookingPermissionsTest(BookingTestMixin, TestCase):
+    def setUp(self):
+        self.company = self.create_client('company')
+        self.provider = self.create_provider('provider@example.com', self.company, windows=[
+            (datetime.time(0), datetime.time(23, 59)),
+        ])
+        self.outsider = self.create_provider('outsider@example.com', self.create_client('other'), windows=[
+            (datetime.time(0), datetime.time(23, 59)),
+        ])
+        self.customer = AppUser.objects.create_user(email='customer@example.com', password='secret-password')
+        self.api = APIClient()
+        self.api.force_authenticate(self.customer)
+        self.start = datetime.datetime.combine(
+            timezone.now().astimezone(UTC).date() + datetime.timedelta(days=2), datetime.time(9), tzinfo=UTC,
+        )
+
+    def book(self, provider, service):
+        return self.api.post('/booking/appointments', {
+            'provider': provider.id, 'service': service.id, 'start': self.start.isoformat(),
+        }, format='json')
+
+    def test_provider_of_another_client(self):
+        service = self.create_service(self.company)
+        response = self.book(self.outsider, service)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('provider', response.json())
+        response = self.api.post('/booking/waitlist', {
+            'provider': self.outsider.id, 'service': service.id,
+            'window_start': self.start.isoformat(),
+            'window_end': (self.start + datetime.timedelta(hours=2)).isoformat(),
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('provider', response.json())
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_private_service(self):
+        service = Service.objects.create(name='private', duration=60, client=self.company, access=Service.PRIVATE)
+        self.assertEqual(self.book(self.provider, service).status_code, 403)
+        UserToClient.objects.create(user=self.customer, client=self.company)
+        self.assertEqual(self.book(self.provider, service).status_code, 201)
+        self.assertEqual(self.book(self.provider, self.create_service(self.company)).status_code, 409)
+
+    def test_slot_search(self):
+        service = self.create_service(self.company)
+        params = {
+            'provider': self.provider.id, 'service': service.id, 'start_date': self.start.date().isoformat(),
+            'end_date': (self.start.date() + datetime.timedelta(days=6)).isoformat(),
+        }
+        self.assertEqual(self.api.get('/booking/slots', dict(params, provider=self.outsider.id)).status_code, 400)
+        self.assertEqual(self.api.get('/booking/slots', dict(params, step=1)).status_code, 400)
+        private = Service.objects.create(name='private', duration=60, client=self.company, access=Service.PRIVATE)
+        self.assertEqual(self.api.get('/booking/slots', dict(params, service=private.id)).status_code, 403)
+        response = self.api.get('/booking/slots', dict(params, step=5)).json()
+        self.assertEqual(len(response['slots']), 1000)
+        self.assertTrue(response['truncated'])
+        self.assertFalse(self.api.get('/booking/slots', params).json()['truncated'])
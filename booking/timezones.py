@@ -0,0 +1,122 @@
+"""
+Provider timezones.
+
+Availability windows and recurring appointments are defined in the provider's local time. Converting every window
+or occurrence through ``zoneinfo`` is slow, so the UTC offsets of a zone are computed once per year as a table of
+DST transitions, cached per zone and year, and conversions are a bisect in that table.
+"""
+import bisect
+import datetime
+import zoneinfo
+from functools import lru_cache
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+
+UTC = datetime.timezone.utc
+ONE_DAY = datetime.timedelta(days=1)
+
+
+class TransitionTable(NamedTuple):
+    # naive UTC instants at which the offset changes
+    utc_transitions: List[datetime.datetime]
+    # naive local times from which the offset after the transition applies, gaps and folds map to the earlier
+    # offset like ``fold=0`` does
+    local_transitions: List[datetime.datetime]
+    # offsets[i] applies before transition i, the last one after all transitions of the year
+    offsets: List[datetime.timedelta]
+
+
+def default_timezone_name() -> str:
+    return settings.TIME_ZONE or 'UTC'
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: str) -> datetime.tzinfo:
+    """Return the zone of a provider, the default timezone when unknown."""
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return zoneinfo.ZoneInfo(default_timezone_name())
+
+
+@lru_cache(maxsize=4096)
+def transition_table(name: str, year: int) -> TransitionTable:
+    """Find the offset changes of a zone within a year by sampling every day and bisecting the changed ones."""
+    zone = get_zone(name)
+
+    def offset_at(instant: datetime.datetime) -> datetime.timedelta:
+        return instant.replace(tzinfo=UTC).astimezone(zone).utcoffset()
+
+    utc_transitions, local_transitions = [], []
+    offsets = [offset_at(datetime.datetime(year, 1, 1))]
+    day = datetime.datetime(year, 1, 1)
+    while day.year == year:
+        next_day = day + ONE_DAY
+        next_offset = offset_at(next_day)
+        if next_offset != offsets[-1]:
+            # transitions happen on whole seconds, the offset at low is the old one and at high the new one
+            low, high = 0, int(ONE_DAY.total_seconds())
+            while high - low > 1:
+                middle = (low + high) // 2
+                if offset_at(day + datetime.timedelta(seconds=middle)) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            transition = day + datetime.timedelta(seconds=high)
+            utc_transitions.append(transition)
+            local_transitions.append(transition + max(offsets[-1], next_offset))
+            offsets.append(next_offset)
+        day = next_day
+    return TransitionTable(utc_transitions, local_transitions, offsets)
+
+
+def to_utc(local: datetime.datetime, name: str) -> datetime.datetime:
+    """Convert a naive local time of a zone to an aware UTC datetime."""
+    table = transition_table(name or default_timezone_name(), local.year)
+    offset = table.offsets[bisect.bisect_right(table.local_transitions, local)]
+    return (local - offset).replace(tzinfo=UTC)
+
+
+def to_local(instant: datetime.datetime, name: str) -> datetime.datetime:
+    """Convert an aware datetime to a naive local time of a zone."""
+    utc = instant.astimezone(UTC).replace(tzinfo=None)
+    table = transition_table(name or default_timezone_name(), utc.year)
+    return utc + table.offsets[bisect.bisect_right(table.utc_transitions, utc)]
+
+
+class LocalClock:
+    """
+    Converts local times of one zone to UTC, caching the offset of the period between two transitions.
+    Consecutive conversions, like the windows of a day range, mostly cost a comparison and a subtraction.
+    """
+
+    def __init__(self, name: str):
+        self.name = name or default_timezone_name()
+        self.offset = datetime.timedelta()
+        self.lower = self.upper = None  # type: datetime.datetime
+
+    def to_utc(self, local: datetime.datetime) -> datetime.datetime:
+        if self.lower is None or not self.lower <= local < self.upper:
+            self.seek(local)
+        return (local - self.offset).replace(tzinfo=UTC)
+
+    def utc_origin(self, start: datetime.datetime, end: datetime.datetime) -> Optional[datetime.datetime]:
+        """
+        Return ``start`` in UTC when the whole ``[start, end)`` local range has the same offset, None otherwise.
+        Times within the range then convert by adding their distance from ``start``.
+        """
+        origin = self.to_utc(start)
+        if end <= self.upper:
+            return origin
+        return None
+
+    def seek(self, local: datetime.datetime):
+        table = transition_table(self.name, local.year)
+        index = bisect.bisect_right(table.local_transitions, local)
+        self.offset = table.offsets[index]
+        self.lower = table.local_transitions[index - 1] if index else datetime.datetime(local.year, 1, 1)
+        if index < len(table.local_transitions):
+            self.upper = table.local_transitions[index]
+        else:
+            self.upper = datetime.datetime(local.year + 1, 1, 1)
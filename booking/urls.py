@@ -1,9 +1,25 @@
-from django.urls import path
+from django.urls import path, re_path
 
 from . import views
 
 app_name = "bookings"
 
 urlpatterns = [
-    path('', views.index, name='index')
-]
\ No newline at end of file
+    path('', views.index, name='index'),
+    path('slots', views.available_slots, name='slots'),
+    path('slots/earliest', views.earliest_slots, name='earliest-slots'),
+    path('appointments', views.appointments, name='appointments'),
+    path('appointments/cancel', views.cancel_schedule, name='cancel-schedule'),
+    path(
+        'appointments/<int:appointment_id>/exceptions', views.occurrence_exceptions, name='occurrence-exceptions',
+    ),
+    path('waitlist', views.waitlist, name='waitlist'),
+    re_path(r'^import/(?P<kind>availability|appointments)$', views.import_schedule, name='import-schedule'),
+    re_path(
+        r'^export/(?P<kind>availability|appointments)\.(?P<file_format>csv|ndjson)$', views.export_schedule,
+        name='export-schedule',
+    ),
+    path('feeds', views.feed_urls, name='feeds'),
+    path('feeds/provider/<int:provider_id>.ics', views.provider_feed, name='provider-feed'),
+    path('feeds/client/<int:client_id>.ics', views.client_feed, name='client-feed'),
+]
@@ -1,5 +1,348 @@
-from django.http import HttpResponse
+import datetime
+import io
+
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import permissions
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.views import Response
+
+from booking import bulk, feeds
+from booking.bitmaps import day_start
+from booking.models import Appointment, WaitlistEntry
+from booking.reservations import (
+    SlotUnavailable, book_appointment, fits_free_time, is_occurrence, move_occurrence, skip_occurrence,
+)
+from booking.schedule import get_appointments_page
+from booking.serializers import (
+    MAX_SEARCH_SLOTS, AppointmentRangeSerializer, AppointmentSerializer, BookAppointmentSerializer,
+    CancelScheduleSerializer, EarliestSlotSearchSerializer, JoinWaitlistSerializer, OccurrenceExceptionSerializer,
+    RotateFeedSerializer, ScheduleExportSerializer, ScheduleImportSerializer, SlotSearchSerializer,
+    WaitlistEntrySerializer,
+)
+from booking.waitlist import cancel_appointments
+from booking.slots import find_earliest_slots, get_free_slots
+from core.exceptions import APIBadRequest, APIConflict
+from core.models.models import UserToClient
+from core.services.models import Service
 
 
 def index(request):
-    return HttpResponse("Hello, world. You're at the bookings index.")
\ No newline at end of file
+    return HttpResponse("Hello, world. You're at the bookings index.")
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def available_slots(request):
+    serializer = SlotSearchSerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    # the serializer checked that the provider belongs to the client offering the service
+    if not can_book_service(request.user, data['service']):
+        raise PermissionDenied()
+    step = datetime.timedelta(minutes=data['step']) if data['step'] else None
+    slots = get_free_slots(
+        provider=data['provider'],
+        service=data['service'],
+        start_date=data['start_date'],
+        end_date=data['end_date'],
+        step=step,
+        not_before=timezone.now(),
+        limit=MAX_SEARCH_SLOTS + 1,
+    )
+    return Response({
+        'slots': [{'start': start, 'end': end} for start, end in slots[:MAX_SEARCH_SLOTS]],
+        # more slots follow the last one returned, search again from its date
+        'truncated': len(slots) > MAX_SEARCH_SLOTS,
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def earliest_slots(request):
+    serializer = EarliestSlotSearchSerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    if not can_search_client(request.user, data['client'], data['service']):
+        raise PermissionDenied()
+    now = timezone.now()
+    provider_ids = UserToClient.objects.filter(client=data['client'], invitation=False).values('user_id')
+    step = datetime.timedelta(minutes=data['step']) if data['step'] else None
+    slots = find_earliest_slots(
+        provider_ids=provider_ids,
+        service=data['service'],
+        start_date=data['start_date'] or timezone.localdate(now),
+        limit=data['limit'],
+        max_days=data['days'],
+        per_provider_limit=data['per_provider_limit'],
+        step=step,
+        not_before=now,
+    )
+    return Response({
+        'slots': [{'start': start, 'end': end, 'provider': provider_id} for start, end, provider_id in slots],
+    })
+
+
+def can_view_schedule(user, provider=None, service=None) -> bool:
+    """Staff see every schedule, other users their own and the ones of the clients they manage."""
+    if user.is_admin:
+        return True
+    if provider is not None and provider.pk != user.pk and not UserToClient.objects.filter(
+            client__in=user.managed_clients, user=provider, invitation=False,
+    ).exists():
+        return False
+    if service is not None and not user.managed_clients.filter(id=service.client_id).exists():
+        return False
+    return True
+
+
+def can_search_client(user, client, service) -> bool:
+    """Everyone searches the providers of the client offering a service, staff and managers those of any client."""
+    if user.is_admin or client.pk == service.client_id:
+        return True
+    return user.managed_clients.filter(id=client.pk).exists()
+
+
+def can_book_service(user, service) -> bool:
+    """Everyone books public services, private ones are booked by staff and the managers of their client."""
+    if user.is_admin or str(service.access) == str(Service.PUBLIC):
+        return True
+    return user.managed_clients.filter(id=service.client_id).exists()
+
+
+def manageable_provider_ids(user):
+    """Return ids of the providers whose schedule a user may import or export, None for all."""
+    if user.is_admin:
+        return None
+    provider_ids = set(UserToClient.objects.filter(
+        client__in=user.managed_clients, invitation=False,
+    ).values_list('user_id', flat=True))
+    provider_ids.add(user.pk)
+    return provider_ids
+
+
+def list_appointments(request):
+    serializer = AppointmentRangeSerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    if not can_view_schedule(request.user, provider=data['provider'], service=data['service']):
+        raise PermissionDenied()
+    queryset = Appointment.objects.all()
+    if data['provider'] is not None:
+        queryset = queryset.filter(provider=data['provider'])
+    if data['service'] is not None:
+        queryset = queryset.filter(service=data['service'])
+    page, next_cursor = get_appointments_page(
+        queryset, start=data['from'], end=data['to'], cursor=data['cursor'], limit=data['limit'],
+    )
+    return Response({
+        'appointments': AppointmentSerializer(instance=page, many=True).data,
+        'next': next_cursor,
+    })
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([permissions.IsAuthenticated])
+def appointments(request):
+    if request.method == 'GET':
+        return list_appointments(request)
+
+    serializer = BookAppointmentSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    if not can_book_service(request.user, data['service']):
+        raise PermissionDenied()
+    start = data['start']
+    end = start + datetime.timedelta(minutes=data['service'].duration)
+    if not fits_free_time(data['provider'], start, end):
+        raise APIConflict(_('The requested time is not available.'))
+    try:
+        appointment = book_appointment(
+            provider=data['provider'],
+            service=data['service'],
+            start=start,
+            customer=request.user,
+            notes=data['notes'],
+            recurrence=data['recurrence'],
+            recurrence_interval=data['recurrence_interval'],
+            recurrence_until=data['recurrence_until'],
+        )
+    except SlotUnavailable:
+        raise APIConflict(_('The requested time is not available.'))
+    return Response(AppointmentSerializer(instance=appointment).data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def occurrence_exceptions(request, appointment_id):
+    appointment = get_object_or_404(Appointment, id=appointment_id)
+    if not request.user.is_admin and request.user.pk not in (appointment.provider_id, appointment.customer_id):
+        raise PermissionDenied()
+    serializer = OccurrenceExceptionSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    if not appointment.is_recurring or not is_occurrence(appointment, data['original_start']):
+        raise APIBadRequest(_('The appointment has no occurrence at that time.'))
+    if data['new_start'] is None:
+        exception = skip_occurrence(appointment, data['original_start'])
+    else:
+        try:
+            exception = move_occurrence(appointment, data['original_start'], data['new_start'])
+        except SlotUnavailable:
+            raise APIConflict(_('The requested time is not available.'))
+    return Response({
+        'original_start': exception.original_start,
+        'new_start': exception.new_start,
+        'new_end': exception.new_end,
+    })
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def cancel_schedule(request):
+    """Cancel all appointments of a provider within a range, e.g. when the provider is sick."""
+    serializer = CancelScheduleSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    if not request.user.is_admin and data['provider'].pk != request.user.pk:
+        raise PermissionDenied()
+    canceled, offered = cancel_appointments(Appointment.objects.filter(
+        provider=data['provider'], appointment_date__gte=data['start'], appointment_date__lt=data['end'],
+    ))
+    return Response({'canceled': canceled, 'offered': len(offered)})
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([permissions.IsAuthenticated])
+def waitlist(request):
+    if request.method == 'GET':
+        entries = WaitlistEntry.objects.filter(customer=request.user).exclude(status='canceled').order_by(
+            'window_start',
+        )
+        return Response({'entries': WaitlistEntrySerializer(instance=entries, many=True).data})
+
+    serializer = JoinWaitlistSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    if not can_book_service(request.user, serializer.validated_data['service']):
+        raise PermissionDenied()
+    entry = WaitlistEntry.objects.create(customer=request.user, **serializer.validated_data)
+    return Response(WaitlistEntrySerializer(instance=entry).data, status=status.HTTP_201_CREATED)
+
+
+def feed_response(request, key: str):
+    version, updated_at, token_version = feeds.get_feed_version(key)
+    if not feeds.is_valid_feed_token(request.GET.get('token'), key, token_version):
+        return HttpResponseForbidden()
+    today = timezone.now().astimezone(datetime.timezone.utc).date()
+    # the feed also changes daily when old appointments leave its window
+    stamp = max(updated_at, day_start(today)) if updated_at else day_start(today)
+    etag = feeds.feed_etag(key, version, today)
+    last_modified = int(stamp.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = StreamingHttpResponse(
+            feeds.iter_feed(key, 'Appointments', stamp), content_type='text/calendar; charset=utf-8',
+        )
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@require_GET
+def provider_feed(request, provider_id):
+    return feed_response(request, feeds.provider_feed_key(provider_id))
+
+
+@require_GET
+def client_feed(request, client_id):
+    return feed_response(request, feeds.client_feed_key(client_id))
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([permissions.IsAuthenticated])
+def feed_urls(request):
+    """Return the feed URLs of the user, a POST first revokes the URLs of their own feed or of a client's feed."""
+    client_ids = list(request.user.managed_clients.values_list('id', flat=True))
+    if request.method == 'POST':
+        serializer = RotateFeedSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        client = serializer.validated_data['client']
+        if client is not None and client.id not in client_ids:
+            raise PermissionDenied()
+        feeds.rotate_feed_tokens([
+            feeds.client_feed_key(client.id) if client is not None else feeds.provider_feed_key(request.user.id),
+        ])
+    provider_key = feeds.provider_feed_key(request.user.id)
+    token_versions = feeds.get_token_versions(
+        [provider_key] + [feeds.client_feed_key(client_id) for client_id in client_ids],
+    )
+
+    def feed_url(view_name, key, object_id):
+        url = reverse(view_name, kwargs={'{}_id'.format(key.split(':')[0]): object_id})
+        token = feeds.sign_feed_key(key, token_versions[key])
+        return request.build_absolute_uri('{}?token={}'.format(url, token))
+
+    return Response({
+        'provider': feed_url('bookings:provider-feed', provider_key, request.user.id),
+        'clients': [
+            {'id': client_id, 'url': feed_url('bookings:client-feed', feeds.client_feed_key(client_id), client_id)}
+            for client_id in client_ids
+        ],
+    })
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def import_schedule(request, kind):
+    """Import availability or appointments from a CSV (text/csv) or NDJSON (application/x-ndjson) request body."""
+    serializer = ScheduleImportSerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    content_type = request.content_type.split(';')[0].strip()
+    file_format = next(
+        (name for name, value in bulk.CONTENT_TYPES.items() if value.split(';')[0] == content_type), None,
+    )
+    if file_format is None:
+        raise APIBadRequest(_('Send text/csv or application/x-ndjson content.'))
+    # the body is read incrementally, request.data would load all of it
+    stream = request.stream or io.BytesIO()
+    result = bulk.import_rows(
+        kind, stream, file_format, allowed_provider_ids=manageable_provider_ids(request.user),
+        batch_size=serializer.validated_data['batch_size'],
+    )
+    return Response(result.to_dict())
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def export_schedule(request, kind, file_format):
+    serializer = ScheduleExportSerializer(data=request.query_params)
+    serializer.is_valid(raise_exception=True)
+    client = serializer.validated_data['client']
+
+    provider_ids = manageable_provider_ids(request.user)
+    if client is not None:
+        if not request.user.is_admin and not request.user.managed_clients.filter(id=client.id).exists():
+            raise PermissionDenied()
+        provider_ids = set(UserToClient.objects.filter(
+            client=client, invitation=False,
+        ).values_list('user_id', flat=True))
+    response = StreamingHttpResponse(
+        bulk.export_rows(kind, file_format, provider_ids), content_type=bulk.CONTENT_TYPES[file_format],
+    )
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(kind, file_format)
+    return response
@@ -0,0 +1,205 @@
+"""
+Waitlist matching.
+
+Time freed by canceled appointments is offered to ``WaitlistEntry`` rows waiting for the provider. Entries
+overlapping a batch of freed time are loaded with one indexed query and pushed into one heap per provider and
+(UTC) day, ordered by priority and then creation time. Each freed slot is matched by popping the best candidates of
+its heap, so a burst of cancellations, like a provider canceling a whole day, doesn't scan the waitlist again for
+every appointment.
+"""
+import datetime
+import heapq
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from booking import bitmaps, feeds
+from booking.models import Appointment, SlotReservation, WaitlistEntry
+from booking.reservations import SlotUnavailable, book_appointment, fits_free_time
+from booking.slots import align_to_unit, merge_intervals
+
+LOG = logging.getLogger(__name__)
+
+# provider id, start and end of the freed time
+FreedSlot = Tuple[int, datetime.datetime, datetime.datetime]
+QueueItem = Tuple[Tuple, WaitlistEntry]
+DayPart = Tuple[datetime.date, datetime.datetime, datetime.datetime]
+
+ONE_DAY = datetime.timedelta(days=1)
+# statuses of appointments whose time can still be given back
+CANCELABLE_STATUSES = ('pending', 'confirmed')
+
+
+def entry_rank(entry: WaitlistEntry) -> Tuple:
+    """Heap key of an entry: higher priority first, then the oldest, the id breaks remaining ties."""
+    return -entry.priority, entry.created_at, entry.id
+
+
+def split_by_day(start: datetime.datetime, end: datetime.datetime) -> List[DayPart]:
+    """Split a range at UTC midnights into ``(day, start, end)`` parts."""
+    parts = []
+    while start < end:
+        day = start.astimezone(datetime.timezone.utc).date()
+        part_end = min(end, bitmaps.day_start(day + ONE_DAY))
+        parts.append((day, start, part_end))
+        start = part_end
+    return parts
+
+
+def build_queues(
+        entries: Iterable[WaitlistEntry], provider_days: Dict[int, set],
+) -> Dict[Tuple[int, datetime.date], List[QueueItem]]:
+    """Push every entry into the heap of each freed day of its provider that its window overlaps."""
+    queues = defaultdict(list)
+    for entry in entries:
+        for day in provider_days.get(entry.provider_id, ()):
+            if entry.window_start < bitmaps.day_start(day + ONE_DAY) and entry.window_end > bitmaps.day_start(day):
+                queues[(entry.provider_id, day)].append((entry_rank(entry), entry))
+    for queue in queues.values():
+        heapq.heapify(queue)
+    return queues
+
+
+def offer(entry: WaitlistEntry, start: datetime.datetime, using: Optional[str] = None) -> Optional[Appointment]:
+    """
+    Book an appointment for a waiting entry. The entry is claimed first so concurrent matchers never offer it twice.
+    :return: the appointment, None when the entry was taken or the time is not available
+    """
+    end = start + datetime.timedelta(minutes=entry.service.duration)
+    if not WaitlistEntry.objects.using(using).filter(id=entry.id, status='waiting').update(status='offered'):
+        return None
+    appointment = None
+    if fits_free_time(entry.provider, start, end, using=using):
+        try:
+            appointment = book_appointment(entry.provider, entry.service, start, customer=entry.customer, using=using)
+        except SlotUnavailable:
+            pass
+    if appointment is None:
+        WaitlistEntry.objects.using(using).filter(id=entry.id).update(status='waiting')
+        return None
+    entry.status, entry.appointment = 'offered', appointment
+    WaitlistEntry.objects.using(using).filter(id=entry.id).update(appointment=appointment)
+    return appointment
+
+
+def offer_slot(
+        queue: List[QueueItem], start: datetime.datetime, end: datetime.datetime, offered: set,
+        not_before: datetime.datetime, using: Optional[str] = None,
+) -> Optional[Appointment]:
+    """
+    Offer freed time to the best entry of a heap that fits in it. Entries that don't fit are pushed back, entries
+    already offered from the heap of another day are dropped.
+    """
+    skipped = []
+    appointment = None
+    while queue:
+        item = heapq.heappop(queue)
+        entry = item[1]
+        if entry.id in offered:
+            continue
+        slot_start = align_to_unit(max(start, entry.window_start, not_before))
+        slot_end = slot_start + datetime.timedelta(minutes=entry.service.duration)
+        if entry.service.duration <= 0 or slot_end > min(end, entry.window_end):
+            skipped.append(item)
+            continue
+        appointment = offer(entry, slot_start, using=using)
+        if appointment is not None:
+            offered.add(entry.id)
+            break
+        skipped.append(item)
+    for item in skipped:
+        heapq.heappush(queue, item)
+    return appointment
+
+
+def match_freed_slots(freed: Iterable[FreedSlot], using: Optional[str] = None) -> List[Appointment]:
+    """
+    Offer freed time to waiting entries, best entries first.
+    :return: appointments booked for waitlist entries
+    """
+    # offered appointments start on whole minutes
+    now = (timezone.now() + datetime.timedelta(seconds=59)).replace(second=0, microsecond=0)
+    by_provider = defaultdict(list)
+    for provider_id, start, end in freed:
+        if provider_id and end > max(start, now):
+            by_provider[provider_id].append((max(start, now), end))
+    if not by_provider:
+        return []
+    parts = []
+    provider_days = defaultdict(set)
+    for provider_id, intervals in by_provider.items():
+        # neighbouring canceled appointments free one longer slot
+        for start, end in merge_intervals(sorted(intervals)):
+            for day, part_start, part_end in split_by_day(start, end):
+                parts.append((part_start, part_end, provider_id, day))
+                provider_days[provider_id].add(day)
+    entries = WaitlistEntry.objects.using(using).filter(
+        provider_id__in=list(provider_days),
+        status='waiting',
+        window_start__lt=max(part[1] for part in parts),
+        window_end__gt=min(part[0] for part in parts),
+    ).select_related('service', 'provider', 'customer')
+    queues = build_queues(entries, provider_days)
+    offered = set()
+    appointments = []
+    parts.sort()
+    for start, end, provider_id, day in parts:
+        queue = queues.get((provider_id, day))
+        remaining = [(start, end)]
+        while queue and remaining:
+            part_start, part_end = remaining.pop()
+            appointment = offer_slot(queue, part_start, part_end, offered, now, using=using)
+            if appointment is None:
+                continue
+            appointments.append(appointment)
+            # time left on both sides of the booked appointment can still go to other entries
+            remaining.extend(
+                interval for interval in ((part_start, appointment.appointment_date), (appointment.end_date, part_end))
+                if interval[1] > interval[0]
+            )
+    return appointments
+
+
+def safe_match_freed_slots(freed: List[FreedSlot], using: Optional[str] = None) -> List[Appointment]:
+    """Match freed time without ever failing the caller, used after cancellations are committed."""
+    try:
+        return match_freed_slots(freed, using=using)
+    except DatabaseError:
+        LOG.exception('Could not offer freed time to the waitlist')
+        return []
+
+
+def cancel_appointments(appointments, using: Optional[str] = None) -> Tuple[int, List[Appointment]]:
+    """
+    Cancel many appointments at once, e.g. a provider's day, and offer the freed time to the waitlist in one batch.
+    Only upcoming pending or confirmed appointments are canceled. Recurring appointments are left untouched, their
+    occurrences are skipped individually.
+    :param appointments: appointments queryset
+    :return: number of canceled appointments and appointments booked from the waitlist
+    """
+    with transaction.atomic(using=using):
+        # locked so that a concurrent status change can't be overwritten with the rows read here
+        rows = list(appointments.using(using).select_for_update(of=('self',)).filter(
+            recurrence='', status__in=CANCELABLE_STATUSES, appointment_date__gte=timezone.now(),
+        ).values_list('id', 'provider_id', 'appointment_date', 'end_date', 'service__client_id'))
+        if not rows:
+            return 0, []
+        appointment_ids = [row[0] for row in rows]
+        Appointment.objects.using(using).filter(id__in=appointment_ids, status__in=CANCELABLE_STATUSES).update(
+            status='canceled',
+        )
+        SlotReservation.objects.using(using).filter(appointment_id__in=appointment_ids).delete()
+    keys = {feeds.provider_feed_key(row[1]) for row in rows if row[1]}
+    keys.update(feeds.client_feed_key(row[4]) for row in rows if row[4])
+    feeds.bump_feed_versions(keys, using=using)
+    freed = [(provider_id, start, end or start) for _, provider_id, start, end, _ in rows if provider_id]
+    # queryset updates don't send signals, refresh bitmaps of the affected days here
+    days = defaultdict(list)
+    for provider_id, start, end in freed:
+        days[provider_id].extend(bitmaps.appointment_days(start, end))
+    for provider_id, provider_days in days.items():
+        bitmaps.safe_refresh_bitmaps([provider_id], min(provider_days), max(provider_days), using=using)
+    return len(rows), safe_match_freed_slots(freed, using=using)
@@ -0,0 +1,76 @@
+"""
+Async entry points of the login and sign up views.
+
+Served through ``appity/asgi.py``, these views check or make the password hash in the hashing pool
+(``core.authentication.hashing``) while the event loop keeps serving other requests, then hand the request to the
+regular DRF view which finds the hashing already done. Sync views run one at a time in the same thread under ASGI,
+so hashing in them would stall every other endpoint. Requests the view would throttle are handed over without
+hashing, the view rejects them. Under WSGI the views work the same, one request per worker.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from rest_framework.request import Request
+
+from core.authentication import views
+from core.authentication.hashing import HashingPoolSaturated, amake_password
+from core.authentication.utils import aappity_authenticate_user, set_password_hash, set_verified_credentials
+
+signup_view = views.SignUpViewSet.as_view({'post': 'create'})
+
+
+def read_credentials(request) -> dict:
+    """Fields of a JSON or form request body, empty when unreadable. The DRF view parses the body again."""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+    return request.POST
+
+
+def is_throttled(throttle_class, request) -> bool:
+    """Check a rate throttle without counting the request, the view counts it."""
+    return throttle_class().would_throttle(Request(request), None)
+
+
+def service_unavailable(error: HashingPoolSaturated) -> JsonResponse:
+    return JsonResponse({'detail': str(error.detail)}, status=error.status_code, headers={
+        'Retry-After': str(error.wait),
+    })
+
+
+async def login(request):
+    credentials = read_credentials(request)
+    email, password = credentials.get('email'), credentials.get('password')
+    if (
+            isinstance(email, str) and isinstance(password, str) and email and password and
+            not await sync_to_async(is_throttled)(views.LoginRateThrottle, request)
+    ):
+        try:
+            user = await aappity_authenticate_user(email=email, password=password, request=request)
+        except HashingPoolSaturated as e:
+            return service_unavailable(e)
+        set_verified_credentials(request, email, password, user)
+    return await sync_to_async(views.login)(request)
+
+
+async def signup(request):
+    password = read_credentials(request).get('password')
+    if (
+            isinstance(password, str) and password and
+            not await sync_to_async(is_throttled)(views.SignUpRateThrottle, request)
+    ):
+        try:
+            encoded = await amake_password(password)
+        except HashingPoolSaturated as e:
+            return service_unavailable(e)
+        set_password_hash(request, password, encoded)
+    return await sync_to_async(signup_view)(request)
+
+
+# like the DRF views they wrap, authentication is by credentials or token, not by session cookie
+login.csrf_exempt = True
+signup.csrf_exempt = True
@@ -0,0 +1,124 @@
+"""
+Bounded thread pool for password hashing.
+
+Checking or making a PBKDF2 password hash takes a worker for tens of milliseconds. Hashes are computed in a small
+dedicated pool instead, awaited by the async login and sign up views (``core.authentication.async_views``) so the
+event loop and the thread running sync views keep serving other requests meanwhile. The pool accepts at most
+``WORKERS + QUEUE`` hashes at once, beyond that hashing fails fast with ``HashingPoolSaturated`` (HTTP 503 with a
+Retry-After header) rather than queueing requests without bound.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions as rest_exceptions
+from rest_framework import status
+
+DEFAULT_SETTINGS = {
+    'WORKERS': 4,
+    'QUEUE': 32,
+    'RETRY_AFTER': 1,
+}
+
+
+def get_settings() -> dict:
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'APPITY_PASSWORD_HASHING', {}))
+
+
+class HashingPoolSaturated(rest_exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Too many sign in attempts are being processed, try again shortly')
+    default_code = 'hashing_pool_saturated'
+
+    def __init__(self, wait: Optional[int] = None):
+        super().__init__()
+        # the DRF exception handler turns ``wait`` into a Retry-After header
+        self.wait = wait if wait is not None else get_settings()['RETRY_AFTER']
+
+
+class HashingPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None  # type: Optional[ThreadPoolExecutor]
+        self.slots = None  # type: Optional[threading.BoundedSemaphore]
+        self.rejected = 0
+
+    def start(self):
+        with self.lock:
+            if self.executor is None:
+                options = get_settings()
+                self.slots = threading.BoundedSemaphore(options['WORKERS'] + options['QUEUE'])
+                self.executor = ThreadPoolExecutor(
+                    max_workers=options['WORKERS'], thread_name_prefix='appity-hashing',
+                )
+
+    def submit(self, function: Callable, *args) -> Future:
+        """
+        Run a function in the pool.
+        :raise HashingPoolSaturated: when the pool already has ``WORKERS + QUEUE`` functions running or waiting
+        """
+        if self.executor is None:
+            self.start()
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingPoolSaturated()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def run(self, function: Callable, *args):
+        return self.submit(function, *args).result()
+
+    async def arun(self, function: Callable, *args):
+        return await asyncio.wrap_future(self.submit(function, *args))
+
+
+hashing_pool = HashingPool()
+
+
+def check_encoded_password(raw_password: str, encoded: str) -> Tuple[bool, bool]:
+    """
+    Check a password against a hash without touching the database, which stays with the calling thread.
+    :return: whether the password matches and whether its hash should be upgraded
+    """
+    upgrade = []
+    valid = hashers.check_password(raw_password, encoded, setter=lambda raw: upgrade.append(True))
+    return valid, bool(upgrade)
+
+
+def upgrade_password(user, encoded: str):
+    user.password = encoded
+    user.save(update_fields=['password'])
+
+
+def check_password(user, raw_password: str) -> bool:
+    """Check a user password in the hashing pool, blocking the calling thread until done."""
+    valid, upgrade = hashing_pool.run(check_encoded_password, raw_password, user.password)
+    if valid and upgrade:
+        upgrade_password(user, hashing_pool.run(hashers.make_password, raw_password))
+    return valid
+
+
+async def acheck_password(user, raw_password: str) -> bool:
+    """Check a user password in the hashing pool without blocking the event loop."""
+    valid, upgrade = await hashing_pool.arun(check_encoded_password, raw_password, user.password)
+    if valid and upgrade:
+        await sync_to_async(upgrade_password)(user, await hashing_pool.arun(hashers.make_password, raw_password))
+    return valid
+
+
+def make_password(raw_password: str) -> str:
+    return hashing_pool.run(hashers.make_password, raw_password)
+
+
+async def amake_password(raw_password: str) -> str:
+    return await hashing_pool.arun(hashers.make_password, raw_password)
@@ -4,7 +4,6 @@ from django.contrib.auth import SESSION_KEY
 from django.utils.deprecation import MiddlewareMixin
 
 from core.authentication.token_authentication import TokenAuthentication
-from core.models import AppUser
 
 
 class TokenAuthenticationMiddleware(MiddlewareMixin):
@@ -13,13 +12,19 @@ class TokenAuthenticationMiddleware(MiddlewareMixin):
         if not TokenAuthentication.has_fleio_token(request):
             return
 
-        user_id = TokenAuthentication.get_user_id_from_header(request)
-        if user_id:
-            user = AppUser.objects.filter(id=user_id).first()
-            if user:
-                request.session[SESSION_KEY] = user_id
-                request.session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.AllowAllUsersModelBackend'
-                request.session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        # the token and its user are resolved once per request, DRF authentication reuses them
+        db_token = TokenAuthentication.get_token_from_header(request)
+        if db_token:
+            user = db_token.user
+            session_values = {
+                SESSION_KEY: user._meta.pk.value_to_string(user),
+                BACKEND_SESSION_KEY: 'django.contrib.auth.backends.AllowAllUsersModelBackend',
+                HASH_SESSION_KEY: user.get_session_auth_hash(),
+            }
+            for key, value in session_values.items():
+                # any assignment marks the session modified and costs a session save at the end of the request
+                if request.session.get(key) != value:
+                    request.session[key] = value
 
 
         # # ensure we have user info in session if a Fleio token is present since django needs it sometimes
@@ -0,0 +1,129 @@
+"""
+Reaper of expired sessions and tokens.
+
+Rows are deleted in chunks bounded by primary key, one short transaction per chunk, so a run never holds the
+database write lock for long: on SQLite other writers get their turn between chunks. In concurrent mode a cache lock
+(shared by all workers when the cache is) keeps overlapping runs, e.g. from a scheduler and a manual run, from doing
+the same work twice, chunks are separated by a pause and chunks failing on a locked database are retried.
+"""
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.db import OperationalError, transaction
+from django.db.models import Exists, Max, Min, OuterRef, Q
+from django.utils import timezone
+
+from core.models.appity_token import AppityOtpToken, AppityToken, SignedTokenRevocation
+
+REAPER_LOCK_KEY = 'appity:reaper-lock'
+REAPER_LOCK_SECONDS = 3600
+DEFAULT_CHUNK_SIZE = 1000
+CONCURRENT_PAUSE_SECONDS = 0.05
+LOCKED_RETRIES = 5
+
+
+class ReapStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.deleted = 0
+        self.chunks = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.deleted / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return dict(
+            deleted=self.deleted,
+            chunks=self.chunks,
+            seconds=round(self.seconds, 3),
+            rows_per_second=round(self.rows_per_second, 1),
+        )
+
+
+def delete_chunk(delete: Callable[[], Tuple[int, Dict[str, int]]], concurrent: bool) -> Tuple[int, Dict[str, int]]:
+    """Run one chunk delete in its own transaction, retrying a few times on a locked database in concurrent mode."""
+    attempt = 0
+    while True:
+        try:
+            with transaction.atomic():
+                return delete()
+        except OperationalError:
+            attempt += 1
+            if not concurrent or attempt >= LOCKED_RETRIES:
+                raise
+            time.sleep(CONCURRENT_PAUSE_SECONDS * 2 ** attempt)
+
+
+def reap_sessions(stats: Dict[str, ReapStats], chunk_size: int, concurrent: bool, now=None):
+    """Delete expired sessions, walking their keys in order. Their tokens and one-time tokens go with them."""
+    now = now or timezone.now()
+    last_key = ''
+    while True:
+        started_at = time.monotonic()
+        keys = list(Session.objects.filter(
+            expire_date__lt=now, session_key__gt=last_key,
+        ).order_by('session_key').values_list('session_key', flat=True)[:chunk_size])
+        if not keys:
+            return
+        _, deleted = delete_chunk(
+            lambda: Session.objects.filter(session_key__in=keys, expire_date__lt=now).delete(), concurrent,
+        )
+        record(stats['sessions'], deleted.get('sessions.Session', 0), started_at)
+        record(stats['tokens'], deleted.get('core.AppityToken', 0), started_at, chunk=False)
+        record(stats['otp_tokens'], deleted.get('core.AppityOtpToken', 0), started_at, chunk=False)
+        last_key = keys[-1]
+        if concurrent:
+            time.sleep(CONCURRENT_PAUSE_SECONDS)
+
+
+def reap_by_id(model, condition: Q, stats: ReapStats, chunk_size: int, concurrent: bool):
+    """Delete rows matching a condition, one primary key range of ``chunk_size`` ids at a time."""
+    bounds = model.objects.aggregate(first=Min('id'), last=Max('id'))
+    if bounds['first'] is None:
+        return
+    for low in range(bounds['first'], bounds['last'] + 1, chunk_size):
+        started_at = time.monotonic()
+        rows = model.objects.filter(condition, id__gte=low, id__lt=low + chunk_size)
+        _, deleted = delete_chunk(rows.delete, concurrent)
+        record(stats, deleted.get(model._meta.label, 0), started_at)
+        if concurrent:
+            time.sleep(CONCURRENT_PAUSE_SECONDS)
+
+
+def record(stats: ReapStats, deleted: int, started_at: float, chunk: bool = True):
+    stats.deleted += deleted
+    stats.chunks += int(chunk)
+    if chunk:
+        stats.seconds += time.monotonic() - started_at
+
+
+def reap(chunk_size: int = DEFAULT_CHUNK_SIZE, concurrent: bool = False) -> Optional[Dict[str, ReapStats]]:
+    """
+    Delete expired sessions, expired tokens, tokens whose session is gone, expired one-time tokens and revocations
+    of expired signed tokens.
+    :param concurrent: take the reaper lock and go easy on the database, for runs overlapping other runs and traffic
+    :return: statistics per table, None when another concurrent run holds the lock
+    """
+    if concurrent and not cache.add(REAPER_LOCK_KEY, True, REAPER_LOCK_SECONDS):
+        return None
+    try:
+        now = timezone.now()
+        stats = {name: ReapStats(name) for name in ('sessions', 'tokens', 'otp_tokens', 'revocations')}
+        reap_sessions(stats, chunk_size, concurrent, now=now)
+        reap_by_id(
+            AppityToken,
+            Q(expire_at__lt=now) | Q(
+                ~Exists(Session.objects.filter(session_key=OuterRef('session_id'))), session_id__isnull=False,
+            ),
+            stats['tokens'], chunk_size, concurrent,
+        )
+        reap_by_id(AppityOtpToken, Q(expire_at__lt=now), stats['otp_tokens'], chunk_size, concurrent)
+        reap_by_id(SignedTokenRevocation, Q(expire_at__lt=now), stats['revocations'], chunk_size, concurrent)
+        return stats
+    finally:
+        if concurrent:
+            cache.delete(REAPER_LOCK_KEY)
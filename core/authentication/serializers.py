@@ -1,11 +1,11 @@
 from django.conf import Settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.hashers import make_password
 from django.utils.translation import gettext_lazy as _
 
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
+from core.authentication.utils import get_password_hash
 from core.models.models import AppUser, Client
 
 class LoginSerializer(serializers.Serializer):
@@ -38,7 +38,7 @@ class SignUpSerializer(serializers.ModelSerializer):
     class Meta:
         model = get_user_model()
         fields = (
-            'email', 'password', 'first_name', 'last_name', 'language',
+            'email', 'password', 'first_name', 'last_name', 'language', 'timezone',
             'invitation_id', 'invitation_token',
         )
 
@@ -78,8 +78,8 @@ class SignUpSerializer(serializers.ModelSerializer):
         for field_name, field_value in validated_data.items():
             if field_name in self.Meta.fields:
                 valid_fields[field_name] = field_value
-        raw_password = validated_data['password']
-        valid_fields['password'] = make_password(validated_data['password'])
+        # hashed once, in the hashing pool unless the async sign up view already did it
+        valid_fields['password'] = get_password_hash(self.context.get('request'), validated_data['password'])
 
         # set language on signup
         language = valid_fields.pop('language', None)
@@ -94,7 +94,6 @@ class SignUpSerializer(serializers.ModelSerializer):
         valid_fields.pop('invitation_token')
         if existing_user and existing_user.unregistered:
             user = super(SignUpSerializer, self).update(existing_user, valid_fields)
-            user.set_password(raw_password)
             user.is_active = True
             user.unregistered = False
             user.save(update_fields=['is_active', 'unregistered'])
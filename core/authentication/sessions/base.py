@@ -0,0 +1,39 @@
+from django.conf import settings
+
+
+class WriteMinimizingSessionMixin:
+    """
+    Session store skipping saves that would write what the store already holds, so setting values that didn't
+    change, or saving again at the end of a request, costs nothing. ``cycle_key`` doesn't write either: the new
+    session is created by the next save, together with everything set in the meantime.
+    """
+    persisted = None  # (session key, serialized data) last loaded or saved
+
+    def snapshot(self, data: dict):
+        return self.session_key, self.serializer().dumps(data)
+
+    def load(self):
+        data = super().load()
+        self.persisted = self.snapshot(data)
+        return data
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        if (
+                not must_create and not settings.SESSION_SAVE_EVERY_REQUEST and
+                self.persisted == self.snapshot(data)
+        ):
+            return
+        super().save(must_create=must_create)
+        self.persisted = self.snapshot(data)
+
+    def cycle_key(self):
+        data = self._session
+        key = self.session_key
+        self._session_key = None
+        self._session_cache = data
+        self.modified = True
+        if key:
+            self.delete(key)
@@ -0,0 +1,11 @@
+"""
+Write-through cached database session engine writing each session at most once per request. Reads are served
+from the cache, which must be shared by all workers.
+"""
+from django.contrib.sessions.backends import cached_db
+
+from core.authentication.sessions.base import WriteMinimizingSessionMixin
+
+
+class SessionStore(WriteMinimizingSessionMixin, cached_db.SessionStore):
+    pass
@@ -0,0 +1,8 @@
+"""Database session engine writing each session at most once per request."""
+from django.contrib.sessions.backends import db
+
+from core.authentication.sessions.base import WriteMinimizingSessionMixin
+
+
+class SessionStore(WriteMinimizingSessionMixin, db.SessionStore):
+    pass
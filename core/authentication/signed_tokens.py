@@ -0,0 +1,239 @@
+"""
+Stateless signed access tokens for API clients.
+
+A signed token embeds the user id, issue time in microseconds, expiry time, a random ``jti`` and the id of the
+signing key, under an HMAC. Verifying one needs no database access: revocations (logout, ``AppUser.clear_sessions``,
+deactivation, deletion) are kept in process as a Bloom filter of revoked ``jti`` values plus an exact map of users
+whose tokens were all revoked, refreshed incrementally from ``SignedTokenRevocation`` every ``REVOCATION_REFRESH``
+seconds. A Bloom filter match is confirmed with the database since it can be a false positive. Revoking all tokens of
+a user covers the tokens issued up to the revocation; a token issued right after it, even within the same second,
+stays valid. The user is loaded on first use and rejected when it was deactivated or deleted since, before other
+processes noticed the revocation.
+
+Signed tokens start with ``apst.`` and are accepted by ``TokenAuthentication`` next to opaque ``AppityToken`` rows.
+"""
+import base64
+import datetime
+import hashlib
+import math
+import secrets
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.functional import SimpleLazyObject
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+
+from core.models.appity_token import SignedTokenRevocation
+from core.models.models import AppUser
+
+TOKEN_PREFIX = 'apst'
+TOKEN_SALT = 'core.authentication.signed_tokens'
+DEFAULT_SETTINGS = {
+    'KEYS': {},
+    'CURRENT_KEY': None,
+    'LIFETIME': 3600,
+    'REVOCATION_REFRESH': 5,
+    'BLOOM_CAPACITY': 100000,
+    'BLOOM_ERROR_RATE': 0.01,
+}
+
+
+class InvalidSignedToken(Exception):
+    pass
+
+
+class SignedToken(NamedTuple):
+    key_id: str
+    user_id: int
+    issued_at: int  # microseconds
+    expire_at: int  # seconds
+    jti: str
+
+    @property
+    def expire_at_datetime(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.expire_at, tz=datetime.timezone.utc)
+
+
+def get_settings() -> dict:
+    options = dict(DEFAULT_SETTINGS, **getattr(settings, 'APPITY_SIGNED_TOKENS', {}))
+    if not options['KEYS']:
+        options['KEYS'] = {'1': settings.SECRET_KEY}
+        options['CURRENT_KEY'] = '1'
+    return options
+
+
+def is_signed_token(token: str) -> bool:
+    return token.startswith(TOKEN_PREFIX + '.')
+
+
+def sign(payload: str, key_id: str) -> str:
+    keys = get_settings()['KEYS']
+    if key_id not in keys:
+        raise InvalidSignedToken('Unknown key.')
+    digest = salted_hmac(TOKEN_SALT, payload, secret=keys[key_id], algorithm='sha256').digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def issue_signed_token(user, lifetime: Optional[int] = None) -> str:
+    options = get_settings()
+    now = time.time_ns() // 1000
+    payload = '.'.join([
+        TOKEN_PREFIX,
+        str(options['CURRENT_KEY']),
+        str(user.pk),
+        str(now),
+        str(now // 1000000 + (lifetime or options['LIFETIME'])),
+        secrets.token_hex(16),
+    ])
+    return '{}.{}'.format(payload, sign(payload, str(options['CURRENT_KEY'])))
+
+
+def verify_signed_token(token: str) -> SignedToken:
+    """
+    Check the signature, expiry and revocation of a signed token.
+    :raise InvalidSignedToken: when the token can't be used
+    """
+    parts = token.split('.')
+    if len(parts) != 7 or parts[0] != TOKEN_PREFIX:
+        raise InvalidSignedToken('Malformed token.')
+    payload, signature = token.rsplit('.', 1)
+    if not constant_time_compare(sign(payload, parts[1]), signature):
+        raise InvalidSignedToken('Invalid signature.')
+    try:
+        signed_token = SignedToken(parts[1], int(parts[2]), int(parts[3]), int(parts[4]), parts[5])
+    except ValueError:
+        raise InvalidSignedToken('Malformed token.')
+    if signed_token.expire_at <= time.time():
+        raise InvalidSignedToken('Expired token.')
+    if revocations.is_revoked(signed_token):
+        raise InvalidSignedToken('Revoked token.')
+    return signed_token
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value: str):
+        # double hashing, the k positions are derived from two 64 bit halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + index * second) % self.size for index in range(self.hash_count))
+
+    def add(self, value: str):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+
+class RevocationSet:
+    """
+    In-process copy of ``SignedTokenRevocation``. New rows are read by id every ``REVOCATION_REFRESH`` seconds, the
+    whole set is rebuilt once per token ``LIFETIME`` to forget revocations of expired tokens.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.bloom = None  # type: Optional[BloomFilter]
+        self.users = {}  # user id => timestamp in microseconds up to which all tokens of the user are revoked
+        self.last_id = 0
+        self.refreshed_at = self.built_at = None  # type: Optional[float]
+
+    def add(self, jti: Optional[str], user_id: int, created_at: datetime.datetime):
+        if jti:
+            self.bloom.add(jti)
+        else:
+            self.users[user_id] = max(self.users.get(user_id, 0), round(created_at.timestamp() * 1000000))
+
+    def refresh(self):
+        options = get_settings()
+        now = time.monotonic()
+        if self.refreshed_at is not None and now - self.refreshed_at < options['REVOCATION_REFRESH']:
+            return
+        with self.lock:
+            if self.refreshed_at is not None and now - self.refreshed_at < options['REVOCATION_REFRESH']:
+                return
+            rows = SignedTokenRevocation.objects.filter(
+                expire_at__gt=timezone.now(),
+            ).order_by('id').values_list('id', 'jti', 'user_id', 'created_at')
+            rebuild = self.built_at is None or now - self.built_at > options['LIFETIME']
+            if not rebuild:
+                new_rows = list(rows.filter(id__gt=self.last_id))
+                rebuild = self.bloom.count + len(new_rows) > self.bloom.capacity
+            if rebuild:
+                new_rows = list(rows)
+                capacity = max(options['BLOOM_CAPACITY'], 2 * len(new_rows))
+                self.bloom = BloomFilter(capacity, options['BLOOM_ERROR_RATE'])
+                self.users = {}
+                self.built_at = now
+            for row_id, jti, user_id, created_at in new_rows:
+                self.add(jti, user_id, created_at)
+                self.last_id = max(self.last_id, row_id)
+            self.refreshed_at = now
+
+    def is_revoked(self, token: SignedToken) -> bool:
+        self.refresh()
+        if token.issued_at <= self.users.get(token.user_id, -1):
+            return True
+        if token.jti in self.bloom:
+            return SignedTokenRevocation.objects.filter(jti=token.jti).exists()
+        return False
+
+
+revocations = RevocationSet()
+
+
+def revoke(user_id: int, jti: Optional[str] = None, expire_at: Optional[datetime.datetime] = None):
+    """
+    Revoke one signed token, or when ``jti`` is None all signed tokens issued to a user so far.
+    Other processes notice within ``REVOCATION_REFRESH`` seconds.
+    """
+    if expire_at is None:
+        expire_at = timezone.now() + datetime.timedelta(seconds=get_settings()['LIFETIME'])
+    revocation = SignedTokenRevocation.objects.create(jti=jti, user_id=user_id, expire_at=expire_at)
+    if revocations.bloom is not None:
+        with revocations.lock:
+            revocations.add(jti, user_id, revocation.created_at)
+
+
+def revoke_signed_token(token: SignedToken):
+    revoke(token.user_id, jti=token.jti, expire_at=token.expire_at_datetime)
+
+
+def load_token_user(user_id: int) -> AppUser:
+    """
+    Load the user of a signed token.
+    :raise AuthenticationFailed: when the user was deleted or deactivated after the token was verified
+    """
+    user = AppUser.objects.filter(pk=user_id).first()
+    if user is None or not user.is_active:
+        raise AuthenticationFailed(_('User inactive or deleted.'))
+    return user
+
+
+class LazyUser(SimpleLazyObject):
+    """User of a signed token, loaded on first access to anything but its id and authentication state."""
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id: int):
+        super().__init__(lambda: load_token_user(user_id))
+        self.__dict__['pk'] = self.__dict__['id'] = user_id
+
+    def __bool__(self):
+        return True
@@ -1,11 +1,15 @@
+import logging
 from datetime import timedelta
+from importlib import import_module
 from typing import Optional
 
+from django.conf import settings
 from django.contrib import auth
 from django.contrib.sessions.models import Session
 from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
 from django.utils.translation import gettext_lazy as _
 from rest_framework import authentication
 from rest_framework.authentication import get_authorization_header
@@ -14,19 +18,44 @@ from rest_framework.permissions import AllowAny
 from rest_framework.request import Request
 
 # from common.logger import get_fleio_logger
-from core.models.appity_token import AppityToken
+from core.authentication.reaper import reap
+from core.authentication.signed_tokens import InvalidSignedToken, LazyUser, is_signed_token, verify_signed_token
+from core.authentication.token_cache import token_cache
+from core.exceptions import APIConflict
+from core.models.appity_token import AppityOtpToken, AppityToken
 
-# from fleio.core.models import FleioOtpToken
 # from fleio.core.utils import match_session_ip_or_401
 # from fleio.logger.decorators import log_periodic_task
 # from fleio.logger.models import PeriodicTaskLog
 
-# LOG = get_fleio_logger(__name__)
+LOG = logging.getLogger(__name__)
 OTP_TOKEN_MAX_LIFETIME_SECONDS = 600
 
 
+REQUEST_TOKEN_ATTRIBUTE = '_appity_token'
+# session key holding the frontend token of the session
+SESSION_TOKEN_KEY = 'appity_token'
+# session key holding the impersonation snapshot, see ``start_impersonation``
+IMPERSONATION_SESSION_KEY = 'impersonation'
+IMPERSONATION_SALT = 'core.authentication.impersonation'
+IMPERSONATION_FIELDS = ('impersonator', 'impersonate', 'impersonator_token', 'token')
+
+
+def resolve_request_token(request, token: str) -> Optional[AppityToken]:
+    """
+    Resolve a token string once per request. The middleware and the DRF authenticator share the resolved token,
+    and so the single load of its user, through the underlying Django request.
+    """
+    django_request = getattr(request, '_request', request)
+    resolved = getattr(django_request, REQUEST_TOKEN_ATTRIBUTE, None)
+    if resolved is None or resolved[0] != token:
+        resolved = (token, token_cache.get(token))
+        setattr(django_request, REQUEST_TOKEN_ATTRIBUTE, resolved)
+    return resolved[1]
+
+
 def get_frontend_token(user, request) -> Optional[str]:
-    token = AppityToken.objects.filter(user=user, session_id=request.session.session_key, frontend=True).first()
+    token = token_cache.get_frontend(getattr(user, 'pk', user), request.session.session_key)
     if token:
         return token.token
     else:
@@ -34,12 +63,13 @@ def get_frontend_token(user, request) -> Optional[str]:
 
 
 def get_token_from_request(request) -> Optional[AppityToken]:
-    if 'impersonate' in request.session and request.get_full_path().startswith('/api/'):
+    impersonation = get_impersonation(request)
+    if impersonation and request.get_full_path().startswith('/api/'):
         # request from impersonated end user, return user frontend token
-        fleio_token = AppityToken.objects.get_frontend_fleio_token(
-            user=request.session['impersonate'],
-            session_id=request.session.session_key,
-        )
+        if isinstance(request.auth, AppityToken) and request.auth.token == impersonation['token']:
+            fleio_token = request.auth
+        else:
+            fleio_token = token_cache.get(impersonation['token'])
     elif isinstance(request.auth, AppityToken):
         fleio_token = request.auth
     else:
@@ -50,8 +80,8 @@ def get_token_from_request(request) -> Optional[AppityToken]:
 
 def generate_otp_token_for_token(token: AppityToken) -> Optional[str]:
     # generate new token
-    otp_token = FleioOtpToken.objects.create(
-        fleio_token=token, expire_at=timezone.now() + timedelta(seconds=OTP_TOKEN_MAX_LIFETIME_SECONDS)
+    otp_token = AppityOtpToken.objects.create(
+        appity_token=token, expire_at=timezone.now() + timedelta(seconds=OTP_TOKEN_MAX_LIFETIME_SECONDS)
     )
     return otp_token.token
 
@@ -59,9 +89,7 @@ def generate_otp_token_for_token(token: AppityToken) -> Optional[str]:
 def generate_otp_token_for_request(request) -> Optional[str]:
     token = request.auth
     if token and isinstance(token, AppityToken):
-        # delete existing expired tokens
-        token.otp_tokens.filter(expire_at__isnull=False, expire_at__lt=timezone.now()).delete()
-        # generate new token
+        # expired tokens are deleted in bulk by the reaper
         return generate_otp_token_for_token(token)
 
     return None
@@ -78,11 +106,13 @@ def initialize_frontend_token(
 ) -> AppityToken:
     if not seconds_until_expiration:
         seconds_until_expiration = user.get_session_expiration_seconds()
+    defaults = {'expire_at': timezone.now() + timedelta(seconds=seconds_until_expiration)}
     with transaction.atomic():
         token, new_token = AppityToken.objects.get_or_create(
             frontend=True,
             session_id=request.session.session_key,
             user=user,
+            defaults=defaults,
         )
         if not new_token and token.is_expired:
             # existing token expired, delete and recreate
@@ -90,18 +120,38 @@ def initialize_frontend_token(
                 token.delete()
             except AppityToken.DoesNotExist:
                 pass
-            token, new_token = AppityToken.objects.get_or_create(
+            token = AppityToken.objects.create(
                 frontend=True,
                 session_id=request.session.session_key,
                 user=user,
+                **defaults,
             )
 
-        if new_token:
-            set_expiry_date(token=token, seconds_until_expiration=seconds_until_expiration)
-
         return token
 
 
+def persist_frontend_session(request, user, seconds_until_expiration: int) -> AppityToken:
+    """
+    Save the session together with a new frontend token stored in it, with a single session write: the token
+    string is generated up front so the session is written once, then the token row pointing to it is inserted.
+    With the write minimizing session engines (``core.authentication.sessions``) the session save at the end of
+    the request is skipped since nothing changed afterwards.
+    """
+    token = AppityToken(
+        user=user,
+        frontend=True,
+        expire_at=timezone.now() + timedelta(seconds=seconds_until_expiration),
+        token=AppityToken.generate_token(user),
+    )
+    request.session[SESSION_TOKEN_KEY] = token.token
+    with transaction.atomic():
+        # creates the session when its key was cycled or flushed, the row must exist before the token refers to it
+        request.session.save()
+        token.session_id = request.session.session_key
+        token.save(force_insert=True)
+    return token
+
+
 def clear_impersonation_frontend_token(impersonated_user, request):
     if impersonated_user:
         AppityToken.objects.filter(
@@ -121,15 +171,70 @@ def initialize_frontend_token_for_impersonation(impersonated_user, request):
     )
 
 
+def sign_impersonation(impersonation: dict) -> str:
+    value = ':'.join(str(impersonation.get(field)) for field in IMPERSONATION_FIELDS)
+    return salted_hmac(IMPERSONATION_SALT, value, algorithm='sha256').hexdigest()
+
+
+def start_impersonation(impersonated_user, request) -> AppityToken:
+    """
+    Let the user of the request act as another user in the current session. Everything authentication checks on
+    later requests is resolved here once and stored in the session as a signed snapshot: both user ids, the
+    impersonator's frontend token and the new frontend token of the impersonated user.
+    """
+    token = initialize_frontend_token_for_impersonation(impersonated_user=impersonated_user, request=request)
+    impersonation = {
+        'impersonator': request.user.pk,
+        'impersonate': impersonated_user.pk,
+        'impersonator_token': request.session.get(SESSION_TOKEN_KEY),
+        'token': token.token,
+    }
+    impersonation['signature'] = sign_impersonation(impersonation)
+    request.session['impersonator'] = impersonation['impersonator']
+    request.session['impersonate'] = impersonation['impersonate']
+    request.session[IMPERSONATION_SESSION_KEY] = impersonation
+    return token
+
+
+def end_impersonation(request):
+    impersonation = request.session.get(IMPERSONATION_SESSION_KEY)
+    if isinstance(impersonation, dict) and impersonation.get('token'):
+        AppityToken.objects.filter(token=impersonation['token']).delete()
+    for key in ('impersonator', 'impersonate', IMPERSONATION_SESSION_KEY):
+        request.session.pop(key, None)
+
+
+def get_impersonation(request) -> Optional[dict]:
+    """
+    Impersonation snapshot of the session, None when there is no impersonation or the snapshot is invalid, which
+    includes partial snapshots and those of sessions from before snapshots were signed.
+    """
+    impersonation = request.session.get(IMPERSONATION_SESSION_KEY)
+    if not isinstance(impersonation, dict) or not all(field in impersonation for field in IMPERSONATION_FIELDS):
+        return None
+    if not constant_time_compare(str(impersonation.get('signature', '')), sign_impersonation(impersonation)):
+        return None
+    if (
+            impersonation['impersonator'] != request.session.get('impersonator') or
+            impersonation['impersonate'] != request.session.get('impersonate')
+    ):
+        return None
+    return impersonation
+
+
 def extend_frontend_session(user, fleio_token: AppityToken, request, remember=False) -> AppityToken:
-    """Extends frontend session by creating a new Django session & Fleio frontend token for a given user"""
+    """Extends frontend session by creating a new Django session & Appity frontend token for a given user"""
     if not fleio_token.frontend:
         raise APIConflict(_('Cannot extend session for non-frontend token.'))
 
-    # add a new session
-    old_session_data = request.session.load()
-    request.session.create()
-    request.session.session_data = old_session_data
+    # copy the session data to a new session, created by the single save below, the current session stays valid
+    django_request = getattr(request, '_request', request)
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session.update(request.session.items())
+    django_request.session = session
+    # the impersonation token belongs to the old session
+    for key in ('impersonator', 'impersonate', IMPERSONATION_SESSION_KEY):
+        session.pop(key, None)
 
     session_expiration_seconds = user.get_session_expiration_seconds(remember=remember)
     if remember:
@@ -138,62 +243,38 @@ def extend_frontend_session(user, fleio_token: AppityToken, request, remember=Fa
         # setting 0 means session expires at browser close
         request.session.set_expiry(0)
 
-    # create the new Fleio frontend token (it will use the newly created Django session)
-    new_fleio_token = initialize_frontend_token(
-        user=user,
-        request=request,
-        seconds_until_expiration=session_expiration_seconds,
-    )
+    new_fleio_token = persist_frontend_session(request, user, session_expiration_seconds)
     request.auth = new_fleio_token
-    request.session['fleio_token'] = new_fleio_token.token
-    # save session_data
-    request.session.save()
     return new_fleio_token
 
 
-def token_login(request, user, seconds_until_expiration: Optional[int] = None):
+def token_login(request, user, seconds_until_expiration: Optional[int] = None, remember: Optional[bool] = None):
+    """
+    Log a user in a new session with a new frontend token, writing the session once.
+    :param remember: keep the session for ``seconds_until_expiration`` instead of until browser close, None leaves
+    the session expiry alone
+    """
+    if not seconds_until_expiration:
+        seconds_until_expiration = user.get_session_expiration_seconds(remember=bool(remember))
     request.session.flush()
     auth.login(request, user, backend='django.contrib.auth.backends.AllowAllUsersModelBackend')
-    if request and request.session and request.session.session_key:
-        token = initialize_frontend_token(
-            user=user,
-            request=request,
-            seconds_until_expiration=seconds_until_expiration,
-        )
-        request.auth = token
-        request.session['appity_token'] = token.token
-
-
-# @log_periodic_task(task_name='Clear expired sessions task'
-# def clear_expired_sessions(periodic_task_log: Optional[PeriodicTaskLog] = None):
-#     LOG.fleio_activity('Starting to clear Django expired sessions and Fleio tokens.')
-#     current_moment = timezone.now()
-#     all_sessions = Session.objects.all()
-#     all_expired_sessions = all_sessions.filter(expire_date__lt=current_moment)
-#     # clear expired tokens or tokens that have related django session missing or expired
-#     expired_tokens = AppityToken.objects.filter(
-#         Q(expire_at__lt=current_moment) |
-#         (Q(session_id__isnull=False) & (
-#             ~Q(session_id__in=all_sessions.values('session_key')) |
-#             Q(session_id__in=all_expired_sessions.values('session_key'))
-#         ))
-#     )
-#     expired_tokens_count = expired_tokens.count()
-#     expired_tokens.delete()
-#     if expired_tokens_count == 0:
-#         LOG.fleio_activity('Did not find expired tokens.')
-#     else:
-#         LOG.fleio_activity('Deleted {} expired token(s).'.format(expired_tokens_count))
-#     # also clear django expired sessions
-#     expired_django_sessions_count = all_expired_sessions.count()
-#     all_expired_sessions.delete()
-#     if expired_django_sessions_count == 0:
-#         LOG.fleio_activity('Did not find expired Django sessions.')
-#     else:
-#         LOG.fleio_activity('Deleted {} expired Django session(s).'.format(expired_django_sessions_count))
-
-#     LOG.fleio_activity('Finished clearing Django expired sessions and Fleio tokens.')
-#     periodic_task_log.summary = 'Django expired sessions and Fleio tokens cleared'
+    if remember is not None:
+        # setting 0 means session expires at browser close
+        request.session.set_expiry(seconds_until_expiration if remember else 0)
+    request.auth = persist_frontend_session(request, user, seconds_until_expiration)
+
+
+def clear_expired_sessions():
+    """Periodic task deleting expired sessions and tokens, safe to schedule next to other runs and live traffic."""
+    stats = reap(concurrent=True)
+    if stats is None:
+        LOG.info('Expired sessions are already being cleared by another run.')
+        return None
+    for table_stats in stats.values():
+        LOG.info('Deleted {} expired {} at {:.0f} rows/s.'.format(
+            table_stats.deleted, table_stats.name, table_stats.rows_per_second,
+        ))
+    return stats
 
 
 class TokenAuthentication(authentication.BaseAuthentication):
@@ -205,18 +286,18 @@ class TokenAuthentication(authentication.BaseAuthentication):
         return len(auth_header) == 2 and auth_header[0].lower() == TokenAuthentication.keyword.lower().encode()
 
     @staticmethod
-    def get_user_id_from_header(request) -> Optional[int]:
+    def get_token_from_header(request) -> Optional[AppityToken]:
         auth_header = get_authorization_header(request).split()
         if TokenAuthentication.has_fleio_token(request=request):
             token = auth_header[1].decode()
+            if is_signed_token(token):
+                # stateless tokens don't use sessions
+                return None
             request_session = request.session
-            db_token = AppityToken.objects.filter(
-                token=token,
-                session_id=request_session.session_key if request_session else None
-            ).first()
-            if db_token:
+            db_token = resolve_request_token(request, token)
+            if db_token and db_token.session_id == (request_session.session_key if request_session else None):
                 if not db_token.is_expired:
-                    return db_token.user_id
+                    return db_token
                 else:
                     try:
                         db_token.delete()
@@ -225,6 +306,11 @@ class TokenAuthentication(authentication.BaseAuthentication):
 
         return None
 
+    @staticmethod
+    def get_user_id_from_header(request) -> Optional[int]:
+        db_token = TokenAuthentication.get_token_from_header(request)
+        return db_token.user_id if db_token else None
+
     @staticmethod
     def is_anonymous_view(request: Request) -> bool:
         try:
@@ -274,28 +360,44 @@ class TokenAuthentication(authentication.BaseAuthentication):
             msg = _('Invalid token header. Token string should not contain invalid characters.')
             raise AuthenticationFailed(msg)
 
+        if is_signed_token(token):
+            return self.authenticate_signed_token(token, anonymous=anonymous)
         return self.authenticate_credentials(request, token, anonymous=anonymous)
 
+    @staticmethod
+    def authenticate_signed_token(token: str, anonymous: bool = False):
+        """Authenticate a stateless signed token without database access, its user is loaded on first use."""
+        try:
+            signed_token = verify_signed_token(token)
+        except InvalidSignedToken as e:
+            if anonymous:
+                # do not raise for anonymous view
+                return None
+            raise AuthenticationFailed(_(str(e)))
+        return LazyUser(signed_token.user_id), signed_token
+
     @staticmethod
     def authenticate_credentials(request: Request, token: str, otp: bool = False, anonymous: bool = False):
         try:
             if otp:
-                db_token = AppityToken.objects.get(otp_tokens__token=token)
-
-                # delete token since it was used
-                otp_token = db_token.otp_tokens.get(token=token)
-                otp_token.delete()
-                if otp_token.is_expired:
+                # one-time tokens are deleted as they are read, a token can't be used twice even concurrently
+                consumed = AppityOtpToken.objects.consume(token)
+                if consumed is None:
+                    raise AppityToken.DoesNotExist()
+                appity_token_id, otp_expired = consumed
+                if otp_expired:
                     if anonymous:
                         # do not raise for anonymous view
                         return None
                     raise AuthenticationFailed(_('Expired token.'))
+                db_token = AppityToken.objects.select_related('user').get(id=appity_token_id)
             else:
                 request_session = getattr(request, 'session', None)
-                db_token = AppityToken.objects.get(
-                    token=token,
-                    session_id=request_session.session_key if request_session else None,
-                )
+                db_token = resolve_request_token(request, token)
+                if db_token is None or db_token.session_id != (
+                        request_session.session_key if request_session else None
+                ):
+                    raise AppityToken.DoesNotExist()
         except AppityToken.DoesNotExist:
             if anonymous:
                 # do not raise for anonymous view
@@ -324,7 +426,7 @@ class TokenAuthentication(authentication.BaseAuthentication):
         if not otp:
             # validate frontend token against session
             if db_token.frontend:
-                session_token = request.session.get('fleio_token')
+                session_token = request.session.get(SESSION_TOKEN_KEY)
             else:
                 session_token = None
 
@@ -332,12 +434,12 @@ class TokenAuthentication(authentication.BaseAuthentication):
                 # we only check if we have a session token - checking against no session token will prevent API calls
                 # without session
                 if {'impersonate', 'impersonator'}.issubset(request.session.keys()):
-                    # we have an active impersonation, check
-                    impersonator_id = request.session.get('impersonator')
-                    user_id = request.session['impersonate']
-                    impersonator_token = get_frontend_token(impersonator_id, request=request)
-
-                    if not ((db_token.user.id in [user_id, impersonator_id]) and (impersonator_token == session_token)):
+                    # we have an active impersonation, check it against the snapshot taken when it started
+                    impersonation = get_impersonation(request)
+                    if not impersonation or not (
+                            db_token.user_id in [impersonation['impersonate'], impersonation['impersonator']] and
+                            impersonation['impersonator_token'] == session_token
+                    ):
                         if anonymous:
                             # do not raise for anonymous view
                             return None
@@ -356,7 +458,7 @@ class TokenAuthentication(authentication.BaseAuthentication):
         #         return None
         #     raise
         # else:
-            return db_token.user, db_token
+        return db_token.user, db_token
 
     def authenticate_header(self, request):
         return self.keyword
@@ -0,0 +1,246 @@
+"""
+Two level cache of ``AppityToken`` rows.
+
+Tokens are resolved on every authenticated request, often more than once. Resolved rows are kept in a small
+in-process LRU in front of the shared Django cache, both with a TTL that never outlives the token's ``expire_at``.
+The token's user is cached next to it under its own key, every field but the password hash, which is replaced by
+the session auth hash derived from it, so a cached token authenticates without any query; user saves and deletes
+drop that key.
+Deletes and updates invalidate both levels through signals. The in-process level of other workers is not reached and
+only expires: a deleted or logged out token stays accepted by them for up to ``APPITY_TOKEN_CACHE['LOCAL_TTL']``
+seconds, the accepted window, traded for local hits that don't touch the shared cache.
+
+Invalidation only reaches other workers through a cache they all share. With a per-process cache (local memory or
+dummy) as ``APPITY_TOKEN_CACHE['CACHE']`` a deleted token would stay valid elsewhere for ``SHARED_TTL`` seconds, so
+the cache stays off and every lookup reads the database, unless ``ENABLED`` says otherwise (e.g. single process
+deployments).
+"""
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from core.models.appity_token import AppityToken
+from core.models.models import AppUser
+
+TOKEN_FIELDS = ('id', 'token', 'user_id', 'created_at', 'expire_at', 'frontend', 'display_name', 'session_id')
+# in model order, as ``from_db`` expects, the password hash stays out of the cache and is loaded when used
+USER_FIELDS = tuple(field.attname for field in AppUser._meta.concrete_fields if field.name != 'password')
+PROCESS_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+DEFAULT_SETTINGS = {
+    # None to enable the cache when CACHE is shared by processes
+    'ENABLED': None,
+    'SIZE': 10000,
+    'LOCAL_TTL': 5,
+    'SHARED_TTL': 300,
+    'CACHE': 'default',
+}
+
+
+def token_key(token: str) -> str:
+    # raw tokens are credentials, keep them out of cache keys
+    return 'appity:token:{}'.format(hashlib.sha256(token.encode()).hexdigest())
+
+
+def frontend_key(user_id: int, session_id: Optional[str]) -> str:
+    return 'appity:frontend-token:{}:{}'.format(user_id, session_id)
+
+
+def user_key(user_id: int) -> str:
+    return 'appity:token-user:{}'.format(user_id)
+
+
+class TokenCache:
+    def __init__(self):
+        options = dict(DEFAULT_SETTINGS, **getattr(settings, 'APPITY_TOKEN_CACHE', {}))
+        self.size = options['SIZE']
+        self.local_ttl = options['LOCAL_TTL']
+        self.shared_ttl = options['SHARED_TTL']
+        self.cache_alias = options['CACHE']
+        self.enabled = options['ENABLED']
+        if self.enabled is None:
+            self.enabled = settings.CACHES[self.cache_alias]['BACKEND'] not in PROCESS_CACHE_BACKENDS
+        self.lock = threading.Lock()
+        self.local = OrderedDict()  # key => (monotonic deadline, value)
+        self.local_hits = self.shared_hits = self.misses = 0
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def ttl(self, limit: int, expire_at: Optional[datetime.datetime]) -> int:
+        if expire_at is None:
+            return limit
+        return min(limit, int((expire_at - timezone.now()).total_seconds()))
+
+    def get_local(self, key: str):
+        with self.lock:
+            item = self.local.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self.local[key]
+                return None
+            self.local.move_to_end(key)
+            return item[1]
+
+    def set_local(self, key: str, value, ttl: int):
+        with self.lock:
+            self.local[key] = (time.monotonic() + ttl, value)
+            self.local.move_to_end(key)
+            while len(self.local) > self.size:
+                self.local.popitem(last=False)
+
+    def lookup(self, key: str, load) -> Tuple[Optional[tuple], Optional[datetime.datetime]]:
+        """
+        Read a value from the local cache, the shared cache or ``load``, storing it in the levels it was missing from.
+        :param load: returns the value and the expiration date bounding its TTL, (None, None) when not found
+        """
+        if not self.enabled:
+            return load()
+        value = self.get_local(key)
+        if value is not None:
+            self.count('local_hits')
+            return value
+        value = self.shared.get(key)
+        if value is not None:
+            self.count('shared_hits')
+        else:
+            self.count('misses')
+            value = load()
+            if value[0] is None:
+                return value
+            if not self.set_shared(key, value):
+                return value
+        ttl = self.ttl(self.local_ttl, value[1])
+        if ttl > 0:
+            self.set_local(key, value, ttl)
+        return value
+
+    def set_shared(self, key: str, value: tuple) -> bool:
+        ttl = self.ttl(self.shared_ttl, value[1])
+        if ttl <= 0:
+            return False
+        self.shared.set(key, value, ttl)
+        return True
+
+    def store(self, key: str, value: tuple):
+        """Store a value loaded elsewhere in both levels."""
+        if self.enabled and self.set_shared(key, value):
+            self.set_local(key, value, self.ttl(self.local_ttl, value[1]))
+
+    def count(self, counter: str):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, token: str) -> Optional[AppityToken]:
+        """Return the token row for a token string with its user, None when there is none."""
+        loaded = []
+
+        def load():
+            db_token = AppityToken.objects.select_related('user').filter(token=token).first()
+            if db_token is None:
+                return None, None
+            loaded.append(db_token)
+            return tuple(getattr(db_token, field) for field in TOKEN_FIELDS), db_token.expire_at
+
+        row, _ = self.lookup(token_key(token), load)
+        if loaded:
+            user = loaded[0].user
+            row = tuple(getattr(user, field) for field in USER_FIELDS)
+            self.store(user_key(user.pk), ((row, user.get_session_auth_hash()), None))
+            return loaded[0]
+        if row is None:
+            return None
+        db_token = AppityToken.from_db(None, TOKEN_FIELDS, row)
+        user = self.get_user(db_token.user_id)
+        if user is None:
+            return None
+        db_token.user = user
+        return db_token
+
+    def get_user(self, user_id: int) -> Optional[AppUser]:
+        def load():
+            user = AppUser.objects.filter(pk=user_id).first()
+            if user is None:
+                return None, None
+            return (tuple(getattr(user, field) for field in USER_FIELDS), user.get_session_auth_hash()), None
+
+        value, _ = self.lookup(user_key(user_id), load)
+        if value is None:
+            return None
+        user = AppUser.from_db(None, USER_FIELDS, value[0])
+        user.cached_session_auth_hash = value[1]
+        return user
+
+    def get_frontend(self, user_id: int, session_id: Optional[str]) -> Optional[AppityToken]:
+        """Return the frontend token of a user in a session, None when there is none."""
+        def load():
+            row = AppityToken.objects.filter(
+                user_id=user_id, session_id=session_id, frontend=True,
+            ).values_list('token', 'expire_at').first()
+            return row or (None, None)
+
+        token, _ = self.lookup(frontend_key(user_id, session_id), load)
+        if token is None:
+            return None
+        db_token = self.get(token)
+        if db_token is None or db_token.user_id != user_id or db_token.session_id != session_id:
+            return None
+        return db_token
+
+    def invalidate(self, tokens: Iterable[Tuple[str, int, Optional[str]]]):
+        """
+        Drop tokens from both levels.
+        :param tokens: ``(token, user_id, session_id)`` of every token
+        """
+        keys = []
+        for token, user_id, session_id in tokens:
+            keys.extend([token_key(token), frontend_key(user_id, session_id)])
+        if not keys:
+            return
+        with self.lock:
+            for key in keys:
+                self.local.pop(key, None)
+        self.shared.delete_many(keys)
+
+    def invalidate_user(self, user_id: int):
+        """Drop the cached user of the tokens of a user, after it changed."""
+        key = user_key(user_id)
+        with self.lock:
+            self.local.pop(key, None)
+        self.shared.delete(key)
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            local_hits, shared_hits, misses, local_size = (
+                self.local_hits, self.shared_hits, self.misses, len(self.local),
+            )
+        lookups = local_hits + shared_hits + misses
+        return dict(
+            local_hits=local_hits,
+            shared_hits=shared_hits,
+            misses=misses,
+            hit_ratio=round((local_hits + shared_hits) / lookups, 4) if lookups else 0.0,
+            local_size=local_size,
+        )
+
+
+token_cache = TokenCache()
+
+
+def invalidate_token(token: AppityToken):
+    token_cache.invalidate([(token.token, token.user_id, token.session_id)])
@@ -1,21 +1,24 @@
 from typing import Optional
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import user_login_failed
 
+from core.authentication.hashing import acheck_password, check_password, make_password
 from core.models import AppUser
 
+# set on the Django request by the async views, read by the DRF views they hand the request to
+VERIFIED_CREDENTIALS_ATTRIBUTE = '_appity_verified_credentials'
+PASSWORD_HASH_ATTRIBUTE = '_appity_password_hash'
+
 
 def match_user_for_invalid_authentication_input(input_value: str) -> Optional[AppUser]:
     return AppUser.objects.filter(email=input_value).first()
 
 
-def appity_authenticate_user(email: str, password: str, request) -> Optional[AppUser]:
-    matched_user = AppUser.objects.filter(email=email).first()  # type: AppUser
-    is_active = getattr(matched_user, 'is_active', None)
-    if not matched_user:
-        return None
-    if matched_user.check_password(password) and (is_active or is_active is None):
-        return matched_user
+def authentication_result(user: AppUser, password_valid: bool, email: str, request) -> Optional[AppUser]:
+    is_active = getattr(user, 'is_active', None)
+    if password_valid and (is_active or is_active is None):
+        return user
     else:
         user_login_failed.send(
             sender=__name__,
@@ -25,3 +28,43 @@ def appity_authenticate_user(email: str, password: str, request) -> Optional[App
             request=request
         )
         return None
+
+
+def appity_authenticate_user(email: str, password: str, request) -> Optional[AppUser]:
+    matched_user = AppUser.objects.filter(email=email).first()  # type: AppUser
+    if not matched_user:
+        return None
+    return authentication_result(matched_user, check_password(matched_user, password), email, request)
+
+
+async def aappity_authenticate_user(email: str, password: str, request) -> Optional[AppUser]:
+    """Async ``appity_authenticate_user``, the event loop keeps running while the password is checked."""
+    matched_user = await AppUser.objects.filter(email=email).afirst()  # type: AppUser
+    if not matched_user:
+        return None
+    password_valid = await acheck_password(matched_user, password)
+    return await sync_to_async(authentication_result)(matched_user, password_valid, email, request)
+
+
+def set_verified_credentials(request, email: str, password: str, user: Optional[AppUser]):
+    setattr(getattr(request, '_request', request), VERIFIED_CREDENTIALS_ATTRIBUTE, (email, password, user))
+
+
+def authenticate_user(email: str, password: str, request) -> Optional[AppUser]:
+    """``appity_authenticate_user`` reusing the result of the async login view for the same credentials."""
+    verified = getattr(getattr(request, '_request', request), VERIFIED_CREDENTIALS_ATTRIBUTE, None)
+    if verified and verified[:2] == (email, password):
+        return verified[2]
+    return appity_authenticate_user(email=email, password=password, request=request)
+
+
+def set_password_hash(request, password: str, encoded: str):
+    setattr(getattr(request, '_request', request), PASSWORD_HASH_ATTRIBUTE, (password, encoded))
+
+
+def get_password_hash(request, password: str) -> str:
+    """Hash of a password, made by the async sign up view when it hashed the same password."""
+    hashed = getattr(getattr(request, '_request', request), PASSWORD_HASH_ATTRIBUTE, None)
+    if hashed and hashed[0] == password:
+        return hashed[1]
+    return make_password(password)
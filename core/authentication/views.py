@@ -4,19 +4,25 @@ from django.utils.translation import gettext_lazy as _
 
 from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework import exceptions as rest_exceptions
-from rest_framework import throttling
 from rest_framework import permissions
 from rest_framework import viewsets
 from rest_framework.views import Response
 
 
-from core.authentication.token_authentication import get_token_from_request, token_login
-from core.authentication.utils import appity_authenticate_user
+from core.authentication.signed_tokens import SignedToken, get_settings, issue_signed_token, revoke_signed_token
+from core.authentication.token_authentication import (
+    OTP_TOKEN_MAX_LIFETIME_SECONDS, end_impersonation, generate_otp_token_for_request, get_impersonation,
+    get_token_from_request, start_impersonation, token_login,
+)
+from core.models.appity_token import AppityToken
+from core.authentication.utils import authenticate_user
+from core.exceptions import APIBadRequest
 from core.models.models import AppUser, UserToClient
+from core.throttling import AnonRateThrottle
 from core.authentication.serializers import LoginSerializer, SignUpSerializer
 from core.utils import login_without_password
 
-class LoginRateThrottle(throttling.AnonRateThrottle):
+class LoginRateThrottle(AnonRateThrottle):
     scope = 'login'
 
 
@@ -29,7 +35,7 @@ def login(request):
 
     data = serializer.validated_data
 
-    user = appity_authenticate_user(
+    user = authenticate_user(
         email=data['email'],
         password=data['password'],
         request=request,
@@ -47,12 +53,7 @@ def login(request):
 
         remember_me = data.get('remember_me', False)
         session_expiration_seconds = user.get_session_expiration_seconds(remember_me)
-        token_login(request, user, session_expiration_seconds)
-        if remember_me:
-            request.session.set_expiry(session_expiration_seconds)
-        else:
-            # setting 0 means session expires at browser close
-            request.session.set_expiry(0)
+        token_login(request, user, session_expiration_seconds, remember=remember_me)
 
         # request.session['ip'] = ip
 
@@ -75,6 +76,7 @@ def get_current_user_info(request):
         'full_name': user.get_full_name(),
         'email': user.email,
         'language': user.language,
+        'timezone': user.timezone,
         'appity_token': appity_token.get_info(session=request.session) if appity_token else None,
     }
 
@@ -120,23 +122,63 @@ def logout(request):
     if not user.is_authenticated:
         return Response(status=200)  # nothing should happen
     else:
+        if isinstance(request.auth, SignedToken):
+            revoke_signed_token(request.auth)
         auth.logout(request)
 
     return Response({'detail': _('Logged out')})
 
 
-class SignUpRateThrottle(throttling.AnonRateThrottle):
-    key = None
-    history = None
-    scope = 'signup'
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def signed_token(request):
+    """Issue a stateless signed access token for API clients."""
+    lifetime = get_settings()['LIFETIME']
+    return Response({
+        'token': issue_signed_token(request.user, lifetime=lifetime),
+        'expiry_seconds': lifetime,
+    })
 
-    def remove_last_history_item(self, request, view):
-        if self.rate is not None:
-            self.key = self.get_cache_key(request, view)
-            if self.key is not None:
-                self.history = self.cache.get(self.key, [])  # type: list
-                self.history.pop()
-                self.cache.set(self.key, self.history, self.duration)
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def otp_token(request):
+    """Issue a one-time token, passed as ``?fleio-token=`` where no header can be sent (e.g. download links)."""
+    token = generate_otp_token_for_request(request)
+    if token is None:
+        raise APIBadRequest(_('One-time tokens can only be issued for Appity tokens.'))
+    return Response({
+        'token': token,
+        'expiry_seconds': OTP_TOKEN_MAX_LIFETIME_SECONDS,
+    })
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def impersonate(request, user_id: int):
+    """Start acting as another user in the current session, the response holds the frontend token to use."""
+    if not request.user.can_impersonate:
+        raise rest_exceptions.PermissionDenied()
+    if not isinstance(request.auth, AppityToken) or not request.auth.frontend:
+        raise APIBadRequest(_('Impersonation requires a frontend session.'))
+    if get_impersonation(request):
+        raise APIBadRequest(_('Another user is already impersonated.'))
+    impersonated_user = AppUser.objects.filter(id=user_id, is_active=True).first()
+    if impersonated_user is None or impersonated_user.is_admin:
+        raise rest_exceptions.NotFound()
+    token = start_impersonation(impersonated_user=impersonated_user, request=request)
+    return Response({'appity_token': token.get_info(session=request.session)})
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def stop_impersonation(request):
+    end_impersonation(request)
+    return Response({'detail': _('Impersonation ended')})
+
+
+class SignUpRateThrottle(AnonRateThrottle):
+    scope = 'signup'
 
 
 class SignUpViewSet(viewsets.ViewSet):
@@ -158,7 +200,7 @@ class SignUpViewSet(viewsets.ViewSet):
 
         serializer = SignUpSerializer(data=request.data.copy(), context={'request': request})
         if not serializer.is_valid(raise_exception=False):
-            SignUpRateThrottle().remove_last_history_item(request, self)
+            SignUpRateThrottle().remove_last_request(request, self)
             raise rest_exceptions.ValidationError(serializer.errors)
 
         with transaction.atomic():
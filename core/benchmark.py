@@ -0,0 +1,28 @@
+"""Helpers shared by the benchmark management commands."""
+import math
+from typing import List
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(math.ceil(pct / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize_latencies(latencies: List[float]) -> dict:
+    """
+    Summarize latencies measured in seconds.
+    :return: dictionary with the count and the mean, p50, p95, p99 and max latencies in milliseconds
+    """
+    values = sorted(latencies)
+    count = len(values)
+    return dict(
+        count=count,
+        mean_ms=round(sum(values) / count * 1000, 3) if count else 0.0,
+        p50_ms=round(percentile(values, 50) * 1000, 3),
+        p95_ms=round(percentile(values, 95) * 1000, 3),
+        p99_ms=round(percentile(values, 99) * 1000, 3),
+        max_ms=round(values[-1] * 1000, 3) if count else 0.0,
+    )
@@ -0,0 +1,153 @@
+"""
+Per-user summary of client statuses.
+
+``ClientStatusSummary`` keeps, for every user, how many of the clients they belong to are in each ``ClientStatus``,
+so checks such as ``AppUser.clients_suspended`` read one row instead of counting clients. The counts are adjusted
+from signals (``core.signals``) in the transaction that changes a client status or a membership, with relative
+updates so concurrent changes add up. The client row is locked while its status or memberships change.
+
+Queryset ``update()`` and ``bulk_create()`` calls bypass the signals; run ``rebuild_client_status_summaries``
+afterwards, which also checks and repairs the summaries in bulk. Queryset ``delete()`` calls don't, Django sends the
+delete signals of every row since receivers are connected.
+"""
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+
+from core.models.client_status_summary import STATUS_FIELDS, ClientStatusSummary
+from core.models.models import Client, UserToClient
+
+DEFAULT_BATCH_SIZE = 1000
+
+# (user id, client status) a membership counts for, None when it does not count
+Contribution = Optional[Tuple[int, str]]
+
+
+@dataclass
+class RebuildStats:
+    users: int = 0
+    created: int = 0
+    updated: int = 0
+
+    def to_dict(self) -> dict:
+        return dict(users=self.users, created=self.created, updated=self.updated)
+
+
+def get_locked_status(client_id: int, using: Optional[str] = None) -> Optional[str]:
+    """Read a client status, locking the client row until the end of the transaction."""
+    return Client.objects.using(using).select_for_update().filter(pk=client_id).values_list(
+        'status', flat=True,
+    ).first()
+
+
+def ensure_summaries(user_ids: Iterable[int], using: Optional[str] = None):
+    ClientStatusSummary.objects.using(using).bulk_create(
+        [ClientStatusSummary(user_id=user_id) for user_id in user_ids], ignore_conflicts=True,
+    )
+
+
+def get_changes(deltas: Dict[str, int]) -> dict:
+    changes = {}
+    for status, delta in deltas.items():
+        if delta > 0:
+            changes[status] = F(status) + delta
+        elif delta < 0:
+            # never below zero, even for a summary out of sync
+            changes[status] = Greatest(F(status) + delta, 0)
+    return changes
+
+
+def adjust(user_ids, deltas: Dict[str, int], using: Optional[str] = None) -> int:
+    """
+    Add ``deltas`` (status to difference) to the summaries of some users.
+    :param user_ids: user ids, or a queryset of them
+    :return: number of summaries updated
+    """
+    changes = get_changes({status: delta for status, delta in deltas.items() if status in STATUS_FIELDS})
+    if not changes:
+        return 0
+    return ClientStatusSummary.objects.using(using).filter(user_id__in=user_ids).update(**changes)
+
+
+def client_status_changed(client_id: int, previous_status: str, status: str, using: Optional[str] = None):
+    """Move the members of a client from the count of its previous status to the count of the new one."""
+    if previous_status == status:
+        return
+    member_ids = UserToClient.objects.using(using).filter(client_id=client_id, invitation=False).values('user_id')
+    adjust(member_ids, {previous_status: -1, status: 1}, using=using)
+
+
+def membership_changed(previous: Contribution, current: Contribution, using: Optional[str] = None):
+    """Replace what a membership counted for before a change by what it counts for after."""
+    if previous == current:
+        return
+    if previous is not None:
+        adjust([previous[0]], {previous[1]: -1}, using=using)
+    if current is not None:
+        ensure_summaries([current[0]], using=using)
+        adjust([current[0]], {current[1]: 1}, using=using)
+
+
+def compute_counts(user_ids: List[int], using: Optional[str] = None) -> Dict[int, Dict[str, int]]:
+    """Count the clients of some users per status from their memberships."""
+    counts = {user_id: dict.fromkeys(STATUS_FIELDS, 0) for user_id in user_ids}
+    rows = UserToClient.objects.using(using).filter(user_id__in=user_ids, invitation=False).values(
+        'user_id', 'client__status',
+    ).annotate(count=Count('id')).order_by()
+    for row in rows:
+        if row['client__status'] in STATUS_FIELDS:
+            counts[row['user_id']][row['client__status']] = row['count']
+    return counts
+
+
+def rebuild_batch(user_ids: List[int], dry_run: bool = False, using: Optional[str] = None) -> RebuildStats:
+    stats = RebuildStats(users=len(user_ids))
+    with transaction.atomic(using=using):
+        # locks the memberships of the batch against concurrent signal updates
+        list(UserToClient.objects.using(using).select_for_update().filter(user_id__in=user_ids).values_list('id'))
+        counts = compute_counts(user_ids, using=using)
+        summaries = {
+            summary.user_id: summary
+            for summary in ClientStatusSummary.objects.using(using).select_for_update().filter(user_id__in=user_ids)
+        }
+        # users without clients need no summary
+        missing = [ClientStatusSummary(user_id=user_id, **counts[user_id]) for user_id in user_ids
+                   if user_id not in summaries and any(counts[user_id].values())]
+        stale = []
+        for user_id, summary in summaries.items():
+            if summary.to_dict() != counts[user_id]:
+                for status, count in counts[user_id].items():
+                    setattr(summary, status, count)
+                stale.append(summary)
+        stats.created, stats.updated = len(missing), len(stale)
+        if not dry_run:
+            ClientStatusSummary.objects.using(using).bulk_create(missing)
+            ClientStatusSummary.objects.using(using).bulk_update(stale, STATUS_FIELDS)
+    return stats
+
+
+def rebuild(user_ids: Optional[Iterable[int]] = None, batch_size: int = DEFAULT_BATCH_SIZE, dry_run: bool = False,
+            using: Optional[str] = None) -> RebuildStats:
+    """
+    Recount the summaries of all users, or of some, one batch of users per transaction.
+    :param dry_run: only report the summaries that are missing or wrong
+    """
+    users = get_user_model().objects.using(using).order_by('pk')
+    if user_ids is not None:
+        users = users.filter(pk__in=list(user_ids))
+    stats = RebuildStats()
+    last_id = None
+    while True:
+        batch = users if last_id is None else users.filter(pk__gt=last_id)
+        batch_ids = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not batch_ids:
+            return stats
+        batch_stats = rebuild_batch(batch_ids, dry_run=dry_run, using=using)
+        stats.users += batch_stats.users
+        stats.created += batch_stats.created
+        stats.updated += batch_stats.updated
+        last_id = batch_ids[-1]
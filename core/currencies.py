@@ -0,0 +1,107 @@
+"""
+In-process snapshot of currency rates and batched price conversion.
+
+Every worker keeps the rates of all ``Currency`` rows in memory. A version token in the shared cache names the current
+rates; it is replaced after any currency change commits, and workers compare it with the version of their snapshot
+at most every ``APPITY_CURRENCY_RATES['VERSION_CHECK']`` seconds, reloading the rates with one query when it differs.
+
+Rates are relative to a common base, the default currency normally has rate 1. Prices are stored in the default
+currency, so converting one multiplies by the target rate and divides by the default rate, rounded half up once
+at the end rather than after each step. ``Currency`` validates rates as positive; rows saved around the validation
+with a rate of zero or less are left out of the snapshot, as unknown currencies.
+"""
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from decimal import ROUND_HALF_UP, Decimal, localcontext
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from core.models.models import Currency
+
+VERSION_KEY = 'appity:currency-rates-version'
+DEFAULT_SETTINGS = {
+    'VERSION_CHECK': 1,
+    'CACHE': 'default',
+}
+
+
+def get_settings() -> dict:
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'APPITY_CURRENCY_RATES', {}))
+
+
+@dataclass(frozen=True)
+class RateSnapshot:
+    version: Optional[str]
+    rates: Dict[str, Decimal] = field(default_factory=dict)
+    default_code: Optional[str] = None
+
+    @property
+    def default_rate(self) -> Decimal:
+        return self.rates.get(self.default_code, Decimal(1))
+
+    def convert(self, amounts: Iterable[Decimal], currency: str, decimal_places: int = 2) -> List[Decimal]:
+        """
+        Convert amounts in the default currency to another currency.
+        :raise KeyError: for an unknown currency
+        """
+        rate, default_rate = self.rates[currency], self.default_rate
+        exponent = Decimal(1).scaleb(-decimal_places)
+        if rate == default_rate:
+            return [Decimal(amount).quantize(exponent, rounding=ROUND_HALF_UP) for amount in amounts]
+        with localcontext() as context:
+            # wide enough for 10 digit prices times 12 digit rates to stay exact before the division
+            context.prec = 40
+            return [(amount * rate / default_rate).quantize(exponent, rounding=ROUND_HALF_UP) for amount in amounts]
+
+
+class CurrencyRates:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None  # type: Optional[RateSnapshot]
+        self.checked_at = 0.0
+
+    @property
+    def shared(self):
+        return caches[get_settings()['CACHE']]
+
+    def get_snapshot(self) -> RateSnapshot:
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() < self.checked_at + get_settings()['VERSION_CHECK']:
+            return snapshot
+        version = self.shared.get(VERSION_KEY)
+        if snapshot is None or version is None or version != snapshot.version:
+            if version is None:
+                # the first worker to find no version names the current rates
+                self.shared.add(VERSION_KEY, uuid.uuid4().hex, None)
+                version = self.shared.get(VERSION_KEY)
+            snapshot = self.load(version)
+        with self.lock:
+            self.snapshot, self.checked_at = snapshot, time.monotonic()
+        return snapshot
+
+    @staticmethod
+    def load(version: Optional[str]) -> RateSnapshot:
+        rates, default_code = {}, None
+        for code, rate, is_default in Currency.objects.values_list('code', 'rate', 'is_default'):
+            if rate <= 0:
+                continue
+            rates[code] = rate
+            if is_default:
+                default_code = code
+        return RateSnapshot(version=version, rates=rates, default_code=default_code)
+
+    def invalidate(self):
+        """Make every worker reload the rates, call after the change is committed."""
+        self.shared.set(VERSION_KEY, uuid.uuid4().hex, None)
+        with self.lock:
+            self.snapshot = None
+
+    def convert(self, amounts: Iterable[Decimal], currency: str, decimal_places: int = 2) -> List[Decimal]:
+        return self.get_snapshot().convert(amounts, currency, decimal_places=decimal_places)
+
+
+currency_rates = CurrencyRates()
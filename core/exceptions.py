@@ -8,3 +8,8 @@ from rest_framework import status
 class APIBadRequest(rest_exceptions.APIException):
     status_code = status.HTTP_400_BAD_REQUEST
     default_detail = _('Unable to perform the requested operation')
+
+
+class APIConflict(rest_exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = _('The request conflicts with the current state of the resource')
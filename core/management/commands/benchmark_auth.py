@@ -0,0 +1,251 @@
+import datetime
+import json
+import random
+import subprocess  # nosec B404
+import time
+import uuid
+from importlib import import_module
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+
+from core.authentication.middleware import TokenAuthenticationMiddleware
+from core.authentication.token_authentication import SESSION_TOKEN_KEY, TokenAuthentication
+from core.authentication.token_cache import token_cache
+from core.benchmark import summarize_latencies
+from core.models.appity_token import AppityToken
+from core.throttling import SlidingWindowThrottle
+
+PATHS = (
+    'login', 'current_user', 'middleware', 'authenticate_valid', 'authenticate_expired', 'authenticate_missing',
+)
+BACKEND = 'django.contrib.auth.backends.AllowAllUsersModelBackend'
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure throughput, latency and queries of the authentication hot paths: login, current user, the token '
+        'middleware and token authentication with valid, expired and missing tokens. Seeds its own users, sessions '
+        'and tokens and removes them afterwards. Results can be saved as JSON and compared with an earlier run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Number of seeded users, each with a session')
+        parser.add_argument('--iterations', type=int, default=500, help='Measured operations per path')
+        parser.add_argument('--path', action='append', dest='paths', choices=PATHS, help='Path to benchmark')
+        parser.add_argument(
+            '--cold-cache', action='store_true', help='Clear the token cache before every operation',
+        )
+        parser.add_argument(
+            '--fast-hashing', action='store_true',
+            help='Hash passwords with MD5 so login latency shows everything but hashing',
+        )
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='JSON file of an earlier run to compare the results with')
+
+    def handle(self, *args, **options):
+        overrides = dict(ALLOWED_HOSTS=['testserver'])
+        if options['fast_hashing']:
+            overrides['PASSWORD_HASHERS'] = ['django.contrib.auth.hashers.MD5PasswordHasher']
+        with override_settings(**overrides), mock.patch.object(
+                SlidingWindowThrottle, 'allow_request', return_value=True,
+        ):
+            self.password = uuid.uuid4().hex
+            self.prefix = 'benchmark-{}'.format(uuid.uuid4().hex[:12])
+            started_at = time.perf_counter()
+            users, sessions = self.seed(options['users'], options['iterations'])
+            self.stdout.write('Seeded {} users, sessions and tokens in {:.2f}s'.format(
+                len(users), time.perf_counter() - started_at,
+            ))
+            try:
+                results = {}
+                for path in options['paths'] or PATHS:
+                    caches[token_cache.cache_alias].clear()
+                    token_cache.clear_local()
+                    results[path] = self.benchmark(path, users, sessions, options['iterations'], options['cold_cache'])
+                    self.report(path, results[path])
+            finally:
+                self.cleanup()
+        document = dict(
+            commit=self.get_commit(),
+            created_at=timezone.now().isoformat(),
+            database=connection.vendor,
+            session_engine=settings.SESSION_ENGINE,
+            users=options['users'],
+            iterations=options['iterations'],
+            cold_cache=options['cold_cache'],
+            fast_hashing=options['fast_hashing'],
+            results=results,
+        )
+        if options['compare']:
+            with open(options['compare']) as previous_file:
+                self.compare(json.load(previous_file), document)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(document, output_file, indent=2, sort_keys=True)
+            self.stdout.write('Results written to {}'.format(options['output']))
+        self.stdout.write(self.style.SUCCESS('Done'))
+
+    def seed(self, user_count: int, iterations: int):
+        """Create users, one session per user holding its frontend token, and expired tokens to authenticate with."""
+        user_model = get_user_model()
+        encoded = make_password(self.password)
+        users = user_model.objects.bulk_create([
+            user_model(email='{}-{}@example.com'.format(self.prefix, index), password=encoded)
+            for index in range(user_count)
+        ])
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        expire_date = timezone.now() + datetime.timedelta(days=1)
+        sessions = []
+        tokens = []
+        for user in users:
+            token = AppityToken.generate_token(user)
+            session_key = '{}{}'.format(self.prefix, uuid.uuid4().hex)[:40]
+            session_data = session_store().encode({
+                SESSION_KEY: user._meta.pk.value_to_string(user),
+                BACKEND_SESSION_KEY: BACKEND,
+                HASH_SESSION_KEY: user.get_session_auth_hash(),
+                SESSION_TOKEN_KEY: token,
+            })
+            sessions.append(Session(session_key=session_key, session_data=session_data, expire_date=expire_date))
+            tokens.append(AppityToken(
+                token=token, user=user, frontend=True, session_id=session_key, expire_at=expire_date,
+            ))
+        Session.objects.bulk_create(sessions, batch_size=500)
+        expired_at = timezone.now() - datetime.timedelta(minutes=1)
+        tokens.extend(
+            AppityToken(
+                token=AppityToken.generate_token(user), user=user, frontend=False, expire_at=expired_at,
+                display_name='{}-expired'.format(self.prefix),
+            )
+            for user in random.choices(users, k=iterations)  # nosec B311
+        )
+        AppityToken.objects.bulk_create(tokens, batch_size=500)
+        return users, {token.session_id: token.token for token in tokens if token.session_id}
+
+    def cleanup(self):
+        users = get_user_model().objects.filter(email__startswith='{}-'.format(self.prefix))
+        # seeded sessions and the ones created by logging in
+        Session.objects.filter(session_key__in=AppityToken.objects.filter(user__in=users).values('session_id')).delete()
+        users.delete()
+
+    def benchmark(self, path: str, users, sessions, iterations: int, cold_cache: bool) -> dict:
+        operations = self.get_operations(path, users, sessions, iterations)
+        latencies = []
+        query_count = 0
+        started_at = time.perf_counter()
+        for operation in operations:
+            if cold_cache:
+                caches[token_cache.cache_alias].clear()
+                token_cache.clear_local()
+            with CaptureQueriesContext(connection) as context:
+                operation_started_at = time.perf_counter()
+                operation()
+                latencies.append(time.perf_counter() - operation_started_at)
+            query_count += len(context.captured_queries)
+        elapsed = time.perf_counter() - started_at
+        result = summarize_latencies(latencies)
+        result['ops_per_second'] = round(len(latencies) / elapsed, 1) if elapsed else 0.0
+        result['queries'] = round(query_count / len(latencies), 2) if latencies else 0.0
+        return result
+
+    def get_operations(self, path: str, users, sessions, iterations: int):
+        """Build the measured operations of a path, setup such as picking a user stays out of the measurement."""
+        factory = RequestFactory()
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        session_items = list(sessions.items())
+
+        def token_request(token, session_key):
+            request = factory.get('/api/current-user/', HTTP_AUTHORIZATION='Fleio-Token {}'.format(token))
+            request.session = session_store(session_key)
+            return request
+
+        def authenticate(request, expect_user):
+            try:
+                result = TokenAuthentication().authenticate(Request(request))
+            except AuthenticationFailed:
+                result = None
+            if bool(result) != expect_user:
+                raise RuntimeError('Unexpected authentication result for {}'.format(path))
+
+        operations = []
+        if path == 'login':
+            for user in random.choices(users, k=iterations):  # nosec B311
+                client = APIClient()
+                data = {'email': user.email, 'password': self.password}
+                operations.append(lambda client=client, data=data: self.check_response(
+                    client.post('/api/login/', data, format='json'),
+                ))
+        elif path == 'current_user':
+            for session_key, token in random.choices(session_items, k=iterations):  # nosec B311
+                client = APIClient()
+                client.credentials(HTTP_AUTHORIZATION='Fleio-Token {}'.format(token))
+                client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+                operations.append(lambda client=client: self.check_response(client.get('/api/current-user/')))
+        elif path == 'middleware':
+            middleware = TokenAuthenticationMiddleware(lambda request: None)
+            for session_key, token in random.choices(session_items, k=iterations):  # nosec B311
+                request = token_request(token, session_key)
+                operations.append(lambda request=request: middleware.process_request(request))
+        elif path == 'authenticate_valid':
+            for session_key, token in random.choices(session_items, k=iterations):  # nosec B311
+                request = token_request(token, session_key)
+                operations.append(lambda request=request: authenticate(request, expect_user=True))
+        elif path == 'authenticate_expired':
+            expired_tokens = AppityToken.objects.filter(
+                display_name='{}-expired'.format(self.prefix),
+            ).values_list('token', flat=True)[:iterations]
+            for token in expired_tokens:
+                request = token_request(token, None)
+                operations.append(lambda request=request: authenticate(request, expect_user=False))
+        elif path == 'authenticate_missing':
+            for _ in range(iterations):
+                request = token_request(uuid.uuid4().hex, None)
+                operations.append(lambda request=request: authenticate(request, expect_user=False))
+        return operations
+
+    @staticmethod
+    def check_response(response):
+        if response.status_code != 200 or not response.json().get('user'):
+            raise RuntimeError('Request failed with status {}: {}'.format(response.status_code, response.content))
+
+    def report(self, path: str, result: dict):
+        self.stdout.write(
+            '  {:<20} ops/s={ops_per_second} queries/op={queries} mean={mean_ms}ms p50={p50_ms}ms '
+            'p95={p95_ms}ms p99={p99_ms}ms max={max_ms}ms'.format(path, **result)
+        )
+
+    def compare(self, previous: dict, current: dict):
+        self.stdout.write('Compared with {} ({})'.format(previous.get('commit') or '-', previous.get('created_at')))
+        for path, result in current['results'].items():
+            before = previous.get('results', {}).get(path)
+            if not before:
+                continue
+            changes = []
+            for key in ('ops_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'queries'):
+                if before.get(key):
+                    changes.append('{}={:+.1f}%'.format(key, (result[key] - before[key]) / before[key] * 100))
+                else:
+                    changes.append('{}={}->{}'.format(key, before.get(key), result[key]))
+            self.stdout.write('  {:<20} {}'.format(path, ' '.join(changes)))
+
+    @staticmethod
+    def get_commit():
+        try:
+            return subprocess.run(  # nosec B603 B607
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=settings.BASE_DIR,
+            ).stdout.strip() or None
+        except OSError:
+            return None
@@ -0,0 +1,123 @@
+import json
+import time
+import uuid
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from core.benchmark import summarize_latencies
+from core.throttling import SlidingWindowThrottle
+
+DEFAULT_ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'core.authentication.sessions.db',
+    'core.authentication.sessions.cached_db',
+)
+SESSION_WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare login and current user latency, queries and session writes across session engines. Requests go '
+        'through the whole middleware and view stack in process, without throttling. Creates its own user and '
+        'removes it afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help='Logins measured per engine')
+        parser.add_argument(
+            '--requests', type=int, default=5, help='Current user requests measured after each login',
+        )
+        parser.add_argument(
+            '--engine', action='append', dest='engines', help='Session engine to benchmark, repeat for more',
+        )
+        parser.add_argument(
+            '--fast-hashing', action='store_true',
+            help='Hash the password with MD5 so login latency shows session and token costs rather than hashing',
+        )
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        results = {}
+        hashers = ['django.contrib.auth.hashers.MD5PasswordHasher'] if options['fast_hashing'] else None
+        with mock.patch.object(SlidingWindowThrottle, 'allow_request', return_value=True):
+            for engine in options['engines'] or DEFAULT_ENGINES:
+                settings_overrides = dict(SESSION_ENGINE=engine, ALLOWED_HOSTS=['testserver'])
+                if hashers:
+                    settings_overrides['PASSWORD_HASHERS'] = hashers
+                with override_settings(**settings_overrides):
+                    results[engine] = self.benchmark(options['iterations'], options['requests'])
+                if not options['json']:
+                    self.report(engine, results[engine])
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+        else:
+            self.stdout.write(self.style.SUCCESS('Done'))
+
+    def report(self, engine, result):
+        self.stdout.write('Session engine "{}"'.format(engine))
+        for name in ('login', 'current_user'):
+            summary = result[name]
+            self.stdout.write(
+                '  {:<12} queries/request={} session writes/request={} '
+                'mean={mean_ms}ms p50={p50_ms}ms p95={p95_ms}ms p99={p99_ms}ms max={max_ms}ms'.format(
+                    name, summary['queries'], summary['session_writes'], **summary
+                )
+            )
+
+    def benchmark(self, iterations, requests):
+        email = 'benchmark-{}@example.com'.format(uuid.uuid4().hex)
+        password = uuid.uuid4().hex
+        user = get_user_model().objects.create_user(email=email, password=password)
+        caches['default'].clear()
+        latencies = {'login': [], 'current_user': []}
+        queries = {'login': [], 'current_user': []}
+        try:
+            for _ in range(iterations):
+                client = APIClient()
+                response, latency, captured = self.measure(
+                    client.post, '/api/login/', {'email': email, 'password': password}, format='json',
+                )
+                latencies['login'].append(latency)
+                queries['login'].append(captured)
+                token = response.json()['user']['appity_token']['token']
+                client.credentials(HTTP_AUTHORIZATION='Fleio-Token {}'.format(token))
+                for _ in range(requests):
+                    _, latency, captured = self.measure(client.get, '/api/current-user/')
+                    latencies['current_user'].append(latency)
+                    queries['current_user'].append(captured)
+        finally:
+            user.clear_sessions()
+            user.delete()
+        result = {}
+        for name, values in latencies.items():
+            result[name] = summarize_latencies(values)
+            count = len(queries[name]) or 1
+            result[name]['queries'] = round(sum(len(captured) for captured in queries[name]) / count, 2)
+            result[name]['session_writes'] = round(sum(
+                self.count_session_writes(captured) for captured in queries[name]
+            ) / count, 2)
+        return result
+
+    @staticmethod
+    def measure(method, *args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            started_at = time.perf_counter()
+            response = method(*args, **kwargs)
+            latency = time.perf_counter() - started_at
+        if response.status_code != 200:
+            raise RuntimeError('Request failed with status {}: {}'.format(response.status_code, response.content))
+        return response, latency, list(context.captured_queries)
+
+    @staticmethod
+    def count_session_writes(captured) -> int:
+        return sum(
+            1 for query in captured
+            if query['sql'].startswith(SESSION_WRITES) and 'django_session' in query['sql'].split('(')[0]
+        )
@@ -0,0 +1,39 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.authentication import reaper
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete expired sessions, expired or orphaned tokens, expired one-time tokens and stale signed token '
+        'revocations in chunks'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=reaper.DEFAULT_CHUNK_SIZE, help='Rows (or id range) deleted per chunk',
+        )
+        parser.add_argument(
+            '--concurrent', action='store_true',
+            help='Skip when another run holds the reaper lock, pause between chunks and retry locked chunks',
+        )
+        parser.add_argument('--json', action='store_true', help='Print statistics as JSON')
+
+    def handle(self, *args, **options):
+        started_at = time.monotonic()
+        stats = reaper.reap(chunk_size=options['chunk_size'], concurrent=options['concurrent'])
+        if stats is None:
+            self.stdout.write(self.style.WARNING('Another run holds the reaper lock, nothing done'))
+            return
+        if options['json']:
+            self.stdout.write(json.dumps({name: table_stats.to_dict() for name, table_stats in stats.items()}))
+            return
+        for table_stats in stats.values():
+            self.stdout.write('Deleted {} {} in {} chunk(s), {:.2f}s ({:.0f} rows/s)'.format(
+                table_stats.deleted, table_stats.name, table_stats.chunks, table_stats.seconds,
+                table_stats.rows_per_second,
+            ))
+        self.stdout.write(self.style.SUCCESS('Done in {:.2f}s'.format(time.monotonic() - started_at)))
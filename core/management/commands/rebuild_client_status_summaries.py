@@ -0,0 +1,38 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import client_status
+
+
+class Command(BaseCommand):
+    help = (
+        'Recount the per-user client status summaries from client memberships, creating missing summaries and '
+        'fixing wrong ones. With --check only reports them and fails when any is found.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', help='Only this user id')
+        parser.add_argument(
+            '--batch-size', type=int, default=client_status.DEFAULT_BATCH_SIZE, help='Users recounted per transaction',
+        )
+        parser.add_argument('--check', action='store_true', help='Report missing or wrong summaries, change nothing')
+        parser.add_argument('--json', action='store_true', help='Print statistics as JSON')
+
+    def handle(self, *args, **options):
+        started_at = time.monotonic()
+        stats = client_status.rebuild(
+            user_ids=options['users'], batch_size=options['batch_size'], dry_run=options['check'],
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(stats.to_dict()))
+        else:
+            self.stdout.write('{} {} missing and {} wrong summaries of {} user(s) in {:.2f}s'.format(
+                'Found' if options['check'] else 'Fixed', stats.created, stats.updated, stats.users,
+                time.monotonic() - started_at,
+            ))
+        if options['check'] and (stats.created or stats.updated):
+            raise CommandError('Client status summaries are out of sync')
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models.role import RoleClosure
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the role hierarchy closure rows from the role parents, creating missing rows and deleting wrong '
+        'ones. With --check only reports them and fails when any is found.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Report missing or wrong rows, change nothing')
+        parser.add_argument('--json', action='store_true', help='Print statistics as JSON')
+
+    def handle(self, *args, **options):
+        missing, wrong = RoleClosure.objects.rebuild(dry_run=options['check'])
+        if options['json']:
+            self.stdout.write(json.dumps(dict(missing=missing, wrong=wrong)))
+        else:
+            self.stdout.write('{} {} missing and {} wrong role closure rows'.format(
+                'Found' if options['check'] else 'Fixed', missing, wrong,
+            ))
+        if options['check'] and (missing or wrong):
+            raise CommandError('Role closure rows are out of sync')
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('Done'))
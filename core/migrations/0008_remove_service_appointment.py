@@ -0,0 +1,17 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:01
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_remove_client_currency'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='service',
+            name='appointment',
+        ),
+    ]
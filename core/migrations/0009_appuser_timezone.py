@@ -0,0 +1,19 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:16
+
+import core.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_remove_service_appointment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appuser',
+            name='timezone',
+            field=models.CharField(blank=True, default='', max_length=64, validators=[core.utils.validate_timezone]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_appuser_timezone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SignedTokenRevocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jti', models.CharField(blank=True, db_index=True, default=None, max_length=32, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expire_at', models.DateTimeField(db_index=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='signed_token_revocations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_signedtokenrevocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppityOtpToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(editable=False, max_length=40, unique=True)),
+                ('expire_at', models.DateTimeField(db_index=True)),
+                ('appity_token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='otp_tokens', to='core.appitytoken')),
+            ],
+            options={
+                'verbose_name': 'Appity-OTP-Token',
+            },
+        ),
+    ]
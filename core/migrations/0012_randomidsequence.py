@@ -0,0 +1,28 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:10
+
+import core.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_appityotptoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RandomIdSequence',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('generation', models.PositiveIntegerField(default=0)),
+                ('next_value', models.BigIntegerField(default=0)),
+                ('key', models.CharField(max_length=32)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='service',
+            name='id',
+            field=models.BigIntegerField(default=core.utils.RandomId('core.Service'), primary_key=True, serialize=False, unique=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_summaries(apps, schema_editor):
+    summary_model = apps.get_model('core', 'ClientStatusSummary')
+    counts = {}
+    memberships = apps.get_model('core', 'UserToClient').objects.filter(invitation=False).values_list(
+        'user_id', 'client__status',
+    )
+    for user_id, status in memberships.iterator():
+        user_counts = counts.setdefault(user_id, {})
+        user_counts[status] = user_counts.get(status, 0) + 1
+    summary_model.objects.bulk_create([
+        summary_model(user_id=user_id, **user_counts) for user_id, user_counts in counts.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_randomidsequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientStatusSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='client_status_summary', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('active', models.PositiveIntegerField(default=0)),
+                ('inactive', models.PositiveIntegerField(default=0)),
+                ('suspending', models.PositiveIntegerField(default=0)),
+                ('suspended', models.PositiveIntegerField(default=0)),
+                ('deleting', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'client status summaries',
+            },
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
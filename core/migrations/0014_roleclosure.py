@@ -0,0 +1,42 @@
+# Generated by Django 4.2.13 on 2026-10-18 12:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_closure(apps, schema_editor):
+    closure_model = apps.get_model('core', 'RoleClosure')
+    parents = dict(apps.get_model('core', 'Role').objects.values_list('id', 'parent_id'))
+    links = []
+    for role_id in parents:
+        ancestor_id, depth, seen = role_id, 0, set()
+        # existing data may hold a cycle, stop when it comes back around
+        while ancestor_id is not None and ancestor_id not in seen:
+            seen.add(ancestor_id)
+            links.append(closure_model(ancestor_id=ancestor_id, descendant_id=role_id, depth=depth))
+            ancestor_id, depth = parents.get(ancestor_id), depth + 1
+    closure_model.objects.bulk_create(links, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_clientstatussummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoleClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='core.role')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='core.role')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant', 'depth'], name='core_rolecl_descend_af6707_idx')],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(fill_closure, migrations.RunPython.noop),
+    ]
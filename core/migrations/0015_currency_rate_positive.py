@@ -0,0 +1,20 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:14
+
+from decimal import Decimal
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_roleclosure'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='currency',
+            name='rate',
+            field=models.DecimalField(decimal_places=6, default=1, max_digits=12, validators=[django.core.validators.MinValueValidator(Decimal('0.000001'))]),
+        ),
+    ]
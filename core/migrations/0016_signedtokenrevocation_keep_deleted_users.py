@@ -0,0 +1,20 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_currency_rate_positive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='signedtokenrevocation',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='signed_token_revocations', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:42
+
+from django.db import migrations, models
+
+
+def keep_one_default(apps, schema_editor):
+    Currency = apps.get_model('core', 'Currency')
+    defaults = Currency.objects.using(schema_editor.connection.alias).filter(is_default=True).order_by('code')
+    first = defaults.first()
+    if first is not None:
+        defaults.exclude(code=first.code).update(is_default=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_signedtokenrevocation_keep_deleted_users'),
+    ]
+
+    operations = [
+        migrations.RunPython(keep_one_default, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='currency',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_default', True)), fields=('is_default',), name='core_currency_single_default'),
+        ),
+    ]
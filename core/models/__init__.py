@@ -1,3 +1,5 @@
 from .models import *
-from .appity_token import AppityToken
-from .role import Role
+from .appity_token import AppityOtpToken, AppityToken, SignedTokenRevocation
+from .role import Role, RoleClosure
+from .random_id import RandomIdSequence
+from .client_status_summary import ClientStatusSummary
@@ -1,10 +1,10 @@
 import binascii
 import os
-from typing import Optional
+from typing import Optional, Tuple
 
 from django.contrib.sessions.backends.db import SessionStore
 from django.contrib.sessions.models import Session
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.utils import timezone
 
 from core.models.models import AppUser
@@ -46,9 +46,13 @@ class AppityToken(models.Model):
             return int((self.expire_at - timezone.now()).total_seconds())
         return None
 
+    @staticmethod
+    def generate_token(user) -> str:
+        return user.email[:2] + binascii.hexlify(os.urandom(19)).decode()
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         if (not update_fields or 'token' in update_fields) and not self.token:
-            self.token = self.user.email[:2] + binascii.hexlify(os.urandom(19)).decode()
+            self.token = self.generate_token(self.user)
         return super(AppityToken, self).save(
             force_insert=force_insert, force_update=force_update, update_fields=update_fields,
         )
@@ -83,3 +87,79 @@ class AppityToken(models.Model):
 
     def __str__(self):
         return '{}'.format(self.token)
+
+
+class SignedTokenRevocation(models.Model):
+    """
+    Revokes stateless signed access tokens: the one with ``jti``, or when ``jti`` is empty every token of the user
+    issued up to ``created_at``. Rows are only needed until ``expire_at``, when the revoked tokens have expired.
+    Rows outlive their user, deleting a user revokes the tokens still issued to them.
+    """
+    jti = models.CharField(max_length=32, default=None, null=True, blank=True, db_index=True)
+    user = models.ForeignKey(
+        AppUser, on_delete=models.DO_NOTHING, db_constraint=False, related_name='signed_token_revocations',
+    )
+    created_at = models.DateTimeField(default=timezone.now)
+    expire_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return '{}: {}'.format(self.user_id, self.jti or 'all')
+
+
+class AppityOtpTokenManager(models.Manager):
+    def consume(self, token: str) -> Optional[Tuple[int, bool]]:
+        """
+        Delete a one-time token, in a single ``DELETE ... RETURNING`` statement where the database supports it, so
+        concurrent uses can't both succeed.
+        :return: id of the Appity token it stands for and whether it had expired, None when there is no such token
+        """
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        now = timezone.now()
+        if connection.vendor == 'postgresql' or (
+                connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+        ):
+            with connection.cursor() as cursor:
+                quote_name = connection.ops.quote_name
+                cursor.execute(
+                    'DELETE FROM {} WHERE {} = %s RETURNING {}, {} < %s'.format(
+                        quote_name(self.model._meta.db_table),
+                        *(quote_name(self.model._meta.get_field(name).column)
+                          for name in ('token', 'appity_token', 'expire_at')),
+                    ),
+                    [token, connection.ops.adapt_datetimefield_value(now)],
+                )
+                row = cursor.fetchone()
+            return (row[0], bool(row[1])) if row else None
+        with transaction.atomic(using=using):
+            row = self.using(using).select_for_update().filter(token=token).values_list(
+                'appity_token_id', 'expire_at',
+            ).first()
+            if row is None:
+                return None
+            self.using(using).filter(token=token).delete()
+            return row[0], row[1] < now
+
+
+class AppityOtpToken(models.Model):
+    """Token used once in place of an Appity token, e.g. in download links where no header can be sent."""
+    token = models.CharField(max_length=40, unique=True, editable=False)
+    appity_token = models.ForeignKey(AppityToken, on_delete=models.CASCADE, related_name='otp_tokens')
+    expire_at = models.DateTimeField(db_index=True)
+
+    objects = AppityOtpTokenManager()
+
+    class Meta:
+        verbose_name = 'Appity-OTP-Token'
+
+    @property
+    def is_expired(self) -> bool:
+        return self.expire_at < timezone.now()
+
+    def save(self, *args, **kwargs):
+        if not self.token:
+            self.token = binascii.hexlify(os.urandom(20)).decode()
+        return super().save(*args, **kwargs)
+
+    def __str__(self):
+        return '{}'.format(self.token)
@@ -0,0 +1,33 @@
+from typing import Dict
+
+from django.conf import settings
+from django.db import models
+
+from .models import ClientStatus
+
+STATUS_FIELDS = tuple(ClientStatus.name_map)
+
+
+class ClientStatusSummary(models.Model):
+    """
+    Number of clients a user belongs to in each ``ClientStatus``, invitations excluded. Maintained by
+    ``core.client_status`` in the transaction changing a client status or a membership.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='client_status_summary',
+    )
+    active = models.PositiveIntegerField(default=0)
+    inactive = models.PositiveIntegerField(default=0)
+    suspending = models.PositiveIntegerField(default=0)
+    suspended = models.PositiveIntegerField(default=0)
+    deleting = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        app_label = 'core'
+        verbose_name_plural = 'client status summaries'
+
+    def to_dict(self) -> Dict[str, int]:
+        return {status: getattr(self, status) for status in STATUS_FIELDS}
+
+    def __str__(self):
+        return '{}: {}'.format(self.user_id, self.to_dict())
@@ -1,12 +1,14 @@
 import datetime
 from decimal import Decimal
-from typing import Optional
+from typing import Dict, Optional
 
 import pycountry
 from rest_framework.request import Request
 
-from django.db import models
-from django.http import HttpRequest
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.validators import MinValueValidator
+from django.db import models, router, transaction
+from django.db.models import Case, When
 from django.utils import timezone
 from django.contrib.sessions.models import Session
 from django.contrib.auth.models import AbstractUser, UserManager
@@ -14,7 +16,11 @@ from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django.utils.functional import cached_property
 
-from core.utils import RandomId, appity_create_user, appity_create_superuser
+from core.utils import LoadedValues, RandomId, appity_create_user, appity_create_superuser, validate_timezone
+
+# (user id, active client) memoized on the Django request by ``AppUser.get_active_client``
+ACTIVE_CLIENT_ATTRIBUTE = '_appity_active_client'
+
 
 # Create your models here.
 def get_default_currency():
@@ -23,6 +29,13 @@ def get_default_currency():
     except (Currency.MultipleObjectsReturned, Currency.DoesNotExist):
         return None
 
+def parse_client_id(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class AppityUserManager(UserManager):
     def create_user(self, username=None, email=None, password=None, **extra_fields):
         # username is not used, default to None
@@ -33,7 +46,7 @@ class AppityUserManager(UserManager):
         return appity_create_superuser(email, password, **extra_fields)
 
 
-class AppUser(AbstractUser):
+class AppUser(LoadedValues, AbstractUser):
     id = models.BigIntegerField(unique=True, default=RandomId('core.AppUser'), primary_key=True)
     email_verified = models.BooleanField(default=False)
     email_last_verified_at = models.DateTimeField(blank=True, null=True, default=None)
@@ -43,6 +56,8 @@ class AppUser(AbstractUser):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
     language = models.CharField(max_length=5, blank=True)
+    # IANA name used for availability and recurring appointments, empty for the default timezone
+    timezone = models.CharField(max_length=64, blank=True, default='', validators=[validate_timezone])
     is_superuser = models.BooleanField(default=False,
                                        help_text=('Designates that this user has all '
                                                   'permissions without explicitly assigning them.'),
@@ -54,6 +69,8 @@ class AppUser(AbstractUser):
     )
 
     objects = AppityUserManager()
+    # a changed timezone moves the availability of the user in UTC
+    loaded_fields = ('timezone',)
 
     class Meta:
         app_label = 'core'
@@ -72,51 +89,56 @@ class AppUser(AbstractUser):
     def __str__(self):
         return self.display
 
+    def get_session_auth_hash(self):
+        # users built from the token cache carry the hash instead of the password it is derived from
+        cached = self.__dict__.get('cached_session_auth_hash')
+        return cached if cached is not None else super().get_session_auth_hash()
+
     @property
     def managed_clients(self):
-        excluded_clients_ids = UserToClient.objects.filter(user=self, invitation=True).values_list(
-            'client__id', flat=True,
-        )
-        return self.clients.exclude(id__in=excluded_clients_ids).order_by('usertoclient')
+        """Clients the user belongs to, invitations excluded, in the order the user joined them."""
+        return Client.objects.filter(
+            usertoclient__user=self, usertoclient__invitation=False,
+        ).order_by('usertoclient')
 
     def get_active_client(self, request) -> Optional['Client']:
-        if request:
-            if self.is_admin:
-                # LOG.error('Method should not be called for an admin user !!!')
-                return None
-            if request.user.is_anonymous or request.user.is_admin:
-                # method is called from an admin user for a regular user, or by anonymous user,
-                # we do not have active client information here
-                return None
-
-            active_client_id = None
-            # attempt to retrieve active client based on request parameters
-            if isinstance(request, Request):
-                active_client_id = request.query_params.get('active_client')
-            elif isinstance(request, HttpRequest):
-                active_client_id = request.GET.get('active_client')
-
-            if active_client_id:
-                active_client = self.managed_clients.filter(id=active_client_id).first()
-                if active_client:
-                    if active_client_id != request.session.get('active_client_id'):
-                        # save active client id in session if not already present
-                        request.session['active_client_id'] = active_client_id
-                        # reset permission cache since client might have changed
-                        # active_client_changed.send(sender=self.__class__, user=self)
-                    return active_client
-
-            active_client_id = request.session.get('active_client_id')
-            active_client = self.managed_clients.filter(id=active_client_id).first()
-            if active_client:
-                return active_client
-            # LOG.info('Active client not found from request, returning first client for user {}'.format(self.display))
-        else:
+        """
+        Resolve the client the user acts for: the one in the ``active_client`` query parameter, the one stored in
+        the session or the first managed client, in a single query. The result is kept on the request and the
+        session is only written when the active client changes.
+        """
+        if not request:
             # LOG.warning('No request provided, returning first client for user {}'.format(self.display))
-            pass
-        active_client = self.managed_clients.first()
-        if request and active_client:
+            return self.managed_clients.first()
+        if self.is_admin:
+            # LOG.error('Method should not be called for an admin user !!!')
+            return None
+        if request.user.is_anonymous or request.user.is_admin:
+            # method is called from an admin user for a regular user, or by anonymous user,
+            # we do not have active client information here
+            return None
+
+        django_request = request._request if isinstance(request, Request) else request
+        resolved = getattr(django_request, ACTIVE_CLIENT_ATTRIBUTE, None)
+        if resolved is not None and resolved[0] == self.pk:
+            return resolved[1]
+
+        # attempt to retrieve active client based on request parameters, then on the session
+        requested_id = parse_client_id(django_request.GET.get('active_client'))
+        stored_id = parse_client_id(request.session.get('active_client_id'))
+        preferred_ids = [client_id for client_id in (requested_id, stored_id) if client_id is not None]
+        preferences = [When(id=client_id, then=priority) for priority, client_id in enumerate(preferred_ids)]
+        clients = self.managed_clients
+        if preferences:
+            clients = clients.order_by(Case(*preferences, default=len(preferences)), 'usertoclient')
+        active_client = clients.first()
+
+        if active_client and active_client.id != stored_id:
+            # save active client id in session if not already present
             request.session['active_client_id'] = active_client.id
+            # reset permission cache since client might have changed
+            # active_client_changed.send(sender=self.__class__, user=self)
+        setattr(django_request, ACTIVE_CLIENT_ATTRIBUTE, (self.pk, active_client))
         return active_client
 
     def get_full_name(self):
@@ -149,9 +171,23 @@ class AppUser(AbstractUser):
     def get_session_expiration_seconds(self, remember=False):
         return settings.USER_LONG_SESSION_SECONDS if remember else settings.USER_SHORT_SESSION_SECONDS
 
+    @cached_property
+    def client_status_counts(self) -> Dict[str, int]:
+        """Number of clients the user belongs to per ``ClientStatus``, from the maintained summary."""
+        try:
+            return self.client_status_summary.to_dict()
+        except ObjectDoesNotExist:
+            # no client yet
+            return dict.fromkeys(ClientStatus.name_map, 0)
+
     @property
     def clients_suspended(self) -> bool:
-        return self.clients.filter(status=ClientStatus.suspended).count() > 0  # noqa: clients relation defined below
+        return self.client_status_counts[ClientStatus.suspended] > 0
+
+    @property
+    def clients_blocked(self) -> bool:
+        """Whether any client of the user is in a blocking status."""
+        return any(self.client_status_counts[status] for status in ClientStatus.blocking_statuses)
 
     @staticmethod
     def create_invited_user(email):
@@ -162,9 +198,14 @@ class AppUser(AbstractUser):
         )
 
     def clear_sessions(self):
+        from core.authentication.signed_tokens import revoke
+        from core.authentication.token_cache import token_cache
+        tokens = list(self.tokens.values_list('token', 'user_id', 'session_id'))
         Session.objects.filter(session_key__in=self.tokens.values('session__session_key')).delete()
         # at this point Appity tokens should've also been deleted but just to be sure run another delete query for them
         self.tokens.all().delete()
+        token_cache.invalidate(tokens)
+        revoke(self.pk)
 
 
 
@@ -195,26 +236,46 @@ class CurrencyManager(models.Manager):
         return self.filter(is_default=True).first() or self.first()
 
 
-class Currency(models.Model):
+class Currency(LoadedValues, models.Model):
     code = models.CharField(max_length=3,
                             primary_key=True,
                             choices=[(i.alpha_3, i.alpha_3) for i in pycountry.currencies])
-    rate = models.DecimalField(default=1, max_digits=12, decimal_places=6)
+    # prices are divided by the rate of the default currency, rates must be positive
+    rate = models.DecimalField(
+        default=1, max_digits=12, decimal_places=6, validators=[MinValueValidator(Decimal('0.000001'))],
+    )
     is_default = models.BooleanField(default=False)
 
     objects = CurrencyManager()
+    loaded_fields = ('is_default',)
 
     class Meta:
         verbose_name_plural = 'currencies'
         app_label = 'core'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['is_default'], condition=models.Q(is_default=True), name='core_currency_single_default',
+            ),
+        ]
 
     def to_dict(self):
         return dict(code=self.code, rate=self.rate, is_default=self.is_default)
 
     def save(self, *args, **kwargs):
+        loaded_default = self.loaded_values['is_default'] if self.loaded_values is not None else None
+        if loaded_default == self.is_default:
+            # the flag didn't change since loading, writing it back could undo another currency becoming the default
+            if not self._state.adding and not args and kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [
+                    field.name for field in self._meta.concrete_fields if not field.primary_key and
+                    field.name != 'is_default'
+                ]
+            return super(Currency, self).save(*args, **kwargs)
         if self.is_default:
-            # NOTE(tomo): Remove any other defaults
-            Currency.objects.filter(is_default=True).exclude(code=self.code).update(is_default=False)
+            with transaction.atomic(using=kwargs.get('using') or router.db_for_write(Currency, instance=self)):
+                # NOTE(tomo): Remove any other defaults
+                Currency.objects.filter(is_default=True).exclude(code=self.code).update(is_default=False)
+                return super(Currency, self).save(*args, **kwargs)
         return super(Currency, self).save(*args, **kwargs)
 
     def __str__(self):
@@ -242,6 +303,11 @@ class Client(models.Model):
         app_label = 'core'
         ordering = ['-date_created']
 
+    def save(self, *args, **kwargs):
+        # the client status summaries of the members are updated in the same transaction
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(Client, instance=self)):
+            return super().save(*args, **kwargs)
+
 
 class UserToClient(models.Model):
     """
@@ -258,3 +324,8 @@ class UserToClient(models.Model):
     class Meta:
         unique_together = ('user', 'client')
         app_label = 'core'
+
+    def save(self, *args, **kwargs):
+        # the client status summary of the user is updated in the same transaction
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(UserToClient, instance=self)):
+            return super().save(*args, **kwargs)
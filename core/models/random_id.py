@@ -0,0 +1,18 @@
+from django.db import models
+
+
+class RandomIdSequence(models.Model):
+    """
+    Counter behind the ``RandomId`` ids of one model. ``next_value`` counts the ids handed out in the current
+    ``generation`` of the id range, ``key`` keys the permutation turning counter values into ids.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    generation = models.PositiveIntegerField(default=0)
+    next_value = models.BigIntegerField(default=0)
+    key = models.CharField(max_length=32)
+
+    class Meta:
+        app_label = 'core'
+
+    def __str__(self):
+        return '{}: {}/{}'.format(self.name, self.generation, self.next_value)
@@ -1,5 +1,21 @@
+"""
+Client roles and their hierarchy.
+
+``RoleClosure`` stores one row for every (ancestor, descendant) pair of the role tree, a role included as its own
+ancestor at depth 0, so ancestor and descendant lookups, cycle checks and the effective roles of a client are single
+indexed queries at any depth. ``Role.save`` keeps the rows in sync when a role is added or moved, in the same
+transaction, and ``core.signals`` unlinks the subtree of a deleted role, whose children become roots; queryset
+deletes send that signal for every role too.
+
+Queryset ``update()`` of ``parent`` and ``bulk_create()`` bypass ``Role.save``; run ``rebuild_role_closure``
+afterwards, which also checks and repairs the rows.
+"""
+from itertools import product
+from typing import Tuple
+
 from django.db import DataError
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import Q
 
 # from common.logger import get_fleio_logger
 from .models import Client
@@ -16,6 +32,11 @@ class RoleManager(models.Manager):
             pass
         return owner_role
 
+    def effective_for_client(self, client) -> models.QuerySet:
+        """Roles a client can use, public or its own, together with the roles they inherit from their ancestors."""
+        available = self.filter(Q(public=True) | Q(owner=client))
+        return self.filter(descendant_links__descendant__in=available).distinct()
+
 
 class Role(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -30,20 +51,136 @@ class Role(models.Model):
     objects = RoleManager()
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        parent = self.parent
-        while parent:
-            if parent.id == self.id:
-                raise DataError('You cannot set a descendant as parent')
-            parent = parent.parent
+        using = using or router.db_for_write(Role, instance=self)
+        with transaction.atomic(using=using):
+            adding = self._state.adding
+            parent_changed = adding
+            if not adding and (update_fields is None or 'parent' in update_fields):
+                previous = Role.objects.using(using).filter(pk=self.pk).values_list('parent_id', flat=True)
+                previous = list(previous)
+                # a row missing from the database is inserted
+                adding = not previous
+                parent_changed = adding or previous[0] != self.parent_id
+            if parent_changed and not adding and self.parent_id is not None:
+                # both roles stay locked so concurrent moves can't close a cycle between them
+                list(Role.objects.using(using).select_for_update().filter(
+                    pk__in=sorted([self.pk, self.parent_id]),
+                ).values_list('pk'))
+                if RoleClosure.objects.using(using).filter(ancestor_id=self.pk, descendant_id=self.parent_id).exists():
+                    raise DataError('You cannot set a descendant as parent')
+
+            super().save(
+                force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields,
+            )
+            if adding:
+                RoleClosure.objects.db_manager(using).link(self)
+            elif parent_changed:
+                RoleClosure.objects.db_manager(using).move(self)
 
-        return super().save(
-            force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields,
-        )
+    def ancestors(self, include_self: bool = False) -> models.QuerySet:
+        """Roles above this one, the parent first."""
+        links = Q(descendant_links__descendant=self)
+        if not include_self:
+            links &= Q(descendant_links__depth__gt=0)
+        return Role.objects.filter(links).order_by('descendant_links__depth')
+
+    def descendants(self, include_self: bool = False) -> models.QuerySet:
+        """Roles below this one, the children first."""
+        links = Q(ancestor_links__ancestor=self)
+        if not include_self:
+            links &= Q(ancestor_links__depth__gt=0)
+        return Role.objects.filter(links).order_by('ancestor_links__depth')
+
+    def is_descendant_of(self, role: 'Role') -> bool:
+        return self.pk != role.pk and RoleClosure.objects.filter(ancestor_id=role.pk, descendant_id=self.pk).exists()
 
     @property
     def display_name(self):
-        owner = '{}::'.format(self.owner.name) if self.owner else ''
+        owner = '{}::'.format(self.owner.company or self.owner.id) if self.owner_id else ''
         return '{}{}'.format(owner, self.name)
 
     def __str__(self):
         return '{}({})'.format(self.display_name, self.id)
+
+
+class RoleClosureManager(models.Manager):
+    def link(self, role: Role):
+        """Add the rows of a new role: itself and, when it has a parent, the ancestors of its parent."""
+        links = [RoleClosure(ancestor_id=role.pk, descendant_id=role.pk, depth=0)]
+        if role.parent_id is not None:
+            links.extend(
+                RoleClosure(ancestor_id=ancestor_id, descendant_id=role.pk, depth=depth + 1)
+                for ancestor_id, depth in self.filter(descendant_id=role.parent_id).values_list('ancestor_id', 'depth')
+            )
+        self.bulk_create(links)
+
+    def move(self, role: Role):
+        """Detach the subtree of a role from its previous ancestors and attach it below its current parent."""
+        subtree = list(self.filter(ancestor_id=role.pk).values_list('descendant_id', 'depth'))
+        self.unlink_subtree(role.pk, include_root=True)
+        if role.parent_id is None:
+            return
+        ancestors = self.filter(descendant_id=role.parent_id).values_list('ancestor_id', 'depth')
+        self.bulk_create([
+            RoleClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + depth + 1)
+            for (ancestor_id, ancestor_depth), (descendant_id, depth) in product(ancestors, subtree)
+        ], batch_size=1000)
+
+    def unlink_subtree(self, role_id: int, include_root: bool = False):
+        """
+        Delete the rows joining the subtree of a role to the roles above it.
+        :param include_root: also the rows of the role itself, otherwise only the rows of its descendants
+        """
+        ancestors = self.filter(descendant_id=role_id, depth__gt=0).values('ancestor_id')
+        descendants = self.filter(ancestor_id=role_id)
+        if not include_root:
+            descendants = descendants.filter(depth__gt=0)
+        self.filter(ancestor_id__in=ancestors, descendant_id__in=descendants.values('descendant_id')).delete()
+
+    def rebuild(self, dry_run: bool = False) -> Tuple[int, int]:
+        """
+        Recompute all rows from the parents of the roles, in one transaction.
+        :param dry_run: only count the rows that are missing or wrong
+        :return: number of missing rows and of wrong rows
+        """
+        with transaction.atomic(using=self.db):
+            parents = dict(Role.objects.using(self.db).select_for_update().values_list('id', 'parent_id'))
+            expected = {}
+            for role_id in parents:
+                ancestor_id, depth = role_id, 0
+                # a cycle left by a queryset update stops where it comes back around
+                while ancestor_id is not None and (ancestor_id, role_id) not in expected:
+                    expected[ancestor_id, role_id] = depth
+                    ancestor_id, depth = parents.get(ancestor_id), depth + 1
+            stale = []
+            for link_id, ancestor_id, descendant_id, depth in self.values_list(
+                    'id', 'ancestor_id', 'descendant_id', 'depth',
+            ):
+                if expected.get((ancestor_id, descendant_id)) == depth:
+                    del expected[ancestor_id, descendant_id]
+                else:
+                    stale.append(link_id)
+            if not dry_run:
+                self.filter(id__in=stale).delete()
+                self.bulk_create([
+                    RoleClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth)
+                    for (ancestor_id, descendant_id), depth in expected.items()
+                ], batch_size=1000)
+        return len(expected), len(stale)
+
+
+class RoleClosure(models.Model):
+    """Path from a role to one of its descendants, or to itself at depth 0."""
+    ancestor = models.ForeignKey(Role, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Role, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    objects = RoleClosureManager()
+
+    class Meta:
+        app_label = 'core'
+        unique_together = ('ancestor', 'descendant')
+        indexes = [models.Index(fields=['descendant', 'depth'])]
+
+    def __str__(self):
+        return '{} -> {} ({})'.format(self.ancestor_id, self.descendant_id, self.depth)
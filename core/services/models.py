@@ -2,9 +2,9 @@ from django.db import models
 
 from booking.models import Appointment
 from core.models.models import Client
-from core.utils import RandomId
+from core.utils import LoadedValues, RandomId
 
-class Service(models.Model):
+class Service(LoadedValues, models.Model):
     PRIVATE = 0
     PUBLIC = 1
 
@@ -13,7 +13,7 @@ class Service(models.Model):
         (PRIVATE, 'Private'),
     ]
 
-    id = models.BigIntegerField(unique=True, default=RandomId('core.Services'), primary_key=True)
+    id = models.BigIntegerField(unique=True, default=RandomId('core.Service'), primary_key=True)
     name = models.CharField(max_length=100)
     description = models.TextField(null=True)
     category = models.CharField(max_length=100, null=True)
@@ -23,6 +23,9 @@ class Service(models.Model):
     # appointment = models.ForeignKey(Appointment, related_name='services', on_delete=models.CASCADE,null=True, blank=True)
     client = models.ForeignKey(Client, related_name='services', on_delete=models.CASCADE)
 
+    # the name is the summary of the service's appointments in feeds
+    loaded_fields = ('name',)
+
     class Meta:
         app_label = 'core'
         verbose_name = 'services'
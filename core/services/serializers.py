@@ -1,13 +1,49 @@
 from rest_framework import serializers
+from rest_framework.settings import api_settings
+from core.currencies import currency_rates
 from core.models.models import Client
 from core.services.models import Service
 
+
+class ServiceListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        services = list(data.all() if hasattr(data, 'all') else data)
+        representation = super().to_representation(services)
+        currency = self.context.get('currency')
+        if currency:
+            # all prices of the listing in one pass over the same rates
+            prices = currency_rates.convert(
+                [service.price for service in services], currency,
+                decimal_places=self.child.fields['price'].decimal_places,
+            )
+            for item, price in zip(representation, prices):
+                self.child.set_price(item, price, currency)
+        return representation
+
+
 class ServiceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Service
         fields = ('name', 'description', 'category', 'price', 'access', 'duration', 'client',)
+        list_serializer_class = ServiceListSerializer
 
     def validate_client(self, value):
         if not Client.objects.filter(pk=value.id).exists():
             raise serializers.ValidationError("The client does not exist.")
         return value
+
+    def set_price(self, data: dict, price, currency: str):
+        # converted prices may have more digits than the field allows, skip its quantizing
+        coerce_to_string = getattr(self.fields['price'], 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+        data['price'] = '{:f}'.format(price) if coerce_to_string else price
+        data['currency'] = currency
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        currency = self.context.get('currency')
+        if currency and not isinstance(self.parent, ServiceListSerializer):
+            price, = currency_rates.convert(
+                [instance.price], currency, decimal_places=self.fields['price'].decimal_places,
+            )
+            self.set_price(data, price, currency)
+        return data
@@ -1,5 +1,8 @@
 from django.shortcuts import render
+from django.utils.translation import gettext_lazy as _
 from rest_framework import viewsets
+from core.currencies import currency_rates
+from core.exceptions import APIBadRequest
 from core.permissions import CustomPermissions, EndUserOnly
 from core.services.models import Service
 from core.services.serializers import ServiceSerializer
@@ -9,3 +12,18 @@ class ServicesViewSet(viewsets.ModelViewSet):
     queryset = Service.objects.all()
     serializer_class = ServiceSerializer
     permission_classes = (CustomPermissions, EndUserOnly,)
+
+    def get_currency(self):
+        """Currency code of the ``currency`` query parameter prices are converted to, None to keep them as stored."""
+        currency = self.request.query_params.get('currency')
+        if not currency or self.request.method != 'GET':
+            return None
+        currency = currency.upper()
+        if currency not in currency_rates.get_snapshot().rates:
+            raise APIBadRequest(_('Unknown currency {}.').format(currency))
+        return currency
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['currency'] = self.get_currency()
+        return context
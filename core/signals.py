@@ -0,0 +1,117 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from core import client_status
+from core.authentication.signed_tokens import revoke
+from core.authentication.token_cache import invalidate_token, token_cache
+from core.currencies import currency_rates
+from core.models.appity_token import AppityToken
+from core.models.models import AppUser, Client, Currency, UserToClient
+from core.models.role import Role, RoleClosure
+
+
+@receiver(post_save, sender=AppityToken)
+def appity_token_saved(sender, instance, created, **kwargs):
+    if not created:
+        # e.g. a new expiration date
+        invalidate_token(instance)
+
+
+@receiver(post_delete, sender=AppityToken)
+def appity_token_deleted(sender, instance, **kwargs):
+    invalidate_token(instance)
+
+
+@receiver(pre_save, sender=AppUser)
+def user_pre_save(sender, instance, raw=False, **kwargs):
+    # only deactivations matter, skip the lookup for active users
+    instance._deactivated = bool(
+        not raw and not instance._state.adding and not instance.is_active and
+        AppUser.objects.filter(pk=instance.pk, is_active=True).exists()
+    )
+
+
+@receiver(post_save, sender=AppUser)
+def user_saved(sender, instance, created, raw=False, **kwargs):
+    if getattr(instance, '_deactivated', False):
+        revoke(instance.pk)
+    if not created:
+        token_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=AppUser)
+def user_deleted(sender, instance, **kwargs):
+    # signed tokens of the user stay valid until they expire otherwise
+    revoke(instance.pk)
+    token_cache.invalidate_user(instance.pk)
+
+
+@receiver(pre_save, sender=Client)
+def client_pre_save(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+    instance._previous_status = None
+    if raw or instance._state.adding or (update_fields is not None and 'status' not in update_fields):
+        return
+    instance._previous_status = client_status.get_locked_status(instance.pk, using=using)
+
+
+@receiver(post_save, sender=Client)
+def client_saved(sender, instance, created, raw=False, using=None, **kwargs):
+    previous_status = getattr(instance, '_previous_status', None)
+    if not raw and previous_status is not None:
+        client_status.client_status_changed(instance.pk, previous_status, instance.status, using=using)
+
+
+def get_membership_contribution(user_id, client_id, invitation, using=None):
+    if invitation:
+        return None
+    status = client_status.get_locked_status(client_id, using=using)
+    return (user_id, status) if status is not None else None
+
+
+@receiver(pre_save, sender=UserToClient)
+def user_to_client_pre_save(sender, instance, raw=False, using=None, **kwargs):
+    instance._previous_contribution = None
+    if raw or instance._state.adding:
+        return
+    previous = UserToClient.objects.using(using).select_for_update().filter(pk=instance.pk).values_list(
+        'user_id', 'client_id', 'invitation',
+    ).first()
+    if previous is not None:
+        instance._previous_contribution = get_membership_contribution(*previous, using=using)
+
+
+@receiver(post_save, sender=UserToClient)
+def user_to_client_saved(sender, instance, created, raw=False, using=None, **kwargs):
+    if raw:
+        return
+    client_status.membership_changed(
+        getattr(instance, '_previous_contribution', None),
+        get_membership_contribution(instance.user_id, instance.client_id, instance.invitation, using=using),
+        using=using,
+    )
+
+
+@receiver(post_delete, sender=UserToClient)
+def user_to_client_deleted(sender, instance, using=None, origin=None, **kwargs):
+    if instance.invitation or (isinstance(origin, AppUser) and origin.pk == instance.user_id):
+        # the summary is deleted with the user
+        return
+    if isinstance(origin, Client) and origin.pk == instance.client_id:
+        status = origin.status
+    else:
+        status = client_status.get_locked_status(instance.client_id, using=using)
+    if status is not None:
+        client_status.membership_changed((instance.user_id, status), None, using=using)
+
+
+@receiver(pre_delete, sender=Role)
+def role_pre_delete(sender, instance, using=None, **kwargs):
+    # the children are left as roots, the rows of the role itself are deleted with it
+    RoleClosure.objects.db_manager(using).unlink_subtree(instance.pk)
+
+
+@receiver(post_save, sender=Currency)
+@receiver(post_delete, sender=Currency)
+def currency_changed(sender, instance, raw=False, using=None, **kwargs):
+    transaction.on_commit(currency_rates.invalidate, using=using)
@@ -1,3 +1,605 @@
-from django.test import TestCase
+import datetime
+import threading
+import time
+from io import StringIO
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import DataError, OperationalError, transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+
+from core.authentication import reaper, signed_tokens
+from core.authentication.token_authentication import (
+    IMPERSONATION_SESSION_KEY, end_impersonation, generate_otp_token_for_token, get_impersonation, sign_impersonation,
+)
+from core.authentication.hashing import HashingPool, HashingPoolSaturated
+from core.authentication.token_cache import TokenCache, token_cache
+from core.currencies import currency_rates
+from core.throttling import SlidingWindowThrottle
+from core.models import AppUser
+from core.models.appity_token import AppityOtpToken, AppityToken, SignedTokenRevocation
+from core.models.client_status_summary import ClientStatusSummary
+from core.models.models import Client, ClientStatus, Currency, UserToClient
+from core.models.random_id import RandomIdSequence
+from core.models.role import Role, RoleClosure
+from core.services.models import Service
+from core.utils import FeistelPermutation, RandomId
+
+
+class TokenAuthenticationQueriesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        token_cache.clear_local()
+        # as with a cache shared by all workers
+        patcher = mock.patch.object(token_cache, 'enabled', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+        self.client = APIClient()
+        response = self.client.post(
+            '/api/login/', {'email': 'user@example.com', 'password': 'secret-password'}, format='json',
+        )
+        self.token = response.json()['user']['appity_token']['token']
+        self.client.credentials(HTTP_AUTHORIZATION='Fleio-Token {}'.format(self.token))
+
+    def get_current_user(self):
+        response = self.client.get('/api/current-user/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user']['id'], self.user.id)
+        self.assertEqual(response.json()['user']['appity_token']['token'], self.token)
+
+    def test_cold_token_cache(self):
+        cache.clear()
+        token_cache.clear_local()
+        # session, token joined with its user
+        with self.assertNumQueries(2):
+            self.get_current_user()
+
+    def test_cached_token(self):
+        self.get_current_user()
+        # only the session: neither the token nor its user, no session save
+        with self.assertNumQueries(1):
+            self.get_current_user()
+        with self.assertNumQueries(1):
+            self.get_current_user()
+
+    def test_process_cache(self):
+        # the test settings keep the default local memory cache, other workers would never see deletes
+        self.assertFalse(TokenCache().enabled)
+        with override_settings(APPITY_TOKEN_CACHE={'ENABLED': True}):
+            self.assertTrue(TokenCache().enabled)
+        with mock.patch.object(token_cache, 'enabled', False):
+            # session, token joined with its user
+            with self.assertNumQueries(2):
+                self.get_current_user()
+
+    def test_deactivated_user(self):
+        self.get_current_user()
+        self.user.is_active = False
+        self.user.save()
+        # the cached user is dropped, the view is open to anonymous users
+        self.assertNotIn('user', self.client.get('/api/current-user/').json())
+
+    def test_revoked_in_other_worker(self):
+        # the in-process level of another worker
+        other = TokenCache()
+        other.enabled = True
+        self.assertEqual(other.get(self.token).user_id, self.user.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(other.get(self.token).user_id, self.user.id)
+        # the token and its user
+        self.assertEqual(other.stats()['local_hits'], 2)
+        self.client.post('/api/logout/')
+        # accepted from local memory until LOCAL_TTL, without a shared cache read
+        with mock.patch('core.authentication.token_cache.caches') as shared_caches:
+            self.assertEqual(other.get(self.token).user_id, self.user.id)
+        shared_caches.__getitem__.assert_not_called()
+        later = time.monotonic() + other.local_ttl
+        with mock.patch('core.authentication.token_cache.time.monotonic', return_value=later):
+            self.assertIsNone(other.get(self.token))
+
+
+class SignedTokenTest(TestCase):
+    def setUp(self):
+        signed_tokens.revocations.clear()
+        self.user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+
+    def test_revoke_all(self):
+        revoked = signed_tokens.issue_signed_token(self.user)
+        self.assertEqual(signed_tokens.verify_signed_token(revoked).user_id, self.user.id)
+        signed_tokens.revoke(self.user.pk)
+        # issued within the same second as the revocation
+        token = signed_tokens.issue_signed_token(self.user)
+        with self.assertRaises(signed_tokens.InvalidSignedToken):
+            signed_tokens.verify_signed_token(revoked)
+        signed_token = signed_tokens.verify_signed_token(token)
+        signed_tokens.revoke_signed_token(signed_token)
+        with self.assertRaises(signed_tokens.InvalidSignedToken):
+            signed_tokens.verify_signed_token(token)
+
+    def test_inactive_or_deleted_user(self):
+        token = signed_tokens.issue_signed_token(self.user)
+        # an update skips the revocation done when a user is deactivated
+        AppUser.objects.filter(pk=self.user.pk).update(is_active=False)
+        with self.assertRaises(AuthenticationFailed):
+            signed_tokens.LazyUser(self.user.pk).email
+        user_id = self.user.pk
+        self.user.delete()
+        with self.assertRaises(signed_tokens.InvalidSignedToken):
+            signed_tokens.verify_signed_token(token)
+        self.assertTrue(SignedTokenRevocation.objects.filter(user_id=user_id).exists())
+        with self.assertRaises(AuthenticationFailed):
+            signed_tokens.LazyUser(user_id).email
+
+
+class ReaperTest(TestCase):
+    def setUp(self):
+        cache.delete(reaper.REAPER_LOCK_KEY)
+        self.user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+        now = timezone.now()
+        self.past, self.future = now - datetime.timedelta(hours=1), now + datetime.timedelta(hours=1)
+        sessions = [
+            Session.objects.create(session_key='session{}'.format(index), session_data='', expire_date=expire_date)
+            for index, expire_date in enumerate([self.past] * 3 + [self.future])
+        ]
+        self.tokens = [AppityToken.objects.create(user=self.user, session=session) for session in sessions]
+        self.tokens.append(AppityToken.objects.create(user=self.user, expire_at=self.past))
+        self.tokens.append(AppityToken.objects.create(user=self.user, expire_at=self.future))
+        for token in self.tokens[2:4]:
+            AppityOtpToken.objects.create(appity_token=token, expire_at=self.past)
+            AppityOtpToken.objects.create(appity_token=token, expire_at=self.future)
+        for expire_at in (self.past, self.future):
+            SignedTokenRevocation.objects.create(user=self.user, expire_at=expire_at)
+
+    def test_reap(self):
+        stats = reaper.reap(chunk_size=2)
+        # tokens and one-time tokens of expired sessions go with them
+        self.assertEqual(
+            {name: stat.deleted for name, stat in stats.items()},
+            {'sessions': 3, 'tokens': 4, 'otp_tokens': 3, 'revocations': 1},
+        )
+        self.assertEqual(stats['sessions'].chunks, 2)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['session3'])
+        self.assertEqual(
+            set(AppityToken.objects.values_list('id', flat=True)), {self.tokens[3].id, self.tokens[5].id},
+        )
+        self.assertEqual(list(AppityOtpToken.objects.values_list('expire_at', flat=True)), [self.future])
+        self.assertEqual(list(SignedTokenRevocation.objects.values_list('expire_at', flat=True)), [self.future])
+        # nothing left to do
+        stats = reaper.reap(chunk_size=2)
+        self.assertEqual(sum(stat.deleted for stat in stats.values()), 0)
+
+    def test_concurrent_lock(self):
+        cache.add(reaper.REAPER_LOCK_KEY, True)
+        self.assertIsNone(reaper.reap(concurrent=True))
+        self.assertEqual(Session.objects.count(), 4)
+        cache.delete(reaper.REAPER_LOCK_KEY)
+        self.assertEqual(reaper.reap(concurrent=True)['sessions'].deleted, 3)
+        self.assertIsNone(cache.get(reaper.REAPER_LOCK_KEY))
+
+
+class HashingPoolTest(TestCase):
+    @override_settings(APPITY_PASSWORD_HASHING={'WORKERS': 1, 'QUEUE': 1, 'RETRY_AFTER': 3})
+    def test_saturated(self):
+        pool, release = HashingPool(), threading.Event()
+        futures = [pool.submit(release.wait) for _ in range(2)]
+        with self.assertRaises(HashingPoolSaturated) as raised:
+            pool.submit(release.wait)
+        self.assertEqual(raised.exception.wait, 3)
+        self.assertEqual(pool.rejected, 1)
+        release.set()
+        for future in futures:
+            future.result()
+        # the single worker runs the callbacks releasing the slots before taking the next function
+        pool.executor.submit(lambda: None).result()
+        self.assertEqual(pool.run(sum, [1, 2]), 3)
+        pool.executor.shutdown()
+
+    def test_login_saturated(self):
+        with mock.patch(
+                'core.authentication.async_views.aappity_authenticate_user', side_effect=HashingPoolSaturated(wait=2),
+        ):
+            response = self.client.post(
+                '/api/login/', {'email': 'user@example.com', 'password': 'secret-password'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+
+
+class CountingThrottle(SlidingWindowThrottle):
+    rate = '10/min'
+
+    def __init__(self, now: float):
+        super().__init__()
+        self.timer = lambda: now
+
+    def get_cache_key(self, request, view):
+        return 'throttle:test'
+
+
+class SlidingWindowThrottleTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def allowed(self, now: float, count: int) -> int:
+        return sum(CountingThrottle(now).allow_request(None, None) for _ in range(count))
+
+    def test_sliding_window(self):
+        start = 60 * 1000
+        self.assertEqual(self.allowed(start + 10, 12), 10)
+        throttle = CountingThrottle(start + 20)
+        self.assertFalse(throttle.allow_request(None, None))
+        # room for one more once this window, then the previous one, weighs 9 requests: 6 seconds into the next
+        self.assertEqual(throttle.wait(), 46)
+        # half of the previous window still counts, leaving room for 5 requests
+        self.assertFalse(CountingThrottle(start + 90).would_throttle(None, None))
+        self.assertEqual(self.allowed(start + 90, 10), 5)
+        self.assertTrue(CountingThrottle(start + 90).would_throttle(None, None))
+        # a quarter of it 15 seconds later, 2.5 + 7 requests
+        self.assertEqual(self.allowed(start + 105, 10), 2)
+        # half of the 7 requests counted in the previous window
+        self.assertEqual(self.allowed(start + 150, 10), 6)
+        self.assertEqual(self.allowed(start + 300, 20), 10)
+
+class OtpTokenTest(TestCase):
+    def setUp(self):
+        self.user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+        self.token = AppityToken.objects.create(user=self.user)
+
+    def test_consume(self):
+        otp = generate_otp_token_for_token(self.token)
+        self.assertEqual(AppityOtpToken.objects.consume(otp), (self.token.id, False))
+        self.assertIsNone(AppityOtpToken.objects.consume(otp))
+        expired = AppityOtpToken.objects.create(
+            appity_token=self.token, expire_at=timezone.now() - datetime.timedelta(seconds=1),
+        )
+        self.assertEqual(AppityOtpToken.objects.consume(expired.token), (self.token.id, True))
+        self.assertFalse(AppityOtpToken.objects.exists())
+
+    def test_used_once(self):
+        otp = generate_otp_token_for_token(self.token)
+        response = APIClient().get('/api/current-user/', {'fleio-token': otp})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user']['id'], self.user.id)
+        # anonymous, in a new session
+        response = APIClient().get('/api/current-user/', {'fleio-token': otp})
+        self.assertNotIn('user', response.json())
+
+
+class ImpersonationSnapshotTest(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/api/current-user/')
+        self.request.session = SessionStore()
+        self.impersonation = {'impersonator': 1, 'impersonate': 2, 'impersonator_token': 'first', 'token': 'second'}
+        self.impersonation['signature'] = sign_impersonation(self.impersonation)
+        self.request.session.update({'impersonator': 1, 'impersonate': 2})
+
+    def test_signed(self):
+        self.request.session[IMPERSONATION_SESSION_KEY] = self.impersonation
+        self.assertEqual(get_impersonation(self.request), self.impersonation)
+        self.request.session[IMPERSONATION_SESSION_KEY] = dict(self.impersonation, impersonate=3)
+        self.assertIsNone(get_impersonation(self.request))
+
+    def test_partial(self):
+        for field in ('impersonator_token', 'token', 'signature'):
+            snapshot = dict(self.impersonation)
+            del snapshot[field]
+            self.request.session[IMPERSONATION_SESSION_KEY] = snapshot
+            self.assertIsNone(get_impersonation(self.request))
+        # sessions from before the snapshot
+        self.request.session[IMPERSONATION_SESSION_KEY] = True
+        self.assertIsNone(get_impersonation(self.request))
+        end_impersonation(self.request)
+        self.assertEqual(dict(self.request.session), {})
+
+
+SMALL_RANDOM_ID = {
+    'default': {'MIN': 1000, 'MAX': 999999, 'GROWTH_FACTOR': 10, 'BLOCK_SIZE': 100},
+    'core.Service': {'MIN': 1, 'MAX': 10, 'GROWTH_FACTOR': 10, 'BLOCK_SIZE': 4},
+}
+
+
+class RandomIdTest(TestCase):
+    def setUp(self):
+        RandomId.local.blocks = {}
+
+    def test_permutation(self):
+        for size in (4, 1000, 4097):
+            permutation = FeistelPermutation(size, b'key')
+            self.assertEqual(sorted(permutation(value) for value in range(size)), list(range(size)))
+
+    def test_unique(self):
+        ids = RandomId('core.AppUser').bulk(2000)
+        self.assertEqual(len(set(ids)), 2000)
+        self.assertTrue(all(1000 <= rid <= 999999 for rid in ids))
+        # one reservation in a savepoint, then one check of existing ids per 1000 ids
+        with self.assertNumQueries(6):
+            ids += RandomId('core.AppUser').bulk(2000)
+        self.assertEqual(len(set(ids)), 4000)
+
+    @override_settings(APPITY_RANDOM_ID=SMALL_RANDOM_ID)
+    def test_generations(self):
+        ids = RandomId('core.Service').bulk(15)
+        self.assertEqual(sorted(ids[:10]), list(range(1, 11)))
+        self.assertTrue(all(11 <= rid <= 100 for rid in ids[10:]))
+        sequence = RandomIdSequence.objects.get(name='core.Service')
+        self.assertEqual((sequence.generation, sequence.next_value), (1, 5))
+        self.assertEqual(len(set(ids + RandomId('core.Service').bulk(85))), 100)
+
+    @override_settings(APPITY_RANDOM_ID=SMALL_RANDOM_ID)
+    def test_existing_ids(self):
+        client = Client.objects.create(
+            company='client', address1='Street 1', city='City', country='RO', zip_code='1000', phone='0000',
+        )
+        Service.objects.bulk_create([
+            Service(id=rid, name='service {}'.format(rid), price=Decimal(1), duration=30, client=client)
+            for rid in range(1, 6)
+        ])
+        ids = RandomId('core.Service').bulk(6)
+        self.assertEqual(sorted(ids[:5]), list(range(6, 11)))
+        self.assertGreater(ids[5], 10)
+
+    @override_settings(APPITY_RANDOM_ID=SMALL_RANDOM_ID)
+    def test_spare_ids_after_commit(self):
+        RandomIdSequence.objects.create(name='core.Service', key='0' * 32)
+        # the test transaction never commits, the counter values reserved in it go back on rollback
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                ids = RandomId('core.Service').bulk(2)
+                1 / 0
+        self.assertEqual(RandomId('core.Service').bulk(2), ids)
+        self.assertNotIn('core.Service', RandomId.local.blocks)
+        with self.captureOnCommitCallbacks(execute=True):
+            ids += RandomId('core.Service').bulk(1)
+        # the spare ids of the committed reservation need no other one
+        with self.assertNumQueries(0):
+            ids += RandomId('core.Service').bulk(3)
+        self.assertEqual(len(set(ids)), 6)
+
+    def test_locked_database(self):
+        with mock.patch.object(RandomId, 'reserve', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                RandomId('core.Service').bulk(1)
+            # during migrations, before the tables exist
+            with mock.patch.object(RandomId, 'tables_exist', return_value=False):
+                self.assertEqual(RandomId('core.Service').bulk(2), [None, None])
+
+
+class ClientStatusSummaryTest(TestCase):
+    def setUp(self):
+        self.user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+        self.clients = [self.create_client(company) for company in ('first', 'second', 'invited')]
+        for client in self.clients[:2]:
+            UserToClient.objects.create(user=self.user, client=client)
+        UserToClient.objects.create(user=self.user, client=self.clients[2], invitation=True)
+
+    @staticmethod
+    def create_client(company: str) -> Client:
+        return Client.objects.create(
+            company=company, address1='Street 1', city='City', country='RO', zip_code='1000', phone='0000',
+            status=ClientStatus.active,
+        )
+
+    def get_counts(self) -> dict:
+        counts = ClientStatusSummary.objects.get(user=self.user).to_dict()
+        return {status: count for status, count in counts.items() if count}
+
+    def test_status_change(self):
+        self.assertEqual(self.get_counts(), {ClientStatus.active: 2})
+        self.clients[0].status = ClientStatus.suspended
+        self.clients[0].save()
+        self.clients[2].status = ClientStatus.suspended
+        self.clients[2].save()
+        self.assertEqual(self.get_counts(), {ClientStatus.active: 1, ClientStatus.suspended: 1})
+        self.assertTrue(AppUser.objects.get(pk=self.user.pk).clients_suspended)
+
+    def test_unlink_and_delete(self):
+        UserToClient.objects.filter(client=self.clients[0]).delete()
+        self.assertEqual(self.get_counts(), {ClientStatus.active: 1})
+        membership = UserToClient.objects.get(client=self.clients[2])
+        membership.invitation = False
+        membership.save()
+        self.assertEqual(self.get_counts(), {ClientStatus.active: 2})
+        self.clients[1].delete()
+        self.assertEqual(self.get_counts(), {ClientStatus.active: 1})
+
+    def test_rebuild(self):
+        # queryset updates bypass the signals, the command repairs what they leave behind
+        Client.objects.filter(pk=self.clients[0].pk).update(status=ClientStatus.deleting)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_client_status_summaries', '--check', '--json', stdout=StringIO())
+        call_command('rebuild_client_status_summaries', '--json', stdout=StringIO())
+        self.assertEqual(self.get_counts(), {ClientStatus.active: 1, ClientStatus.deleting: 1})
+        call_command('rebuild_client_status_summaries', '--check', '--json', stdout=StringIO())
+
+
+class RoleClosureTest(TestCase):
+    def setUp(self):
+        self.root = Role.objects.create(name='root')
+        self.child = Role.objects.create(name='child', parent=self.root)
+        self.grandchild = Role.objects.create(name='grandchild', parent=self.child)
+        self.other = Role.objects.create(name='other')
+
+    def get_links(self) -> set:
+        return set(RoleClosure.objects.values_list('ancestor__name', 'descendant__name', 'depth'))
+
+    def test_link(self):
+        self.assertEqual(list(self.grandchild.ancestors()), [self.child, self.root])
+        self.assertEqual(list(self.root.descendants(include_self=True)), [self.root, self.child, self.grandchild])
+        self.assertTrue(self.grandchild.is_descendant_of(self.root))
+        self.assertFalse(self.root.is_descendant_of(self.root))
+
+    def test_move(self):
+        self.child.parent = self.other
+        self.child.save()
+        self.assertEqual(list(self.grandchild.ancestors()), [self.child, self.other])
+        self.assertEqual(list(self.root.descendants()), [])
+        self.child.parent = None
+        self.child.save(update_fields=['parent'])
+        self.assertEqual(list(self.grandchild.ancestors()), [self.child])
+
+    def test_reject_cycle(self):
+        self.root.parent = self.grandchild
+        with self.assertRaises(DataError):
+            self.root.save()
+        self.child.parent = self.child
+        with self.assertRaises(DataError):
+            self.child.save()
+        self.assertEqual(list(self.grandchild.ancestors()), [self.child, self.root])
+
+    def test_delete(self):
+        self.child.delete()
+        self.grandchild.refresh_from_db()
+        self.assertIsNone(self.grandchild.parent_id)
+        self.assertEqual(self.get_links(), {
+            ('root', 'root', 0), ('grandchild', 'grandchild', 0), ('other', 'other', 0),
+        })
+        Role.objects.filter(pk=self.root.pk).delete()
+        self.assertEqual(self.get_links(), {('grandchild', 'grandchild', 0), ('other', 'other', 0)})
+
+    def test_rebuild(self):
+        links = self.get_links()
+        # queryset updates bypass ``Role.save``, the command repairs what they leave behind
+        Role.objects.filter(pk=self.grandchild.pk).update(parent=self.other)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_role_closure', '--check', '--json', stdout=StringIO())
+        call_command('rebuild_role_closure', '--json', stdout=StringIO())
+        self.assertEqual(self.get_links(), links - {('child', 'grandchild', 1), ('root', 'grandchild', 2)} | {
+            ('other', 'grandchild', 1),
+        })
+        call_command('rebuild_role_closure', '--check', '--json', stdout=StringIO())
+
+
+class ClientQueriesTest(TestCase):
+    def setUp(self):
+        self.user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+        self.clients = [self.create_client(company) for company in ('first', 'second', 'third')]
+        for client in self.clients:
+            UserToClient.objects.create(user=self.user, client=client)
+        self.invited_client = self.create_client('invited')
+        UserToClient.objects.create(user=self.user, client=self.invited_client, invitation=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @staticmethod
+    def create_client(company):
+        return Client.objects.create(
+            company=company, address1='Street 1', city='City', country='RO', zip_code='1000', phone='0000',
+        )
+
+    def get_request(self, **params):
+        request = RequestFactory().get('/api/clients', params)
+        request.user = self.user
+        request.session = SessionStore()
+        return request
+
+    def test_list(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/clients')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([client['id'] for client in response.json()], [client.id for client in self.clients])
+
+    def test_detail(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/clients/{}'.format(self.clients[1].id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['company'], 'second')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/clients/{}'.format(self.invited_client.id))
+        self.assertEqual(response.status_code, 404)
+
+    def test_active_client_memoized(self):
+        request = self.get_request(active_client=self.clients[2].id)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.get_active_client(request), self.clients[2])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.user.get_active_client(request), self.clients[2])
+        self.assertEqual(request.session['active_client_id'], self.clients[2].id)
+
+    def test_active_client_session_written_on_change(self):
+        request = self.get_request()
+        request.session['active_client_id'] = self.clients[1].id
+        request.session.modified = False
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.get_active_client(request), self.clients[1])
+        self.assertFalse(request.session.modified)
+
+        request = self.get_request(active_client=self.invited_client.id)
+        request.session['active_client_id'] = 'unknown'
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.get_active_client(request), self.clients[0])
+        self.assertEqual(request.session['active_client_id'], self.clients[0].id)
+
+
+class ServiceCurrencyQueriesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Currency.objects.create(code='USD', rate=1, is_default=True)
+        Currency.objects.create(code='EUR', rate=Decimal('0.915'))
+        # signals invalidate the rates on commit, which never comes in a test case
+        currency_rates.invalidate()
+        self.user = AppUser.objects.create_user(email='user@example.com', password='secret-password')
+        client = Client.objects.create(
+            company='client', address1='Street 1', city='City', country='RO', zip_code='1000', phone='0000',
+        )
+        Service.objects.bulk_create([
+            Service(name='service {}'.format(index), price=Decimal('10.05') + index, duration=30, client=client)
+            for index in range(20)
+        ])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_list_in_currency(self):
+        currency_rates.get_snapshot()
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/services', {'currency': 'eur'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 20)
+        prices = {service['name']: service['price'] for service in response.json()}
+        # 10.05 * 0.915 = 9.19575
+        self.assertEqual(prices['service 0'], '9.20')
+        self.assertEqual({service['currency'] for service in response.json()}, {'EUR'})
+
+    def test_unknown_currency(self):
+        response = self.client.get('/api/services', {'currency': 'XXX'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_default_currency_save(self):
+        currency = Currency.objects.get(code='USD')
+        currency.rate = Decimal('1.000000')
+        # no update of the other currencies
+        with self.assertNumQueries(1):
+            currency.save()
+
+    def test_stale_default_save(self):
+        stale = Currency.objects.get(code='USD')
+        euro = Currency.objects.get(code='EUR')
+        euro.is_default = True
+        euro.save()
+        stale.rate = Decimal('1.100000')
+        stale.save()
+        self.assertEqual(list(Currency.objects.filter(is_default=True).values_list('code', flat=True)), ['EUR'])
+        self.assertEqual(Currency.objects.get(code='USD').rate, Decimal('1.100000'))
+
+    def test_zero_rate(self):
+        currency = Currency(code='GBP', rate=0)
+        with self.assertRaises(ValidationError):
+            currency.full_clean()
+        # saved around the validation
+        Currency.objects.filter(code='USD').update(rate=0)
+        currency.save()
+        currency_rates.invalidate()
+        self.assertEqual(self.client.get('/api/services', {'currency': 'GBP'}).status_code, 400)
+        response = self.client.get('/api/services', {'currency': 'EUR'})
+        self.assertEqual(response.status_code, 200)
+        # relative to a default rate of 1
+        self.assertEqual({service['name']: service['price'] for service in response.json()}['service 0'], '9.20')
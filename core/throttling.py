@@ -0,0 +1,116 @@
+"""
+Approximate sliding window rate throttles.
+
+DRF's rate throttles keep the timestamp of every request within the rate duration under one cache key and rewrite
+that list on each request, so cache memory and traffic grow with the rate limit. These throttles count requests in
+fixed windows as long as the rate duration instead, two integer counters per key: the estimate for the sliding window
+ending now is the count of the current window plus the count of the previous one weighted by how much of it the
+sliding window still covers. Each request costs one cache read and one atomic increment, plus one decrement when it is
+throttled since throttled requests aren't counted, as with DRF.
+
+The increments are atomic with Redis or Memcached, the database and file caches do them as a read and a write.
+"""
+from typing import Optional, Tuple
+
+from rest_framework import throttling
+
+
+class SlidingWindowThrottle(throttling.SimpleRateThrottle):
+    """Drop-in base for ``SimpleRateThrottle`` subclasses, which only need to define ``get_cache_key``."""
+    window = None  # type: Optional[int]
+
+    def bucket_keys(self) -> Tuple[str, str]:
+        return '{}:{}'.format(self.key, self.window), '{}:{}'.format(self.key, self.window - 1)
+
+    def increment(self, key: str) -> int:
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # the previous window counter must outlive the current window
+            if self.cache.add(key, 1, 2 * self.duration):
+                return 1
+            return self.cache.incr(key)
+
+    def estimate(self, current: int, previous: int) -> float:
+        elapsed = (self.now % self.duration) / self.duration
+        return previous * (1 - elapsed) + current
+
+    def prepare(self, request, view) -> bool:
+        if self.rate is None:
+            return False
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return False
+        self.now = self.timer()
+        self.window = int(self.now // self.duration)
+        return True
+
+    def allow_request(self, request, view):
+        if not self.prepare(request, view):
+            return True
+        current_key, previous_key = self.bucket_keys()
+        self.previous = self.cache.get(previous_key, 0)
+        self.current = self.increment(current_key)
+        if self.estimate(self.current, self.previous) > self.num_requests:
+            self.cache.decr(current_key)
+            self.current -= 1
+            return self.throttle_failure()
+        return self.throttle_success()
+
+    def throttle_success(self):
+        # counted by ``allow_request``, there's no history to store
+        return True
+
+    def would_throttle(self, request, view) -> bool:
+        """Whether a request would be throttled now, without counting it."""
+        if not self.prepare(request, view):
+            return False
+        current_key, previous_key = self.bucket_keys()
+        counts = self.cache.get_many([current_key, previous_key])
+        return self.estimate(counts.get(current_key, 0) + 1, counts.get(previous_key, 0)) > self.num_requests
+
+    def remove_last_request(self, request, view):
+        """Stop counting a request allowed in the current window, e.g. one that failed validation."""
+        if not self.prepare(request, view):
+            return
+        current_key, _ = self.bucket_keys()
+        try:
+            if self.cache.get(current_key, 0) > 0:
+                self.cache.decr(current_key)
+        except ValueError:
+            # the counter expired meanwhile
+            pass
+
+    def wait(self):
+        """Seconds until the estimate leaves room for one more request."""
+        elapsed = self.now % self.duration
+        remaining = self.duration - elapsed
+        allowed = self.num_requests - 1
+        if self.current <= allowed and self.previous:
+            # within the current window, as the previous window weighs less and less
+            needed = self.duration * (1 - (allowed - self.current) / self.previous) - elapsed
+            if needed < remaining:
+                return max(0.0, needed)
+        if not self.current:
+            return remaining
+        # within the next window, as the current window weighs less and less
+        return remaining + max(0.0, self.duration * (1 - allowed / self.current))
+
+
+class AnonRateThrottle(SlidingWindowThrottle, throttling.AnonRateThrottle):
+    pass
+
+
+class UserRateThrottle(SlidingWindowThrottle, throttling.UserRateThrottle):
+    pass
+
+
+class ScopedRateThrottle(SlidingWindowThrottle, throttling.ScopedRateThrottle):
+    def allow_request(self, request, view):
+        # the scope comes from the view
+        self.scope = getattr(view, self.scope_attr, None)
+        if not self.scope:
+            return True
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        return super().allow_request(request, view)
@@ -1,17 +1,25 @@
 from django.urls import path
 
 from rest_framework import routers
-from core.authentication.views import SignUpViewSet, current_user, login
+from core.authentication.async_views import login, signup
+from core.authentication.views import (
+    current_user, impersonate, logout, otp_token, signed_token, stop_impersonation,
+)
 from core.services.views import ServicesViewSet
 from core.views import ClientViewSet
 
 router = routers.SimpleRouter(trailing_slash=False)
-router.register(r'signup/', SignUpViewSet, basename='signup')
 router.register(r'clients', ClientViewSet, basename='clients')
 router.register(r'services', ServicesViewSet, basename='services')
 
 urlpatterns = [
     path("login/", login),
+    path('signup/', signup),
+    path("logout/", logout),
+    path('tokens/signed', signed_token),
+    path('tokens/otp', otp_token),
+    path('impersonate/<int:user_id>', impersonate),
+    path('impersonate/stop', stop_impersonation),
     path('current-user/', current_user)
 ]
 
@@ -1,29 +1,78 @@
 from django.contrib import auth
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
 from django.utils.deconstruct import deconstructible
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
+from django.db import connections, router, transaction
 from django.db.utils import OperationalError
 from django.db.utils import ProgrammingError
 from django.apps import apps
+from typing import List, Optional, Tuple
+import hashlib
 import random
+import secrets
+import threading
+import zoneinfo
 
 
 
 
+class FeistelPermutation:
+    """Keyed permutation of ``range(size)``: a balanced Feistel network over the next even bit width, cycle walking
+    values that fall outside the range."""
+    ROUNDS = 4
+
+    def __init__(self, size: int, key: bytes):
+        self.size = size
+        self.key = key
+        bits = max(2, (size - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+
+    def round(self, number: int, value: int) -> int:
+        digest = hashlib.blake2b(value.to_bytes(8, 'little'), key=self.key, digest_size=8, person=bytes([number]))
+        return int.from_bytes(digest.digest(), 'little') & self.mask
+
+    def encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.mask
+        for number in range(self.ROUNDS):
+            left, right = right, left ^ self.round(number, right)
+        return (left << self.half_bits) | right
+
+    def __call__(self, value: int) -> int:
+        # the network permutes a range less than 4 times larger, walking takes few steps on average
+        value = self.encrypt(value)
+        while value >= self.size:
+            value = self.encrypt(value)
+        return value
+
+
 @deconstructible
 class RandomId(object):
     """
     Callable that generates a random primary key that is unique in the specified model's table.
+
+    Ids are a keyed permutation of a per model counter (``RandomIdSequence``), so they look random but never repeat
+    and need no probe query: counter values are reserved ``BLOCK_SIZE`` at a time and each block is checked once
+    against ids generated before the counter existed. The counter goes through the ``APPITY_RANDOM_ID`` range
+    ``MIN`` to ``MAX``, then through ``MAX + 1`` to ``MAX * GROWTH_FACTOR`` and so on.
+
+    A reservation made inside a transaction goes back with it on rollback, so its spare ids are only kept for later
+    calls once it commits (``transaction.on_commit``). Such a reservation also keeps the sequence row locked until the
+    transaction ends, making other transactions reserving ids of the same model wait; spare ids make it happen once
+    per ``BLOCK_SIZE`` ids per thread, and a long transaction creating many rows can take its ids with ``bulk``
+    before it starts.
     """
+    local = threading.local()
 
     def __init__(self, model_param):
         """:param: model - can be model name as string or model class"""
         self.model_param = model_param
 
-    def __call__(self):
-        random.seed()
+    def get_model_and_scope(self):
+        """:return: the model class (None when it is not available yet) and the APPITY_RANDOM_ID scope to use"""
         if isinstance(self.model_param, str):
             model_name = self.model_param
             try:
@@ -41,29 +90,152 @@ class RandomId(object):
         scope = 'default'
         if model_name in settings.APPITY_RANDOM_ID:
             scope = model_name
-        minimum = settings.APPITY_RANDOM_ID[scope]['MIN']
-        maximum = settings.APPITY_RANDOM_ID[scope]['MAX']
-        retries = 0
-        ModelClass = model_class
-        while True:
-            rid = random.randint(minimum, maximum)  # nosec B311
-            if model_class is None:
-                # database table does not exist; we're probably in a migration
-                return rid
+        return model_class, scope
+
+    @staticmethod
+    def get_range(options: dict, generation: int) -> Tuple[int, int]:
+        """:return: first and last id of a generation of the id range"""
+        minimum, maximum = options['MIN'], options['MAX']
+        for _ in range(generation):
+            minimum, maximum = maximum + 1, maximum * options['GROWTH_FACTOR']
+        return minimum, maximum
+
+    def reserve(self, model_class, options: dict, count: int) -> List[int]:
+        """Reserve ``count`` counter values and turn them into ids not taken in the table."""
+        sequence_model = apps.get_model('core.RandomIdSequence')
+        using = router.db_for_write(model_class)
+        ids = []
+        with transaction.atomic(using=using):
+            sequence, _ = sequence_model.objects.using(using).select_for_update().get_or_create(
+                name=model_class._meta.label, defaults={'key': secrets.token_hex(16)},
+            )
+            while len(ids) < count:
+                minimum, maximum = self.get_range(options, sequence.generation)
+                size = maximum - minimum + 1
+                if sequence.next_value >= size:
+                    sequence.generation += 1
+                    sequence.next_value = 0
+                    continue
+                end = min(size, sequence.next_value + count - len(ids))
+                key = hashlib.blake2b(
+                    '{}:{}'.format(sequence.key, sequence.generation).encode(), digest_size=32,
+                ).digest()
+                permutation = FeistelPermutation(size, key)
+                ids.extend(minimum + permutation(value) for value in range(sequence.next_value, end))
+                sequence.next_value = end
+            sequence.save(using=using)
+        # ids generated at random before the counter existed
+        taken = set()
+        for start in range(0, len(ids), 1000):
+            taken.update(model_class._base_manager.using(using).filter(
+                id__in=ids[start:start + 1000],
+            ).values_list('id', flat=True))
+        return [rid for rid in ids if rid not in taken]
+
+    @staticmethod
+    def tables_exist(model_class, using: str) -> bool:
+        tables = connections[using].introspection.table_names()
+        sequence_model = apps.get_model('core.RandomIdSequence')
+        return model_class._meta.db_table in tables and sequence_model._meta.db_table in tables
+
+    def keep(self, label: str, ids: List[int], using: str):
+        """Keep spare ids for later calls of this thread, once the transaction reserving them committed."""
+        if not ids:
+            return
+        if not connections[using].in_atomic_block:
+            self.local.blocks.setdefault(label, []).extend(ids)
+            return
+        blocks = self.local.blocks
+        transaction.on_commit(lambda: blocks.setdefault(label, []).extend(ids), using=using)
+
+    def take(self, count: int) -> List[int]:
+        model_class, scope = self.get_model_and_scope()
+        options = settings.APPITY_RANDOM_ID[scope]
+        if model_class is None:
+            # database table does not exist; we're probably in a migration
+            return [random.randint(options['MIN'], options['MAX']) for _ in range(count)]  # nosec B311
+        blocks = getattr(self.local, 'blocks', None)
+        if blocks is None:
+            blocks = self.local.blocks = {}
+        label = model_class._meta.label
+        using = router.db_for_write(model_class)
+        ids = []
+        while len(ids) < count:
+            block = blocks.get(label)
+            if block:
+                taken = block[:count - len(ids)]
+                del block[:len(taken)]
+                ids.extend(taken)
+                continue
             try:
-                if not ModelClass.objects.filter(id=rid).exists():
-                    break
+                reserved = self.reserve(model_class, options, max(count - len(ids), options.get('BLOCK_SIZE', 100)))
             except (ProgrammingError, OperationalError):
-                # db table probably doesn't exist yet
+                # a locked database or any other error of existing tables is not ours to hide
+                if self.tables_exist(model_class, using):
+                    raise
                 # workaround for the fact that schema migration (uselessly) tries to get the field's default value
                 # ProgrammingError - for mysql
                 # OperationalError - for sqlite
-                return None
-            retries += 1
-            if retries >= settings.APPITY_RANDOM_ID[scope]['GROW_AFTER_COLLISIONS']:
-                maximum = maximum * settings.APPITY_RANDOM_ID[scope]['GROWTH_FACTOR']
-                retries = 0
-        return rid
+                return [None] * count
+            wanted = count - len(ids)
+            ids.extend(reserved[:wanted])
+            self.keep(label, reserved[wanted:], using)
+        return ids
+
+    def __call__(self):
+        return self.take(1)[0]
+
+    def bulk(self, count):
+        """
+        Generate many unique ids at once, for bulk_create.
+        :param count: number of ids to generate
+        :return: list of distinct ids
+        """
+        return self.take(count)
+
+
+class LoadedValues:
+    """
+    Remembers the values of ``loaded_fields`` as last loaded from or saved to the database, so that signal receivers
+    see what a save changes without reading the row again. ``loaded_values`` is None when the instance was not
+    loaded from the database or some of the fields were deferred.
+    """
+    loaded_fields = ()  # type: tuple
+    loaded_values = None  # type: Optional[dict]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_loaded_values()
+        return instance
+
+    def remember_loaded_values(self, update_fields=None):
+        values = self.__dict__
+        if update_fields is not None:
+            loaded_values = getattr(self, 'loaded_values', None)
+            if loaded_values is not None:
+                names = {self._meta.get_field(name).attname for name in update_fields}
+                loaded_values.update((name, values[name]) for name in self.loaded_fields if name in names)
+            return
+        self.loaded_values = {name: values[name] for name in self.loaded_fields} if all(
+            name in values for name in self.loaded_fields
+        ) else None
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        self.remember_loaded_values(kwargs.get('update_fields'))
+        return result
+
+
+def validate_timezone(value):
+    """Accept IANA timezone names, empty meaning the default timezone."""
+    if not value:
+        return
+    try:
+        zoneinfo.ZoneInfo(value)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValidationError(_('Unknown timezone.'))
+
 
 def appity_create_user(email, password=None, **extra_fields):
     """